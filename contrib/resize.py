@@ -1,36 +1,16 @@
+#!/usr/bin/env python3
+"""
+Обрабатывает все .jpg/.png в текущем каталоге и сохраняет результат в resized/.
+Использует тот же код обработки, что и сайт (fm.helpers.render_image).
+Для обработки загруженных файлов используйте manage.py rerender_media.
+"""
 
 import os
 import sys
-from PIL import Image
 
-class Model(object):
-    def __init__(self, filename):
-        self.profile_photo = filename
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
-    def save(self, output):
-        width = 800
-        ratio = 16/9
-
-        img = Image.open(self.profile_photo)
-
-        crop = [
-            min(round(img.size[1] * ratio), img.size[0]),
-            min(round(img.size[0] / ratio), img.size[1])
-        ]
-        box = (
-            (img.size[0] - crop[0])/2,
-            (img.size[1] - crop[1])/2,
-            (img.size[0] + crop[0])/2,
-            (img.size[1] + crop[1])/2
-        )
-        factor = 1 if crop[0] < width else width/crop[0]
-        size = (
-            round(crop[0] * factor),
-            round(crop[1] * factor)
-        )
-
-        img = img.resize(size=size, resample=Image.BILINEAR, box=box)
-        img.save(output, format='JPEG', quality=100)
+from fm.helpers import render_image, POST_IMAGE_SIZE
 
 resized_dir = 'resized'
 if not os.path.exists(resized_dir):
@@ -38,5 +18,7 @@ if not os.path.exists(resized_dir):
 
 for filename in os.listdir('.'):
     if filename.endswith('.jpg') or filename.endswith('.png'):
-        m = Model(filename)
-        m.save('%s/%s.jpg' % (resized_dir, filename.split('.')[0]))
+        with open(filename, 'rb') as f:
+            output = render_image(f, *POST_IMAGE_SIZE)
+        with open('%s/%s.jpg' % (resized_dir, filename.split('.')[0]), 'wb') as f:
+            f.write(output)
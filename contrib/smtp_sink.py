@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Локальный SMTP-сервер, который принимает и отбрасывает письма: заменяет
+почтовый сервер при тестах и замерах обработчика очереди писем.
+
+    python3 contrib/smtp_sink.py -p 1025 --delay 0.5
+
+    # settings: EMAIL_HOST = 'localhost'; EMAIL_PORT = 1025
+    python3 manage.py outbox_worker --once
+
+Параметр --delay добавляет паузу перед ответом на каждое письмо (медленный
+сервер), --connect-delay - перед приветствием (дорогое соединение).
+Письма можно сохранять в каталог (-o) для проверки содержимого.
+"""
+
+import argparse
+import os
+import socketserver
+import threading
+import time
+
+stats = {'connections': 0, 'messages': 0}
+lock = threading.Lock()
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        args = self.server.args
+        with lock:
+            stats['connections'] += 1
+        time.sleep(args.connect_delay)
+        self.reply('220 localhost smtp-sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip().split(' ', 1)[0].upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif command in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                self.receive()
+                time.sleep(args.delay)
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+    def receive(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line == b'.\r\n':
+                break
+            lines.append(line[1:] if line.startswith(b'..') else line)
+        with lock:
+            stats['messages'] += 1
+            number = stats['messages']
+        if self.server.args.output:
+            with open(os.path.join(self.server.args.output, '%06d.eml' % number), 'wb') as f:
+                f.writelines(lines)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SMTP server that accepts and drops messages')
+    parser.add_argument('-p', dest='port', type=int, default=1025)
+    parser.add_argument('--delay', type=float, default=0, help='Seconds before accepting each message')
+    parser.add_argument('--connect-delay', type=float, default=0, help='Seconds before greeting')
+    parser.add_argument('-o', dest='output', default=None, help='Directory to save messages to')
+    args = parser.parse_args()
+
+    server = Server(('localhost', args.port), SMTPHandler)
+    server.args = args
+    print('Listening on localhost:%d' % args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print('Connections: %(connections)d, messages: %(messages)d' % stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,12 @@
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
 from django.forms import TextInput, Textarea, BaseForm
-from django.db import models
+from django.db import connection, models, DatabaseError
+from django.utils.functional import cached_property
 from django.utils.safestring import mark_safe
-from .models import Post, Comment, Tag, City, User
+from .models import Post, Comment, Tag, City, User, OutboxEmail
+from .exports import export_action, viewed_count_of
 from rangefilter.filter import DateRangeFilter
 from django.templatetags.static import StaticNode
 
@@ -15,13 +19,11 @@ class DateRangeFilterFM(DateRangeFilter):
 
    def get_form(self, request):
        form_class = self._get_form_class()
-       print(self.used_parameters)
        return form_class(self.used_parameters)
 
    def queryset(self, request, queryset):
        if self.form.is_valid():
            validated_data = dict(self.form.cleaned_data.items())
-           print(validated_data)
            if validated_data.get('my_posts__created__gte'):
                queryset = queryset.filter(
                    my_posts__created__gte=validated_data.get('my_posts__created__gte') or date(1970, 1, 1),
@@ -29,7 +31,7 @@ class DateRangeFilterFM(DateRangeFilter):
                    )
 
            return queryset.annotate(created_count=models.Count('my_posts')) \
-           .annotate(viewed_count=models.Count('posts_viewed'))
+           .annotate(viewed_count=viewed_count_of())
        return queryset
 
    @staticmethod
@@ -39,6 +41,77 @@ class DateRangeFilterFM(DateRangeFilter):
           StaticNode.handle_simple('js/DateTimeShortcuts.js'),
        ]
 
+def estimate_rows(model):
+    """
+    Оценка числа строк таблицы по статистике БД (без COUNT(*)) или None.
+    """
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute('SELECT table_rows FROM information_schema.tables '
+                'WHERE table_schema = DATABASE() AND table_name = %s', [table])
+        elif connection.vendor == 'sqlite':
+            # Таблица статистики появляется после ANALYZE
+            try:
+                cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+            except DatabaseError:
+                return None
+        else:
+            return None
+        row = cursor.fetchone()
+    if not row or row[0] is None:
+        return None
+    return int(str(row[0]).split()[0].split('.')[0])
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Для списка без фильтров берет число строк из статистики БД, если таблица
+    большая (FM_ADMIN_ESTIMATE_THRESHOLD); отфильтрованные списки считает точно.
+    """
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            estimate = estimate_rows(self.object_list.model)
+            if estimate and estimate > getattr(settings, 'FM_ADMIN_ESTIMATE_THRESHOLD', 10000):
+                return estimate
+        return super(EstimatedCountPaginator, self).count
+
+class FastChangeListMixin(object):
+    """
+    Список без точного COUNT(*) по всей таблице и поиск с ограниченной стоимостью:
+    число ищется еще и как id, текст - сначала среди последних FM_ADMIN_SEARCH_WINDOW
+    записей (диапазон по первичному ключу вместо просмотра всей таблицы). Если там
+    ничего нет, ищется по всей таблице; если есть - сотрудник видит сообщение,
+    что более старые записи не просматривались.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+
+        base = queryset
+        window = getattr(settings, 'FM_ADMIN_SEARCH_WINDOW', 50000)
+        last = queryset.model._default_manager.order_by('-pk').values_list('pk', flat=True).first()
+        search = super(FastChangeListMixin, self).get_search_results
+        if window and last is not None and last > window:
+            queryset, use_distinct = search(request, queryset.filter(pk__gt=last - window), search_term)
+            if queryset.exists():
+                messages.info(request, 'Текст искался только среди последних %d записей (id больше %d).'
+                    % (window, last - window))
+            else:
+                queryset, use_distinct = search(request, base, search_term)
+        else:
+            queryset, use_distinct = search(request, queryset, search_term)
+        if search_term.isdigit():
+            queryset = queryset | base.filter(pk=int(search_term))
+        return queryset, use_distinct
+
 admin.site.site_header = 'Администрирование Friendmarket'
 #admin.site.site_title =
 from django.utils import timezone
@@ -56,9 +129,10 @@ class CommentInline(admin.TabularInline):
     }
 
 @admin.register(Post)
-class PostAdmin(admin.ModelAdmin):
+class PostAdmin(FastChangeListMixin, admin.ModelAdmin):
     list_display = ('id', 'typeContent', 'title', 'author_full_name', 'author', 'created', 'city')
     list_display_links = ('title', )
+    list_select_related = ('author', 'city')
     list_filter = ('typeContent', 'city')
 
     fieldsets = (
@@ -80,24 +154,29 @@ class PostAdmin(admin.ModelAdmin):
     empty_value_display = '-нет-'
 
     inlines = (CommentInline, )
+    actions = (export_action('posts', 'csv'), export_action('posts', 'ndjson'))
 
     def author_full_name(self, obj):
         return obj.author.get_full_name()
     author_full_name.short_description = 'Имя автора'
 
     def image_preview(self, obj):
+        if not obj.image:
+            return ''
+        # Размеры сохранены при загрузке, файл не открывается
         return mark_safe('<img src="{url}" width="{width}" height={height} />'.format(
                 url=obj.image.url,
-                width=obj.image.width,
-                height=obj.image.height,
+                width=obj.image_width,
+                height=obj.image_height,
             )
         )
     image_preview.short_description = 'Изображение'
 
 @admin.register(Comment)
-class CommentAdmin(admin.ModelAdmin):
+class CommentAdmin(FastChangeListMixin, admin.ModelAdmin):
     list_display = ('id', 'comment', 'post', 'author')
     list_display_links = ('comment', )
+    list_select_related = ('post', 'author')
 
     fieldsets = (
         (None, {
@@ -105,6 +184,7 @@ class CommentAdmin(admin.ModelAdmin):
         }),
     )
     search_fields = ('comment', 'post__title')
+    actions = (export_action('comments', 'csv'), export_action('comments', 'ndjson'))
 
     empty_value_display = '-нет-'
 
@@ -122,6 +202,14 @@ class CityAdmin(admin.ModelAdmin):
     list_editable = ('name', )
     ordering = ('name', )
 
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('id', 'subject', 'recipients', 'created', 'attempts', 'next_attempt', 'last_error')
+    list_display_links = ('subject', )
+    # Текст письма может содержать пароль
+    exclude = ('message', )
+    readonly_fields = ('subject', 'from_email', 'recipients', 'created', 'attempts', 'last_error')
+
 class PostInline(admin.TabularInline):
     model = Post
     fk_name = 'author'
@@ -133,8 +221,8 @@ class PostInline(admin.TabularInline):
     }
 
 @admin.register(User)
-class StatisticsAdmin(admin.ModelAdmin):
-    
+class StatisticsAdmin(FastChangeListMixin, admin.ModelAdmin):
+
     def created_count(self, obj):
         return obj.created_count or ''
 
@@ -164,5 +252,6 @@ class StatisticsAdmin(admin.ModelAdmin):
     )
 
     inlines = (PostInline, )
+    actions = (export_action('users', 'csv'), export_action('users', 'ndjson'))
 
     # date_hierarchy = 'my_posts__created'
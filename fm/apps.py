@@ -6,3 +6,6 @@ class FmConfig(AppConfig):
 
     def ready(self):
         import fm.signals
+        from django.db.backends.signals import connection_created
+        from fm.slowlog import install
+        connection_created.connect(install, dispatch_uid='fm-slowlog')
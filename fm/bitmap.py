@@ -0,0 +1,95 @@
+from array import array
+from bisect import bisect_left
+
+# Контейнер хранит младшие 16 бит чисел одного диапазона (65536 значений).
+# До ARRAY_LIMIT значений - отсортированный массив uint16 (2 байта на число),
+# больше - битовая карта фиксированного размера 8 КБ, как в Roaring bitmap.
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+ARRAY_LIMIT = 4096
+
+ARRAY = b'A'
+BITMAP = b'B'
+
+
+def split(value):
+    """
+    Номер контейнера и позиция в нем.
+    """
+    return value >> CHUNK_BITS, value & (CHUNK_SIZE - 1)
+
+
+def group(values):
+    """
+    Раскладывает числа по контейнерам: {номер: [позиции]}.
+    """
+    chunks = {}
+    for value in values:
+        key, low = split(value)
+        chunks.setdefault(key, []).append(low)
+    return chunks
+
+
+class Container(object):
+    """
+    Множество чисел 0..65535. Массив хранится как array('H'),
+    битовая карта - как целое число Python (быстрые побитовые операции).
+    """
+    __slots__ = ('values', 'bits')
+
+    def __init__(self, values=None, bits=None):
+        self.values = values
+        self.bits = bits
+        if values is None and bits is None:
+            self.values = array('H')
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        if data[:1] == BITMAP:
+            return cls(bits=int.from_bytes(data[1:], 'little'))
+        values = array('H')
+        values.frombytes(data[1:])
+        return cls(values=values)
+
+    def to_bytes(self):
+        if self.bits is not None:
+            return BITMAP + self.bits.to_bytes(CHUNK_SIZE // 8, 'little')
+        return ARRAY + self.values.tobytes()
+
+    def __len__(self):
+        if self.bits is not None:
+            return bin(self.bits).count('1')
+        return len(self.values)
+
+    def __contains__(self, low):
+        if self.bits is not None:
+            return bool(self.bits >> low & 1)
+        i = bisect_left(self.values, low)
+        return i < len(self.values) and self.values[i] == low
+
+    def __iter__(self):
+        if self.bits is None:
+            return iter(self.values)
+        bits = self.bits
+        return (i for i in range(bits.bit_length()) if bits >> i & 1)
+
+    def add_many(self, lows):
+        """
+        Добавляет значения; возвращает число действительно новых.
+        """
+        before = len(self)
+        if self.bits is not None:
+            for low in lows:
+                self.bits |= 1 << low
+        else:
+            merged = set(self.values)
+            merged.update(lows)
+            if len(merged) > ARRAY_LIMIT:
+                bits = 0
+                for low in merged:
+                    bits |= 1 << low
+                self.values, self.bits = None, bits
+            else:
+                self.values = array('H', sorted(merged))
+        return len(self) - before
@@ -0,0 +1,187 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.cache import caches
+from django.http import JsonResponse
+
+# Двухуровневый кэш: L1 - ограниченный LRU в памяти процесса, L2 - общий
+# кэш Django (FM_CACHE_ALIAS). Значения лежат в пространствах имен ("tags",
+# "post:12"); у каждого пространства в L2 есть номер версии, входящий в ключи.
+# Сброс пространства увеличивает версию: старые записи L2 становятся
+# недоступны, а другие процессы замечают новую версию при очередном чтении
+# пространства (сверка с L2 не чаще раза в FM_CACHE_BUS_INTERVAL сек.).
+# Записи L1 хранятся с версией пространства: после сброса они просто
+# перестают совпадать и вытесняются LRU, перебирать L1 не нужно. Версии
+# помнятся для FM_CACHE_NAMESPACES последних прочитанных пространств.
+
+MISSING = object()
+
+
+def stats_name(namespace):
+    return namespace.split(':', 1)[0]
+
+
+class TwoTierCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # (namespace, key) -> (version, value)
+        self.versions = OrderedDict()   # namespace -> (версия, время сверки с L2), LRU
+        self.stats = {}
+
+    @property
+    def l2(self):
+        return caches[getattr(settings, 'FM_CACHE_ALIAS', 'default')]
+
+    def count(self, namespace, name):
+        # Вызывается под self.lock
+        counters = self.stats.setdefault(stats_name(namespace), {
+            'l1_hits': 0, 'l2_hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0})
+        counters[name] += 1
+
+    def version(self, namespace):
+        """
+        Версия пространства. Сверяется с L2 только для читаемого пространства
+        и не чаще раза в FM_CACHE_BUS_INTERVAL сек.
+        """
+        now = time.time()
+        with self.lock:
+            known = self.versions.get(namespace)
+            if known is not None and now - known[1] < getattr(settings, 'FM_CACHE_BUS_INTERVAL', 1.0):
+                self.versions.move_to_end(namespace)
+                return known[0]
+
+        key = 'fm:ns:%s' % namespace
+        version = self.l2.get(key)
+        if version is None:
+            version = int(time.time() * 1000)
+            self.l2.add(key, version, None)
+            version = self.l2.get(key, version)
+
+        with self.lock:
+            self.versions[namespace] = (version, now)
+            self.versions.move_to_end(namespace)
+            while len(self.versions) > getattr(settings, 'FM_CACHE_NAMESPACES', 5000):
+                self.versions.popitem(last=False)
+        return version
+
+    def lookup_l1(self, namespace, key, version):
+        # Вызывается под self.lock; запись старой версии удаляется при чтении
+        entry = self.entries.get((namespace, key))
+        if entry is None:
+            return MISSING
+        if entry[0] != version:
+            del self.entries[(namespace, key)]
+            return MISSING
+        self.entries.move_to_end((namespace, key))
+        self.count(namespace, 'l1_hits')
+        return entry[1]
+
+    def get(self, namespace, key, default=None):
+        version = self.version(namespace)
+        with self.lock:
+            value = self.lookup_l1(namespace, key, version)
+        if value is not MISSING:
+            return value
+
+        value = self.l2.get('fm:%s:%s:%s' % (namespace, version, key), MISSING)
+        if value is MISSING:
+            with self.lock:
+                self.count(namespace, 'misses')
+            return default
+        self.put_l1(namespace, key, version, value, 'l2_hits')
+        return value
+
+    def set(self, namespace, key, value, timeout=None):
+        version = self.version(namespace)
+        if timeout is None:
+            timeout = getattr(settings, 'FM_CACHE_TIMEOUT', 300)
+        self.l2.set('fm:%s:%s:%s' % (namespace, version, key), value, timeout)
+        self.put_l1(namespace, key, version, value)
+
+    def get_many(self, namespace, keys):
+        """
+        {ключ: значение} для найденных ключей: сначала L1, остальное одним запросом к L2.
+        """
+        version = self.version(namespace)
+        found, rest = {}, []
+        with self.lock:
+            for key in keys:
+                value = self.lookup_l1(namespace, key, version)
+                if value is MISSING:
+                    rest.append(key)
+                else:
+                    found[key] = value
+
+        if rest:
+            names = {'fm:%s:%s:%s' % (namespace, version, key): key for key in rest}
+            values = self.l2.get_many(list(names))
+            for name, key in names.items():
+                if name not in values:
+                    with self.lock:
+                        self.count(namespace, 'misses')
+                    continue
+                self.put_l1(namespace, key, version, values[name], 'l2_hits')
+                found[key] = values[name]
+        return found
+
+    def set_many(self, namespace, values, timeout=None):
+        version = self.version(namespace)
+        if timeout is None:
+            timeout = getattr(settings, 'FM_CACHE_TIMEOUT', 300)
+        self.l2.set_many({'fm:%s:%s:%s' % (namespace, version, key): value
+            for key, value in values.items()}, timeout)
+        for key, value in values.items():
+            self.put_l1(namespace, key, version, value)
+
+    def get_or_set(self, namespace, key, default, timeout=None):
+        value = self.get(namespace, key, MISSING)
+        if value is MISSING:
+            value = default()
+            self.set(namespace, key, value, timeout)
+        return value
+
+    def put_l1(self, namespace, key, version, value, counter=None):
+        with self.lock:
+            if counter is not None:
+                self.count(namespace, counter)
+            self.entries[(namespace, key)] = (version, value)
+            self.entries.move_to_end((namespace, key))
+            while len(self.entries) > getattr(settings, 'FM_CACHE_L1_SIZE', 1000):
+                evicted, _ = self.entries.popitem(last=False)
+                self.count(evicted[0], 'evictions')
+
+    def invalidate(self, *namespaces):
+        for namespace in namespaces:
+            key = 'fm:ns:%s' % namespace
+            try:
+                self.l2.incr(key)
+            except ValueError:
+                # Пространство еще не использовалось ни одним процессом
+                pass
+            with self.lock:
+                # Записи L1 старой версии больше не совпадут при чтении
+                self.versions.pop(namespace, None)
+                self.count(namespace, 'invalidations')
+
+    def clear_local(self):
+        with self.lock:
+            self.entries.clear()
+            self.versions.clear()
+            self.stats.clear()
+
+
+cache = TwoTierCache()
+
+
+@staff_member_required
+def cache_stats(request):
+    with cache.lock:
+        stats = {name: dict(counters) for name, counters in cache.stats.items()}
+        size = len(cache.entries)
+    return JsonResponse({
+        'l1_size': size,
+        'namespaces': stats,
+    })
@@ -0,0 +1,103 @@
+import hashlib
+import zlib
+
+import numpy as np
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+
+from fm.models import Post, MinHashBand, MinHashSignature
+from fm.textindex import features
+
+# MinHash-подпись вопроса - NUM_HASHES минимумов хэшей его признаков (слова
+# и триграммы, как в fm.textindex); доля совпавших минимумов оценивает меру
+# Жаккара. Подпись режется на BANDS полос по ROWS значений, ключи полос лежат
+# в MinHashBand: кандидаты в дубликаты находятся по индексу ключей, без
+# перебора всех вопросов, и сравниваются по подписям из MinHashSignature. С 16 полосами по 4 вопросы с мерой 0.5 находятся
+# с вероятностью ~0.65, с мерой 0.7 - ~0.99.
+BANDS = 16
+ROWS = 4
+NUM_HASHES = BANDS * ROWS
+PRIME = (1 << 31) - 1
+
+_random = np.random.RandomState(20180622)
+A = _random.randint(1, PRIME, NUM_HASHES).astype(np.int64)
+B = _random.randint(0, PRIME, NUM_HASHES).astype(np.int64)
+
+
+def signature(title, description=''):
+    shingles = set(features('%s %s' % (title or '', description or '')))
+    if not shingles:
+        return None
+    codes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) % PRIME for shingle in shingles),
+        dtype=np.int64, count=len(shingles))
+    return ((np.outer(codes, A) + B) % PRIME).min(axis=0)
+
+
+def band_keys(sig):
+    keys = []
+    for band in range(BANDS):
+        digest = hashlib.blake2b(sig[band * ROWS:(band + 1) * ROWS].tobytes(),
+            digest_size=8, person=b'band%02d' % band).digest()
+        keys.append(int.from_bytes(digest, 'big') >> 1)
+    return keys
+
+
+def index(post):
+    """
+    Перестраивает ключи вопроса; у постов других типов ключи удаляются.
+    """
+    index_many([post])
+
+
+def index_many(posts):
+    """
+    То же для пачки постов (импорт, перестроение) - четыре запроса на пачку.
+    """
+    bands, signatures = [], []
+    for post in posts:
+        sig = signature(post.title, post.description) if post.typeContent == Post.QUESTION else None
+        if sig is not None:
+            bands.extend(MinHashBand(post_id=post.pk, key=key) for key in band_keys(sig))
+            signatures.append(MinHashSignature(post_id=post.pk, data=sig.astype('<u4').tobytes()))
+    post_ids = [post.pk for post in posts]
+    with transaction.atomic():
+        MinHashBand.objects.filter(post_id__in=post_ids).delete()
+        MinHashSignature.objects.filter(post_id__in=post_ids).delete()
+        MinHashBand.objects.bulk_create(bands)
+        MinHashSignature.objects.bulk_create(signatures)
+
+
+def find(title, description='', limit=5, exclude=None):
+    """
+    [(id вопроса, оценка меры Жаккара)] по убыванию оценки, не ниже FM_DUPLICATE_MIN_SCORE.
+    Кандидаты - FM_DUPLICATE_CANDIDATES вопросов с наибольшим числом совпавших полос.
+    """
+    sig = signature(title, description)
+    if sig is None:
+        return []
+    candidates = MinHashBand.objects.filter(key__in=band_keys(sig))
+    if exclude is not None:
+        candidates = candidates.exclude(post_id=exclude)
+    candidates = candidates.values('post_id').annotate(n=Count('id')).order_by('-n') \
+        [:getattr(settings, 'FM_DUPLICATE_CANDIDATES', 200)]
+    post_ids = [row['post_id'] for row in candidates]
+
+    questions = Post.objects.filter(pk__in=post_ids, typeContent=Post.QUESTION)
+    signatures = {pk: np.frombuffer(data, dtype='<u4') for pk, data in MinHashSignature.objects
+        .filter(post__in=questions).values_list('post_id', 'data')}
+    # Вопросы, проиндексированные до появления MinHashSignature, подписываются
+    # заново (до запуска duplicates_rebuild)
+    for pk, other_title, other_description in questions.exclude(pk__in=list(signatures)) \
+            .values_list('pk', 'title', 'description'):
+        signatures[pk] = signature(other_title, other_description)
+
+    min_score = getattr(settings, 'FM_DUPLICATE_MIN_SCORE', 0.4)
+    found = []
+    for pk, other in signatures.items():
+        score = float((other == sig).mean()) if other is not None else 0.0
+        if score >= min_score:
+            found.append((pk, score))
+    found.sort(key=lambda item: -item[1])
+    return found[:limit]
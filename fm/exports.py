@@ -0,0 +1,209 @@
+import csv
+from datetime import datetime, time
+from itertools import islice
+
+from django import forms
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.http import Http404, HttpResponseBadRequest, StreamingHttpResponse
+
+from fm import viewed
+from fm.bitmap import split
+from fm.models import User, Post, Comment, ViewedChunk
+
+EXPORT_CHUNK_SIZE = 2000
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+
+class Echo(object):
+    """
+    Псевдо-буфер для csv.writer: возвращает строку вместо записи,
+    чтобы отдавать ее сразу в StreamingHttpResponse.
+    """
+    def write(self, value):
+        return value
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def count_of(model, field):
+    """
+    Подзапрос с количеством связанных записей. В отличие от нескольких
+    Count(distinct) по JOIN не размножает строки.
+    """
+    rows = model.objects.filter(**{field: OuterRef('pk')}).order_by() \
+        .values(field).annotate(num=Count('pk')).values('num')
+    return Coalesce(Subquery(rows, output_field=IntegerField()), 0)
+
+
+def viewed_count_of():
+    """
+    Подзапрос с числом прочитанных пользователем постов
+    из битовых карт или из таблицы Post.viewed.
+    """
+    if not viewed.bitmap_enabled():
+        return count_of(Post.viewed.through, 'user')
+    rows = ViewedChunk.objects.filter(user=OuterRef('pk')).order_by() \
+        .values('user').annotate(num=Sum('count')).values('num')
+    return Coalesce(Subquery(rows, output_field=IntegerField()), 0)
+
+
+def user_rows(queryset):
+    queryset = queryset.order_by('pk').annotate(
+        posts_count=count_of(Post, 'author'),
+        comments_count=count_of(Comment, 'author'),
+        likes_count=count_of(Post.likes.through, 'user'),
+        follows_count=count_of(Post.follows.through, 'user'),
+        viewed_count=viewed_count_of())
+    fields = ('id', 'email', 'first_name', 'last_name', 'gender', 'created',
+        'last_login', 'is_active', 'posts_count', 'comments_count',
+        'likes_count', 'follows_count', 'viewed_count')
+    for row in queryset.values_list(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield dict(zip(fields, row))
+
+
+def post_rows(queryset):
+    bitmap = viewed.bitmap_enabled()
+    queryset = queryset.order_by('pk').annotate(
+        likes_count=count_of(Post.likes.through, 'post'),
+        follows_count=count_of(Post.follows.through, 'post'),
+        viewed_count=Value(0, IntegerField()) if bitmap else count_of(Post.viewed.through, 'post'),
+        comments_count=count_of(Comment, 'post'))
+    fields = ('id', 'typeContent', 'title', 'created', 'author__email',
+        'city__name', 'best_note', 'likes_count', 'follows_count',
+        'viewed_count', 'comments_count')
+    rows = queryset.values_list(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    views_key, views = None, {}
+    for chunk in chunked(rows, EXPORT_CHUNK_SIZE):
+        # Теги одним запросом на пачку постов
+        tags = {}
+        through = Post.tags.through.objects.filter(post_id__in=[row[0] for row in chunk]) \
+            .order_by().values_list('post_id', 'tag__tag')
+        for post_id, tag in through:
+            tags.setdefault(post_id, []).append(tag)
+        for row in chunk:
+            item = dict(zip(fields, row))
+            item['tags'] = tags.get(row[0], [])
+            if bitmap:
+                # Счетчики просмотров по битовым картам: один проход на диапазон id
+                key = split(row[0])[0]
+                if key != views_key:
+                    views_key, views = key, viewed.post_counts(key)
+                item['viewed_count'] = views.get(row[0], 0)
+            yield item
+
+
+def comment_rows(queryset):
+    fields = ('id', 'post', 'author__email', 'created', 'comment', 'note',
+        'parent', 'reply_to')
+    queryset = queryset.order_by('pk').values_list(*fields)
+    for row in queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield dict(zip(fields, row))
+
+
+# Для каждого типа выгрузки: модель, генератор строк и поле для фильтра по датам
+# (для пользователей - как в DateRangeFilterFM, по дате их постов)
+EXPORTS = {
+    'users': (User, user_rows, 'my_posts__created'),
+    'posts': (Post, post_rows, 'created'),
+    'comments': (Comment, comment_rows, 'created'),
+}
+
+
+def render_csv(rows):
+    writer = csv.writer(Echo())
+    header = None
+    for row in rows:
+        if header is None:
+            header = list(row)
+            yield writer.writerow(header)
+        yield writer.writerow(['|'.join(value) if isinstance(value, list) else value
+            for value in row.values()])
+
+
+def render_ndjson(rows):
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    for row in rows:
+        yield encoder.encode(row) + '\n'
+
+
+RENDERERS = {
+    'csv': render_csv,
+    'ndjson': render_ndjson,
+}
+
+
+def export_response(kind, queryset, fmt):
+    _, rows, _ = EXPORTS[kind]
+    response = StreamingHttpResponse(RENDERERS[fmt](rows(queryset)),
+        content_type=FORMATS[fmt])
+    filename = '%s-%s.%s' % (kind, datetime.now().strftime('%Y%m%d-%H%M'), fmt)
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+def filter_by_dates(queryset, field, params):
+    """
+    Фильтр по диапазону дат с теми же параметрами, что и у DateRangeFilterFM:
+    <field>__gte и <field>__lte.
+    """
+    date_field = forms.DateField(required=False)
+    gte = date_field.clean(params.get(field + '__gte'))
+    lte = date_field.clean(params.get(field + '__lte'))
+    if not gte and not lte:
+        return queryset
+
+    lookup = {}
+    if gte:
+        lookup[field + '__gte'] = datetime.combine(gte, time.min)
+    if lte:
+        lookup[field + '__lte'] = datetime.combine(lte, time.max)
+
+    if '__' in field:
+        # Фильтр по связанной таблице: без JOIN в основном запросе
+        relation = queryset.model._meta.get_field(field.split('__', 1)[0])
+        lookup = {key.split('__', 1)[1]: value for key, value in lookup.items()}
+        related = relation.related_model.objects.filter(**lookup)
+        return queryset.filter(pk__in=related.values(relation.field.name))
+    return queryset.filter(**lookup)
+
+
+@staff_member_required
+def export(request, kind, fmt):
+    """
+    Потоковая выгрузка пользователей, постов или комментариев в CSV/NDJSON.
+    """
+    if kind not in EXPORTS or fmt not in FORMATS:
+        raise Http404
+
+    model, _, field = EXPORTS[kind]
+    try:
+        queryset = filter_by_dates(model.objects.all(), field, request.GET)
+    except ValidationError as e:
+        return HttpResponseBadRequest('; '.join(e.messages))
+    return export_response(kind, queryset, fmt)
+
+
+def export_action(kind, fmt):
+    """
+    Действие админки для выгрузки выбранных записей.
+    """
+    def action(modeladmin, request, queryset):
+        return export_response(kind, queryset, fmt)
+    action.short_description = 'Выгрузить в %s' % fmt.upper()
+    action.__name__ = 'export_%s' % fmt
+    return action
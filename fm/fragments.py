@@ -0,0 +1,90 @@
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import Count
+
+from fm.cache import cache
+from fm.models import Post
+
+# Поля PostSerializer, зависящие от запрашивающего пользователя;
+# остальные одинаковы для всех и кэшируются фрагментом по id и версии поста
+USER_FIELDS = ('isMy', 'isLike', 'isFollow', 'isBest')
+
+
+def enabled():
+    return getattr(settings, 'FM_POST_FRAGMENTS', True)
+
+
+def fragment_key(request, post):
+    # Адреса картинок абсолютные - фрагменты разных хостов не смешиваются;
+    # время изменения отличает одинаковые id после пересоздания базы
+    host = request.get_host() if request is not None else ''
+    return '%s:%d:%d:%d' % (host, post.pk, post.version, post.modified.timestamp() * 1000)
+
+
+def load(posts, context):
+    """
+    {id поста: общая часть} - из кэша, недостающие строятся одним запросом.
+    Версия поста меняется при правке, лайках, подписках и комментариях
+    (fm.versions), поэтому сброс не нужен: старые ключи просто истекают.
+    """
+    from fm.serializers import PostSerializer
+
+    keys = {fragment_key(context.get('request'), post): post for post in posts}
+    found = cache.get_many('fragments', list(keys))
+    shared = {keys[key].pk: fragment for key, fragment in found.items()}
+
+    missing = {post.pk: key for key, post in keys.items() if key not in found}
+    if missing:
+        queryset = Post.objects.filter(pk__in=list(missing)) \
+            .annotate(countLike=Count('likes', distinct=True),
+                countComnt=Count('post_comments', distinct=True)) \
+            .select_related('author', 'city').prefetch_related('tags')
+        fields = [name for name in PostSerializer.Meta.fields if name not in USER_FIELDS]
+        serializer = PostSerializer(queryset, many=True, fields=fields,
+            context=dict(context, fragments=False))
+        built = {row['id']: dict(row) for row in serializer.data}
+        cache.set_many('fragments', {missing[pk]: row for pk, row in built.items()})
+        shared.update(built)
+    return shared
+
+
+def user_flags(posts, fields, context):
+    """
+    {id поста: флаги пользователя} - по одному запросу IN к лайкам и подпискам.
+    """
+    request = context.get('request')
+    user_id = request.user.pk if request is not None else None
+    post_ids = [post.pk for post in posts]
+    liked = followed = set()
+    if user_id is not None and 'isLike' in fields:
+        liked = set(Post.likes.through.objects.filter(user_id=user_id, post_id__in=post_ids)
+            .values_list('post_id', flat=True))
+    if user_id is not None and 'isFollow' in fields:
+        followed = set(Post.follows.through.objects.filter(user_id=user_id, post_id__in=post_ids)
+            .values_list('post_id', flat=True))
+    best_note = context.get('best_note')
+
+    return {post.pk: {
+        'isMy': user_id is not None and post.author_id == user_id,
+        'isLike': post.pk in liked,
+        'isFollow': post.pk in followed,
+        'isBest': best_note is not None and best_note.pk == post.pk,
+    } for post in posts}
+
+
+def render(posts, serializer):
+    """
+    Строки списка постов в порядке полей сериализатора (с учетом ?fields=).
+    """
+    fields = list(serializer.fields)
+    shared = load(posts, serializer.context)
+    flags = user_flags(posts, fields, serializer.context)
+    rows = []
+    for post in posts:
+        if post.pk not in shared:
+            # Пост удален между запросом списка и построением фрагментов
+            continue
+        row = dict(shared[post.pk], **flags[post.pk])
+        rows.append(OrderedDict((name, row[name]) for name in fields if name in row))
+    return rows
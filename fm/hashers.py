@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth.hashers import Argon2PasswordHasher, PBKDF2PasswordHasher
+from django.http import JsonResponse
+from rest_framework.exceptions import APIException
+
+# Хэширование паролей в ограниченном пуле потоков процесса: PBKDF2 (OpenSSL)
+# и Argon2 (argon2-cffi) отпускают GIL, поэтому потоки дают настоящий
+# параллелизм, а одновременно считается не больше FM_HASH_WORKERS хэшей.
+# Поток запроса при этом ждет результата и занят все время хэширования:
+# пул ограничивает нагрузку на процессор, но не освобождает рабочие потоки
+# сервера. Их защищает только предел очереди: при всплеске входов сверх
+# FM_HASH_QUEUE ожидающих хэшей запрос сразу получает 503, а не ждет.
+
+
+class Overloaded(APIException):
+    status_code = 503
+    default_detail = 'Сервер перегружен, повторите запрос позже.'
+    default_code = 'overloaded'
+
+    def __init__(self):
+        super(Overloaded, self).__init__()
+        self.wait = 1
+
+
+class HashPool(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.executor = None
+        self.stats = {'submitted': 0, 'completed': 0, 'rejected': 0,
+            'depth': 0, 'max_depth': 0, 'wait_time': 0.0, 'hash_time': 0.0}
+
+    def run(self, func, *args):
+        """
+        Выполняет func в пуле и ждет результата в потоке вызывающего.
+        Если в очереди уже FM_HASH_QUEUE хэшей, сразу бросает Overloaded.
+        """
+        # verify() базовых хэшеров вызывает encode(): внутри пула - без очереди
+        if getattr(self.local, 'inside', False):
+            return func(*args)
+
+        with self.lock:
+            if self.executor is None:
+                workers = getattr(settings, 'FM_HASH_WORKERS', None) or os.cpu_count() or 1
+                self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hasher')
+            if self.stats['depth'] >= getattr(settings, 'FM_HASH_QUEUE', 64):
+                self.stats['rejected'] += 1
+                raise Overloaded()
+            self.stats['submitted'] += 1
+            self.stats['depth'] += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'], self.stats['depth'])
+
+        queued = time.perf_counter()
+
+        def task():
+            started = time.perf_counter()
+            self.local.inside = True
+            try:
+                return func(*args)
+            finally:
+                self.local.inside = False
+                with self.lock:
+                    self.stats['depth'] -= 1
+                    self.stats['completed'] += 1
+                    self.stats['wait_time'] += started - queued
+                    self.stats['hash_time'] += time.perf_counter() - started
+
+        return self.executor.submit(task).result()
+
+
+pool = HashPool()
+
+
+class PooledPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    PBKDF2 в пуле; число итераций - FM_PBKDF2_ITERATIONS, пароли
+    с другим числом пересчитываются при входе.
+    """
+    @property
+    def iterations(self):
+        return getattr(settings, 'FM_PBKDF2_ITERATIONS', PBKDF2PasswordHasher.iterations)
+
+    def encode(self, password, salt, iterations=None):
+        return pool.run(super(PooledPBKDF2PasswordHasher, self).encode, password, salt, iterations)
+
+    def verify(self, password, encoded):
+        return pool.run(super(PooledPBKDF2PasswordHasher, self).verify, password, encoded)
+
+
+class PooledArgon2PasswordHasher(Argon2PasswordHasher):
+    """
+    Argon2 в пуле (нужен пакет argon2-cffi); параметры - FM_ARGON2_TIME_COST,
+    FM_ARGON2_MEMORY_COST (КБ) и FM_ARGON2_PARALLELISM, пароли с другими
+    параметрами или другим алгоритмом пересчитываются при входе.
+    """
+    @property
+    def time_cost(self):
+        return getattr(settings, 'FM_ARGON2_TIME_COST', Argon2PasswordHasher.time_cost)
+
+    @property
+    def memory_cost(self):
+        return getattr(settings, 'FM_ARGON2_MEMORY_COST', Argon2PasswordHasher.memory_cost)
+
+    @property
+    def parallelism(self):
+        return getattr(settings, 'FM_ARGON2_PARALLELISM', Argon2PasswordHasher.parallelism)
+
+    def encode(self, password, salt):
+        return pool.run(super(PooledArgon2PasswordHasher, self).encode, password, salt)
+
+    def verify(self, password, encoded):
+        return pool.run(super(PooledArgon2PasswordHasher, self).verify, password, encoded)
+
+
+@staff_member_required
+def hasher_stats(request):
+    with pool.lock:
+        stats = dict(pool.stats)
+    completed = stats['completed'] or 1
+    stats['avg_wait_ms'] = stats['wait_time'] / completed * 1000
+    stats['avg_hash_ms'] = stats['hash_time'] / completed * 1000
+    return JsonResponse(stats)
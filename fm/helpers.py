@@ -1,23 +1,37 @@
 import os, uuid
-import sys
+import hashlib
 from PIL import Image
 from io import BytesIO
-from django.conf import settings
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.apps import apps
+from django.core.files.base import ContentFile
+from django.db.models import Case, DateTimeField, F, IntegerField, Value, When
+from django.utils import timezone
+
+# Параметры обработки изображений: ширина и соотношение сторон
+PROFILE_PHOTO_SIZE = (400, 1)
+POST_IMAGE_SIZE = (800, 16/9)
+JPEG_QUALITY = 80
 
 def get_upload_path(instance, filename, path):
     ext = os.path.splitext(filename)[1]
     filename = str(uuid.uuid4()) + ext
     return os.path.join(path, filename)
 
-def save_resized_image(imagefile, width, ratio):
-    # Пересохраняем только если такого файла еще нет
-    if os.path.isfile(settings.MEDIA_ROOT + "/" + imagefile.name):
-        return imagefile
-
-    img = Image.open(imagefile)
-    output = BytesIO()
+def file_digest(content):
+    """
+    SHA-256 содержимого файла (django File или FieldFile).
+    """
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
 
+def resize_image(img, width, ratio):
+    """
+    Обрезает изображение по центру до соотношения сторон ratio
+    и уменьшает до ширины width (не увеличивая).
+    """
     crop = [
         min(round(img.size[1] * ratio), img.size[0]),
         min(round(img.size[0] / ratio), img.size[1])
@@ -34,9 +48,50 @@ def save_resized_image(imagefile, width, ratio):
         round(crop[1] * factor)
     )
 
-    img = img.resize(size=size, resample=Image.BILINEAR, box=box)
-    img.save(output, format='JPEG', quality=80)
-    imagefile = InMemoryUploadedFile(output, 'ImageField',
-        "%s.jpg" % imagefile.name.split('.')[0], 'image/jpeg',
-        sys.getsizeof(output), None)
-    return imagefile
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    return img.resize(size=size, resample=Image.BILINEAR, box=box)
+
+def render_image(source, width, ratio, quality=JPEG_QUALITY):
+    """
+    Возвращает байты JPEG с обработанным изображением из файла source.
+    """
+    img = resize_image(Image.open(source), width, ratio)
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+def save_resized_image(imagefile, width, ratio):
+    # Уже сохраненный файл (в том числе файл по умолчанию) не пересохраняем
+    if getattr(imagefile, '_committed', True):
+        return imagefile
+
+    # Такое же изображение с такими же параметрами уже обработано:
+    # используем готовый файл без декодирования. Если ссылок на него нет,
+    # срок хранения для media_gc отсчитывается заново; файл, строку которого
+    # media_gc уже удалил, не используем
+    MediaFile = apps.get_model('fm', 'MediaFile')
+    source = '%s:%d:%.4f' % (file_digest(imagefile), width, ratio)
+    reused = MediaFile.objects.filter(source=source)
+    released = Case(When(refs__lte=0, then=Value(timezone.now())), default=F('released'),
+        output_field=DateTimeField())
+    if reused.update(released=released):
+        name = reused.values_list('name', flat=True).first()
+        if name:
+            return name
+
+    output = render_image(imagefile, width, ratio)
+
+    name = imagefile.field.generate_filename(imagefile.instance,
+        "%s.jpg" % os.path.splitext(imagefile.name)[0])
+    name = imagefile.storage.save(name, ContentFile(output))
+    MediaFile.objects.filter(name=name).update(source=source)
+    return name
+
+def filter_ordered(queryset, ids):
+    """
+    Объекты с указанными id в порядке списка ids.
+    """
+    order = Case(*[When(pk=pk, then=Value(position)) for position, pk in enumerate(ids)],
+        output_field=IntegerField())
+    return queryset.filter(pk__in=ids).order_by(order)
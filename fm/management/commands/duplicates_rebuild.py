@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+from django.core.management.base import BaseCommand
+
+from fm import duplicates
+from fm.models import Post, MinHashBand, MinHashSignature
+
+class Command(BaseCommand):
+    help = 'Rebuilds the MinHash LSH index used to find duplicate questions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', dest='chunk_size', nargs='?', type=int, default=1000,
+            help='Questions per transaction')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        post_ids = list(Post.objects.filter(typeContent=Post.QUESTION)
+            .order_by('pk').values_list('pk', flat=True))
+
+        # Ключи и подписи постов, переставших быть вопросами, удаляются целиком
+        MinHashBand.objects.exclude(post__typeContent=Post.QUESTION).delete()
+        MinHashSignature.objects.exclude(post__typeContent=Post.QUESTION).delete()
+        for start in range(0, len(post_ids), chunk_size):
+            chunk = post_ids[start:start + chunk_size]
+            duplicates.index_many(list(Post.objects.filter(pk__in=chunk)
+                .only('pk', 'typeContent', 'title', 'description')))
+            print('Questions: %d/%d' % (min(start + chunk_size, len(post_ids)), len(post_ids)))
+
+        print('Bands: %d, signatures: %d' % (MinHashBand.objects.count(), MinHashSignature.objects.count()))
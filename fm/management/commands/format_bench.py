@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import gzip
+import json
+import time
+
+import msgpack
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from fm.models import User
+from fm.renderers import MessagePackRenderer
+from fm.views import PostList
+
+class Command(BaseCommand):
+    help = 'Compares JSON and MessagePack payload size and encode/decode time for feed pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', dest='page_size', nargs='?', type=int, default=100)
+        parser.add_argument('-n', dest='iterations', nargs='?', type=int, default=200)
+        parser.add_argument('-u', dest='user', nargs='?', default=None,
+            help='Email of the user the page is rendered for (default: first user)')
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(email=options['user']) if options['user'] else User.objects.order_by('pk')
+        user = users.first()
+        if user is None:
+            raise CommandError('No user to render the feed for')
+
+        # Страница ленты в том виде, в каком ее отдает PostList (без отметки прочитанного)
+        request = Request(APIRequestFactory().get('/api-auth/posts/'))
+        request.user = user
+        view = PostList(request=request, kwargs={}, format_kwarg=None)
+        posts = view.get_queryset()[:options['page_size']]
+        data = {'count': len(posts), 'next': None, 'previous': None,
+            'results': view.get_serializer(posts, many=True).data}
+        context = {'request': request}
+
+        formats = (
+            ('json', JSONRenderer(), lambda body: json.loads(body.decode('utf-8'))),
+            ('msgpack', MessagePackRenderer(), lambda body: msgpack.unpackb(body, raw=False)),
+        )
+        print('Posts on page: %d, iterations: %d' % (len(data['results']), options['iterations']))
+        print('%-8s %10s %10s %12s %12s' % ('format', 'bytes', 'gzip', 'encode, ms', 'decode, ms'))
+        for name, renderer, decode in formats:
+            started = time.perf_counter()
+            for _ in range(options['iterations']):
+                body = renderer.render(data, renderer.media_type, context)
+            encode = (time.perf_counter() - started) / options['iterations'] * 1000
+
+            started = time.perf_counter()
+            for _ in range(options['iterations']):
+                decode(body)
+            decoded = (time.perf_counter() - started) / options['iterations'] * 1000
+            print('%-8s %10d %10d %12.3f %12.3f' % (name, len(body), len(gzip.compress(body)), encode, decoded))
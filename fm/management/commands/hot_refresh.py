@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from fm.models import Post
+from fm.ranking import refresh_hot
+
+class Command(BaseCommand):
+    help = 'Recalculates "hot" rating of posts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-d', dest='days', nargs='?', type=int, default=0,
+            help='Only posts created during the last N days (0 - all posts)')
+        parser.add_argument('-s', dest='chunk_size', nargs='?', type=int, default=500)
+
+    def handle(self, *args, **options):
+        posts = Post.objects.order_by('pk')
+        if options['days']:
+            posts = posts.filter(created__gte=timezone.now() - timedelta(days=options['days']))
+
+        ids = posts.values_list('pk', flat=True)
+        chunk_size = options['chunk_size']
+        last_pk = 0
+        total = updated = 0
+        while True:
+            chunk = list(ids.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            updated += refresh_hot(chunk)
+            total += len(chunk)
+            last_pk = chunk[-1]
+
+        print('Posts checked: %d, updated: %d' % (total, updated))
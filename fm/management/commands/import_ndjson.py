@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from fm import duplicates, textindex
+from fm.cache import cache
+from fm.models import User, Post, Comment, Tag, City, MediaFile
+from fm.signals import MEDIA_FIELDS
+
+# Поля, которые можно передать для каждого типа записей;
+# внешние ключи передаются как id (author -> author_id)
+FIELDS = {
+    'user': ('id', 'email', 'password', 'username', 'first_name', 'last_name',
+        'phone', 'birthday', 'gender', 'created', 'profile_photo',
+        'enable_notif', 'android_regid', 'is_active'),
+    'post': ('id', 'author_id', 'created', 'typeContent', 'title',
+        'description', 'image', 'image_width', 'image_height', 'best_note_id'),
+    'comment': ('id', 'author_id', 'post_id', 'created', 'comment', 'note_id',
+        'parent_id', 'reply_to_id'),
+}
+FOREIGN_KEYS = ('author', 'post', 'note', 'parent', 'reply_to', 'best_note')
+
+MODELS = (
+    ('user', User),
+    ('post', Post),
+    ('comment', Comment),
+)
+
+
+@contextmanager
+def keep_created(*models):
+    """
+    Отключает auto_now_add у поля created, чтобы сохранить исходные даты.
+    """
+    fields = [model._meta.get_field('created') for model in models]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+class Command(BaseCommand):
+    help = 'Imports users, posts, tags and comments from NDJSON file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('-s', dest='chunk_size', nargs='?', type=int, default=5000)
+        parser.add_argument('-c', dest='checkpoint', nargs='?', default=None,
+            help='Checkpoint file (default: <path>.checkpoint)')
+        parser.add_argument('--restart', dest='restart', action='store_true',
+            help='Ignore existing checkpoint')
+        parser.add_argument('--no-refresh', dest='refresh', action='store_false',
+            help='Do not recalculate post ratings, subscribers and unread counters after import')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.isfile(path):
+            raise CommandError('No such file: %s' % path)
+
+        self.checkpoint = options['checkpoint'] or path + '.checkpoint'
+        state = {'offset': 0, 'rows': 0}
+        if not options['restart'] and os.path.isfile(self.checkpoint):
+            with open(self.checkpoint) as f:
+                state = json.load(f)
+            print('Resuming from row %d' % state['rows'])
+
+        self.tags = {}
+        self.cities = {}
+
+        started = time.time()
+        imported = 0
+        with open(path, 'rb') as f, keep_created(User, Post, Comment):
+            f.seek(state['offset'])
+            chunk = []
+            while True:
+                line = f.readline()
+                if line.strip():
+                    chunk.append(json.loads(line.decode('utf-8')))
+                if chunk and (len(chunk) >= options['chunk_size'] or not line):
+                    with transaction.atomic():
+                        self.import_chunk(chunk)
+                    imported += len(chunk)
+                    state = {'offset': f.tell(), 'rows': state['rows'] + len(chunk)}
+                    self.save_checkpoint(state)
+                    chunk = []
+
+                    elapsed = time.time() - started
+                    print('Imported %d rows, %.0f rows/s' % (imported, imported / max(elapsed, 1e-6)))
+                if not line:
+                    break
+
+        self.reset_sequences()
+        if options['refresh']:
+            call_command('hot_refresh')
+            call_command('subscribers_rebuild')
+            call_command('unread_reconcile')
+        # Списки в кэше и индексы автодополнения всех процессов
+        cache.invalidate('posts', 'comments', 'tags', 'cities', 'users', 'prefix')
+
+        elapsed = time.time() - started
+        print('Done: %d rows in %.1fs (%.0f rows/s)' % (imported, elapsed, imported / max(elapsed, 1e-6)))
+
+    def save_checkpoint(self, state):
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.checkpoint)
+
+    def import_chunk(self, chunk):
+        records = {}
+        for record in chunk:
+            records.setdefault(record.get('type'), []).append(record)
+
+        self.resolve(Tag, 'tag', self.tags,
+            [r['tag'] for r in records.get('tag', [])] +
+            [tag for r in records.get('post', []) for tag in r.get('tags', [])])
+        self.resolve(City, 'name', self.cities,
+            [r['name'] for r in records.get('city', [])] +
+            [r['city'] for r in records.get('post', []) if r.get('city')])
+
+        for kind, model in MODELS:
+            rows = records.get(kind, [])
+            if not rows:
+                continue
+
+            # Уже загруженные записи (например, если упали после коммита
+            # но до записи контрольной точки) пропускаем
+            existing = set(model.objects.filter(pk__in=[r['id'] for r in rows])
+                .values_list('pk', flat=True))
+            rows = [r for r in rows if r['id'] not in existing]
+            objects = [self.build(kind, model, r) for r in rows]
+            model.objects.bulk_create(objects)
+            self.count_media(model, objects)
+
+            if kind == 'post':
+                Post.tags.through.objects.bulk_create([
+                    Post.tags.through(post_id=r['id'], tag_id=self.tags[tag])
+                    for r in rows for tag in set(r.get('tags', []))])
+                self.index_posts(objects)
+
+    def build(self, kind, model, record):
+        values = {}
+        for key, value in record.items():
+            if key in FOREIGN_KEYS:
+                key += '_id'
+            if key in FIELDS[kind]:
+                values[key] = value
+
+        values['created'] = parse_datetime(values['created']) \
+            if values.get('created') else timezone.now()
+        if kind == 'user':
+            values['email'] = User.objects.normalize_email(values['email'])
+            values.setdefault('password', make_password(None))
+        if kind == 'post' and record.get('city'):
+            values['city_id'] = self.cities[record['city']]
+        return model(**values)
+
+    def count_media(self, model, objects):
+        """
+        Ссылки на файлы в MediaFile, как в signals.media_count: bulk_create
+        сигналов не посылает, а media_gc удаляет файлы без ссылок.
+        """
+        field = MEDIA_FIELDS.get(model)
+        if field is None:
+            return
+        names = Counter(getattr(obj, field).name for obj in objects if getattr(obj, field))
+        for name, num in names.items():
+            MediaFile.objects.add_refs(name, num)
+
+    def index_posts(self, posts):
+        # Индекс похожих постов (если он уже построен) и ключи поиска дубликатов
+        for post in posts:
+            textindex.update(post)
+        duplicates.index_many(posts)
+
+    def resolve(self, model, field, cache, names):
+        """
+        Находит или создает теги/города пачкой, запоминая их id.
+        """
+        names = set(names) - set(cache)
+        if not names:
+            return
+
+        cache.update(model.objects.filter(**{field + '__in': names}).values_list(field, 'pk'))
+        missing = names - set(cache)
+        if missing:
+            model.objects.bulk_create([model(**{field: name}) for name in missing])
+            cache.update(model.objects.filter(**{field + '__in': missing}).values_list(field, 'pk'))
+
+    def reset_sequences(self):
+        # Записи вставлены с явными id; выравниваем последовательности
+        statements = connection.ops.sequence_reset_sql(no_style(), [User, Post, Comment, Tag, City])
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
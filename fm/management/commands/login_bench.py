@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from fm import hashers
+
+class Command(BaseCommand):
+    help = 'Measures password checks (logins) per second per core for password hashers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('hashers', nargs='*', default=[
+            'django.contrib.auth.hashers.PBKDF2PasswordHasher', settings.PASSWORD_HASHERS[0]],
+            help='Hasher classes to compare (default: Django PBKDF2 and the preferred hasher)')
+        parser.add_argument('-c', dest='concurrency', nargs='?', type=int, default=16,
+            help='Simultaneous logins (request threads)')
+        parser.add_argument('-t', dest='duration', nargs='?', type=float, default=5)
+
+    def handle(self, *args, **options):
+        cores = os.cpu_count() or 1
+        print('Cores: %d, concurrent logins: %d, %.0f s per hasher' % (
+            cores, options['concurrency'], options['duration']))
+        print('%-55s %10s %10s %10s %10s' % ('hasher', 'logins/s', 'per core', 'p95, ms', 'rejected'))
+        for path in options['hashers']:
+            hasher = import_string(path)()
+            encoded = make_password('correct horse', hasher=hasher)
+            latencies, rejected = self.run(encoded, hasher, options)
+            latencies.sort()
+            p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0
+            rate = len(latencies) / options['duration']
+            print('%-55s %10.1f %10.1f %10.1f %10d' % (path, rate, rate / cores, p95, rejected))
+
+    def run(self, encoded, hasher, options):
+        deadline = time.time() + options['duration']
+        latencies, rejected = [], [0]
+        lock = threading.Lock()
+
+        def worker():
+            while time.time() < deadline:
+                started = time.perf_counter()
+                try:
+                    ok = hasher.verify('correct horse', encoded)
+                except hashers.Overloaded:
+                    with lock:
+                        rejected[0] += 1
+                    continue
+                with lock:
+                    if ok:
+                        latencies.append(time.perf_counter() - started)
+
+        threads = [threading.Thread(target=worker) for _ in range(options['concurrency'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies, rejected[0]
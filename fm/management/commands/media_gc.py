@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.utils import timezone
+
+from fm.models import MediaFile, User, Post
+
+class Command(BaseCommand):
+    help = 'Deletes media files which are not referenced anymore'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-g', dest='grace', nargs='?', type=int, default=24,
+            help='Keep files which lost their last reference less than N hours ago')
+        parser.add_argument('-s', dest='chunk_size', nargs='?', type=int, default=500)
+        parser.add_argument('--recount', dest='recount', action='store_true',
+            help='Recalculate reference counters before collecting')
+        parser.add_argument('--dry-run', dest='dry_run', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            self.recount()
+
+        # Срок хранения отсчитывается от потери последней ссылки; повторное
+        # использование файла (save_resized_image) отсчитывает его заново
+        cutoff = timezone.now() - timedelta(hours=options['grace'])
+        orphans = MediaFile.objects.filter(refs__lte=0, released__lt=cutoff).order_by('pk')
+        deleted = 0
+        last_pk = 0
+        while True:
+            chunk = list(orphans.filter(pk__gt=last_pk).values_list('pk', 'name')[:options['chunk_size']])
+            if not chunk:
+                break
+            last_pk = chunk[-1][0]
+            for pk, name in chunk:
+                if options['dry_run']:
+                    print(name)
+                    deleted += 1
+                    continue
+                # Строка удаляется, только если файл все еще не нужен; файл -
+                # только если его не создали заново после удаления строки
+                if not orphans.filter(pk=pk).delete()[0]:
+                    continue
+                if not MediaFile.objects.filter(name=name).exists():
+                    default_storage.delete(name)
+                deleted += 1
+
+        print('Unreferenced files %s: %d' % ('found' if options['dry_run'] else 'deleted', deleted))
+
+    def recount(self):
+        refs = {}
+        for model, field in ((User, 'profile_photo'), (Post, 'image')):
+            rows = model.objects.exclude(**{field: ''}).exclude(**{field + '__isnull': True}) \
+                .order_by().values_list(field).annotate(num=Count('pk'))
+            for name, num in rows:
+                refs[name] = refs.get(name, 0) + num
+
+        for media in MediaFile.objects.iterator():
+            num = refs.get(media.name, 0)
+            if media.refs != num:
+                released = None if num > 0 else media.released or timezone.now()
+                MediaFile.objects.filter(pk=media.pk).update(refs=num, released=released)
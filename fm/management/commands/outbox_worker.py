@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from fm import outbox
+
+class Command(BaseCommand):
+    help = 'Sends queued emails reusing one SMTP connection, retrying failed ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', dest='batch_size', nargs='?', type=int, default=100)
+        parser.add_argument('-i', dest='interval', nargs='?', type=float, default=2.0,
+            help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', dest='once', action='store_true',
+            help='Drain the queue and exit')
+
+    def handle(self, *args, **options):
+        connection = get_connection(fail_silently=False)
+        total = 0
+        try:
+            while True:
+                close_old_connections()
+                sent, failed = outbox.deliver(connection, options['batch_size'])
+                total += sent
+                if sent or failed:
+                    print('Sent: %d, failed: %d' % (sent, failed))
+                if sent + failed < options['batch_size']:
+                    # Очередь разобрана: не держим SMTP-соединение, пока ждем
+                    connection.close()
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            connection.close()
+        print('Total sent: %d' % total)
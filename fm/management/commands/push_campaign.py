@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import threading
+import time
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import timedelta
+from http.client import HTTPSConnection
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+
+from fm.models import User, Post
+from fm.signals import FCM_URL, FCM_KEY, FCM_BATCH
+from fm.subscribers import NOTIFIABLE
+
+
+class RateLimiter(object):
+    """
+    Не больше rate запросов в секунду на все потоки.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class FCMClient(object):
+    """
+    Отправка в FCM через постоянные HTTPS-соединения, по одному на поток.
+    """
+    def __init__(self):
+        url = urlsplit(FCM_URL)
+        self.host, self.path = url.netloc, url.path
+        self.local = threading.local()
+
+    def send(self, payload):
+        body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Authorization": "key=%s" % FCM_KEY}
+        for attempt in (1, 2):
+            connection = getattr(self.local, 'connection', None)
+            if connection is None:
+                connection = self.local.connection = HTTPSConnection(self.host, timeout=30)
+            try:
+                connection.request('POST', self.path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except OSError:
+                # Сервер закрыл соединение: повторяем один раз через новое
+                connection.close()
+                self.local.connection = None
+                if attempt == 2:
+                    raise
+                continue
+            if response.status != 200:
+                raise CommandError('FCM returned %d: %s' % (response.status, data[:200]))
+            return json.loads(data.decode("utf-8"))
+
+
+class Command(BaseCommand):
+    help = 'Sends PUSH-message campaign to a segment of users (city, followed tags, activity)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', help='Campaign name, used for the checkpoint file')
+        parser.add_argument('-t', dest='title', nargs='?', default='Мега пост')
+        parser.add_argument('-b', dest='body', nargs='?', default='Сообщение')
+        parser.add_argument('-p', dest='post_id', nargs='?', type=int, default=0)
+        parser.add_argument('--city', dest='city', nargs='*', default=[],
+            help='Users who posted or follow posts in these cities')
+        parser.add_argument('--tag', dest='tag', nargs='*', default=[],
+            help='Users who follow posts with these tags')
+        parser.add_argument('--active', dest='active', nargs='?', type=int, default=None,
+            help='Users who logged in within this number of days')
+        parser.add_argument('-s', dest='chunk_size', nargs='?', type=int, default=FCM_BATCH)
+        parser.add_argument('-w', dest='workers', nargs='?', type=int, default=4)
+        parser.add_argument('-r', dest='rate', nargs='?', type=float, default=10,
+            help='Max FCM requests per second (0 - unlimited)')
+        parser.add_argument('-c', dest='checkpoint', nargs='?', default=None,
+            help='Checkpoint file (default: push_campaign_<name>.checkpoint)')
+        parser.add_argument('--restart', dest='restart', action='store_true',
+            help='Ignore existing checkpoint')
+        parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+            help='Only count recipients')
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] > FCM_BATCH:
+            raise CommandError('Chunk size can not exceed %d' % FCM_BATCH)
+
+        recipients = self.get_recipients(options)
+        if options['dry_run']:
+            print('Recipients: %d' % recipients.count())
+            return
+
+        self.checkpoint = options['checkpoint'] or 'push_campaign_%s.checkpoint' % options['name']
+        state = {'last': 0, 'done': [], 'sent': 0, 'failed': 0, 'failed_ranges': []}
+        if not options['restart'] and os.path.isfile(self.checkpoint):
+            with open(self.checkpoint) as f:
+                state.update(json.load(f))
+            print('Resuming after user %d, retrying %d failed chunks' % (
+                state['last'], len(state['failed_ranges'])))
+
+        data = {"title": options['title'], "body": options['body'], "post": options['post_id'], "comment": 0}
+        self.client = FCMClient()
+        self.limiter = RateLimiter(options['rate'])
+        started = time.time()
+
+        # Пользователи идут по возрастанию id через серверный курсор; пачки
+        # отправляются параллельно, но контрольная точка сдвигается только
+        # за непрерывно отправленный префикс, а завершенные вне очереди пачки
+        # запоминаются в done и при возобновлении пропускаются. Пачки, на которые
+        # FCM или сеть ответили ошибкой, хранятся в failed_ranges и отправляются
+        # повторно в начале следующего запуска
+        rows = recipients.filter(pk__gt=state['last']).order_by('pk') \
+            .values_list('pk', 'android_regid').iterator(chunk_size=options['chunk_size'])
+        pending = {}
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            try:
+                for chunk, retry in chain(self.retry_chunks(recipients, state['failed_ranges']),
+                        ((chunk, None) for chunk in self.chunks(rows, options['chunk_size'], state['done']))):
+                    if len(pending) >= options['workers'] * 2:
+                        self.collect(pending, state, wait(pending, return_when=FIRST_COMPLETED).done)
+                    future = executor.submit(self.send, data, [regid for _, regid in chunk])
+                    pending[future] = (chunk[0][0], chunk[-1][0], len(chunk), retry)
+            finally:
+                # И при прерывании (Ctrl+C, ошибка БД) дожидаемся уже отправляемых
+                # пачек и записываем их в контрольную точку, иначе при
+                # возобновлении они ушли бы повторно
+                while pending:
+                    self.collect(pending, state, wait(pending, return_when=FIRST_COMPLETED).done)
+
+        if state['failed_ranges']:
+            print('Failed chunks: %d, run again to retry them' % len(state['failed_ranges']))
+        elif os.path.isfile(self.checkpoint):
+            os.remove(self.checkpoint)
+        elapsed = max(time.time() - started, 1e-6)
+        print('Sent: %d, failed: %d, %.1f messages/s' % (state['sent'], state['failed'], state['sent'] / elapsed))
+
+    def get_recipients(self, options):
+        users = User.objects.filter(NOTIFIABLE)
+        if options['city']:
+            posts = Post.objects.filter(city__name__in=options['city'])
+            users = users.filter(Q(pk__in=posts.values('author_id')) |
+                Q(pk__in=Post.follows.through.objects.filter(post__in=posts).values('user_id')))
+        if options['tag']:
+            users = users.filter(pk__in=Post.follows.through.objects
+                .filter(post__tags__tag__in=options['tag']).values('user_id'))
+        if options['active'] is not None:
+            users = users.filter(last_login__gte=timezone.now() - timedelta(days=options['active']))
+        return users
+
+    def chunks(self, rows, size, done):
+        chunk = []
+        for pk, regid in rows:
+            if any(first <= pk <= last for first, last in done):
+                continue
+            chunk.append((pk, regid))
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def send(self, data, regids):
+        self.limiter.wait()
+        if settings.DEBUG:
+            print('PUSH-message payload:', {"registration_ids": regids[:3], "data": data},
+                '(%d recipients)' % len(regids))
+            return len(regids), 0
+        result = self.client.send({"registration_ids": regids, "data": data})
+        return result.get('success', 0), result.get('failure', 0)
+
+    def retry_chunks(self, recipients, failed_ranges):
+        """
+        Пачки из диапазонов, не отправленных в прошлый раз, вместе с записью
+        диапазона в failed_ranges: она удаляется после успешной отправки.
+        """
+        for failed in list(failed_ranges):
+            chunk = list(recipients.filter(pk__range=failed[:2]).order_by('pk')
+                .values_list('pk', 'android_regid'))
+            if chunk:
+                yield chunk, failed
+            else:
+                failed_ranges.remove(failed)
+
+    def collect(self, pending, state, finished):
+        for future in finished:
+            first, last, num, retry = pending.pop(future)
+            try:
+                sent, failed = future.result()
+            except Exception as e:
+                # Ошибка FCM или сети: пачка запоминается для повторной отправки,
+                # остальные продолжают отправляться и сохраняться
+                print('Users %d-%d failed: %s' % (first, last, e))
+                if retry is None:
+                    state['failed'] += num
+                    state['failed_ranges'].append([first, last, num])
+                    state['done'].append([first, last])
+                continue
+            if retry is not None:
+                state['failed'] -= retry[2]
+                state['failed_ranges'].remove(retry)
+            else:
+                state['done'].append([first, last])
+            state['sent'] += sent
+            state['failed'] += failed
+
+        # Сдвигаем контрольную точку за все пачки, перед которыми нет незавершенных
+        in_flight = min((first for first, _, _, retry in pending.values() if retry is None), default=None)
+        done = []
+        for first, last in sorted(state['done']):
+            if in_flight is None or last < in_flight:
+                state['last'] = max(state['last'], last)
+            else:
+                done.append([first, last])
+        state['done'] = done
+        self.save_checkpoint(state)
+
+    def save_checkpoint(self, state):
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.checkpoint)
@@ -3,7 +3,7 @@
 from django.core.management.base import BaseCommand, CommandError
 
 from fm.models import User
-from fm.signals import fcm_send
+from fm.signals import fcm_send, FCM_BATCH
 
 class Command(BaseCommand):
     help = 'Sends PUSH-message to user'
@@ -22,9 +22,11 @@ class Command(BaseCommand):
             raise CommandError('No valid user(s) defined: %s' % options['user'])
 
         data = {"title": options['title'], "body": options['body'], "post": options['post_id'], "comment": options['comment_id']}
-        payload = {"registration_ids": list(ids), "data": data}
+        ids = list(ids)
+        for start in range(0, len(ids), FCM_BATCH):
+            payload = {"registration_ids": ids[start:start + FCM_BATCH], "data": data}
 
-        print('PUSH messaege payload:', payload)
+            print('PUSH messaege payload:', payload)
 
-        ret = fcm_send(payload)
-        print('FCM returned:', ret)
+            ret = fcm_send(payload)
+            print('FCM returned:', ret)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import os
+import time
+
+import numpy as np
+from scipy import sparse
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from fm import recommend, viewed
+from fm.bitmap import CHUNK_BITS, Container
+from fm.models import Post, PostNeighbors, ViewedChunk
+
+# Вес взаимодействия пользователя с постом; веса складываются
+LIKE = 3
+FOLLOW = 2
+VIEW = 1
+
+
+class Command(BaseCommand):
+    help = 'Builds item-item post neighbors from likes, follows and views (incremental)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-k', dest='top_k', nargs='?', type=int,
+            default=getattr(settings, 'FM_RECOMMEND_K', 30))
+        parser.add_argument('-d', dest='state_dir', nargs='?',
+            default=getattr(settings, 'FM_RECOMMEND_DIR', '/var/tmp/friendmarket_recommend'),
+            help='Directory with matrices from the previous run')
+        parser.add_argument('-s', dest='chunk_size', nargs='?', type=int, default=1000,
+            help='Posts per transaction')
+        parser.add_argument('--full', dest='full', action='store_true',
+            help='Ignore previous run and recompute everything')
+
+    def handle(self, *args, **options):
+        started = time.time()
+        interactions = self.load_interactions()
+        print('Interactions: %d, users: %d' % (interactions.nnz, interactions.shape[0]))
+
+        # Матрица совместной встречаемости C = R^T R (пост x пост). Повторный
+        # запуск пересчитывает вклад только изменившихся пользователей:
+        # C += R_new[d]^T R_new[d] - R_old[d]^T R_old[d]
+        os.makedirs(options['state_dir'], exist_ok=True)
+        state = {name: os.path.join(options['state_dir'], name + '.npz')
+            for name in ('interactions', 'cooccurrence')}
+        if options['full'] or not all(os.path.isfile(path) for path in state.values()):
+            cooccurrence = (interactions.T @ interactions).tocsr()
+            touched = np.unique(interactions.indices)
+        else:
+            previous = sparse.load_npz(state['interactions']).tocsr()
+            cooccurrence = sparse.load_npz(state['cooccurrence']).tocsr()
+            shape = tuple(max(a, b) for a, b in zip(previous.shape, interactions.shape))
+            previous.resize(shape)
+            interactions.resize(shape)
+            cooccurrence.resize((shape[1], shape[1]))
+
+            dirty = np.unique((interactions != previous).nonzero()[0])
+            old, new = previous[dirty], interactions[dirty]
+            cooccurrence = (cooccurrence - old.T @ old + new.T @ new).tocsr()
+            cooccurrence.eliminate_zeros()
+            touched = np.union1d(old.indices, new.indices)
+            print('Changed users: %d' % len(dirty))
+
+        # Маска существующих постов: удаленные не попадают в соседи
+        existing = np.zeros(cooccurrence.shape[0], dtype=bool)
+        post_ids = np.fromiter(Post.objects.values_list('pk', flat=True).iterator(), dtype=np.int64)
+        existing[post_ids[post_ids < len(existing)]] = True
+        updated = self.save_neighbors(cooccurrence, touched[existing[touched]], existing, options)
+
+        for name, matrix in (('interactions', interactions), ('cooccurrence', cooccurrence)):
+            tmp = state[name] + '.tmp'
+            with open(tmp, 'wb') as f:
+                sparse.save_npz(f, matrix)
+            os.replace(tmp, state[name])
+        print('Posts updated: %d, %.1f s' % (updated, time.time() - started))
+
+    def load_interactions(self):
+        """
+        Разреженная матрица пользователь x пост с суммой весов взаимодействий.
+        """
+        users, posts, weights = [], [], []
+
+        def add(rows, weight):
+            pairs = np.fromiter((value for row in rows for value in row), dtype=np.int64).reshape(-1, 2)
+            users.append(pairs[:, 0])
+            posts.append(pairs[:, 1])
+            weights.append(np.full(len(pairs), weight, dtype=np.int32))
+
+        add(Post.likes.through.objects.values_list('user_id', 'post_id').iterator(), LIKE)
+        add(Post.follows.through.objects.values_list('user_id', 'post_id').iterator(), FOLLOW)
+        if viewed.bitmap_enabled():
+            add(self.viewed_pairs(), VIEW)
+        else:
+            add(Post.viewed.through.objects.values_list('user_id', 'post_id').iterator(), VIEW)
+
+        users, posts, weights = np.concatenate(users), np.concatenate(posts), np.concatenate(weights)
+        if not len(users):
+            return sparse.csr_matrix((0, 0), dtype=np.int32)
+
+        # Просмотры тех, кто видел почти все (лента отмечает прочитанными все
+        # посты выборки), связывают все посты со всеми - такие не учитываем
+        views = np.bincount(users[weights == VIEW], minlength=users.max() + 1)
+        keep = (weights != VIEW) | (views[users] <= getattr(settings, 'FM_RECOMMEND_MAX_VIEWS', 1000))
+
+        shape = (int(users.max()) + 1, int(posts.max()) + 1)
+        return sparse.coo_matrix((weights[keep], (users[keep], posts[keep])), shape=shape).tocsr()
+
+    def viewed_pairs(self):
+        rows = ViewedChunk.objects.values_list('user_id', 'key', 'data').iterator()
+        for user_id, key, data in rows:
+            base = key << CHUNK_BITS
+            for low in Container.from_bytes(data):
+                yield user_id, base + low
+
+    def save_neighbors(self, cooccurrence, touched, existing, options):
+        """
+        Top-K соседей по косинусной мере для затронутых постов:
+        C_ij / sqrt(C_ii * C_jj).
+        """
+        top_k = options['top_k']
+        norms = np.sqrt(cooccurrence.diagonal().astype(np.float64))
+        post_ids = touched.tolist()
+        updated = 0
+
+        for start in range(0, len(post_ids), options['chunk_size']):
+            chunk = post_ids[start:start + options['chunk_size']]
+            rows = []
+            for post_id in chunk:
+                begin, end = cooccurrence.indptr[post_id], cooccurrence.indptr[post_id + 1]
+                ids = cooccurrence.indices[begin:end]
+                scores = cooccurrence.data[begin:end] / (norms[post_id] * norms[ids])
+                mask = (ids != post_id) & existing[ids]
+                ids, scores = ids[mask], scores[mask]
+                if len(ids) > top_k:
+                    best = np.argpartition(-scores, top_k)[:top_k]
+                    ids, scores = ids[best], scores[best]
+                order = np.argsort(-scores, kind='stable')
+                rows.append(PostNeighbors(post_id=post_id, count=len(order),
+                    data=recommend.pack(ids[order].tolist(), scores[order].tolist())))
+            with transaction.atomic():
+                PostNeighbors.objects.filter(post_id__in=chunk).delete()
+                PostNeighbors.objects.bulk_create(rows)
+            updated += len(rows)
+        return updated
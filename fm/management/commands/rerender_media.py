@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from fm.helpers import file_digest, render_image, PROFILE_PHOTO_SIZE, POST_IMAGE_SIZE, JPEG_QUALITY
+from fm.models import User, Post, MediaFile
+
+# Модель, поле и параметры обработки для каждого вида изображений
+TARGETS = (
+    (User, 'profile_photo', PROFILE_PHOTO_SIZE),
+    (Post, 'image', POST_IMAGE_SIZE),
+)
+
+
+def render(path, width, ratio, quality):
+    # Выполняется в отдельном процессе: только чтение и обработка файла
+    with open(path, 'rb') as f:
+        return render_image(f, width, ratio, quality)
+
+
+class Command(BaseCommand):
+    help = 'Re-renders uploaded images with current sizes in parallel, skipping unchanged ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-w', dest='workers', nargs='?', type=int, default=os.cpu_count())
+        parser.add_argument('-q', dest='quality', nargs='?', type=int, default=JPEG_QUALITY)
+        parser.add_argument('-m', dest='manifest', nargs='?', default=None,
+            help='Manifest file (default: MEDIA_ROOT/.renditions.json)')
+        parser.add_argument('--force', dest='force', action='store_true',
+            help='Re-render all images ignoring manifest')
+
+    def handle(self, *args, **options):
+        # Манифест: renditions - "хэш исходника:параметры" -> результат,
+        # sources - результат команды -> исходник, из которого он получен
+        manifest_path = options['manifest'] or os.path.join(settings.MEDIA_ROOT, '.renditions.json')
+        manifest = {}
+        if os.path.isfile(manifest_path) and not options['force']:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        self.renditions = manifest.get('renditions', {})
+        self.sources = manifest.get('sources', {})
+
+        jobs = []
+        relinked = 0
+        for model, field, (width, ratio) in TARGETS:
+            params = [width, ratio, options['quality']]
+            names = model.objects.exclude(**{field: ''}).exclude(**{field + '__isnull': True}) \
+                .exclude(**{field: model._meta.get_field(field).get_default()}) \
+                .order_by().values_list(field, flat=True).distinct()
+            uploaded = self.uploaded_with(list(names), width, ratio) \
+                if options['quality'] == JPEG_QUALITY and not options['force'] else set()
+            for name in names.iterator():
+                if name in uploaded:
+                    # Обработано при загрузке из оригинала с теми же параметрами
+                    continue
+                # Свой результат не перекодируем (потери накапливаются):
+                # обрабатываем исходник, пока он хранится
+                source = self.sources.get(name, name)
+                if not default_storage.exists(source):
+                    continue
+                key = '%s:%d:%.4f:%d' % (self.digest(source), width, ratio, options['quality'])
+                output = self.renditions.get(key)
+                if output == name:
+                    continue
+                if output and default_storage.exists(output):
+                    self.relink(model, field, name, output)
+                    relinked += 1
+                    continue
+                jobs.append((model, field, name, source, key, params))
+
+        print('Images to process: %d, relinked: %d' % (len(jobs), relinked))
+        started = time.time()
+        self.done = self.bytes_before = self.bytes_after = 0
+        batch = options['workers'] * 8
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            # Пачками, чтобы не держать в памяти результаты всех изображений
+            for start in range(0, len(jobs), batch):
+                self.process(executor, jobs[start:start + batch])
+
+        tmp = manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'renditions': self.renditions, 'sources': self.sources}, f)
+        os.replace(tmp, manifest_path)
+
+        elapsed = max(time.time() - started, 1e-6)
+        print('Processed %d images in %.1fs (%.1f images/s, %.1f MB/s)' % (
+            self.done, elapsed, self.done / elapsed, self.bytes_before / elapsed / 2**20))
+        print('Size: %d -> %d bytes, saved %d bytes' % (
+            self.bytes_before, self.bytes_after, self.bytes_before - self.bytes_after))
+
+    def uploaded_with(self, names, width, ratio):
+        """
+        Файлы, полученные при загрузке (save_resized_image) с этими же размерами.
+        """
+        suffix = ':%d:%.4f' % (width, ratio)
+        rows = MediaFile.objects.filter(name__in=names, source__endswith=suffix)
+        return set(rows.values_list('name', flat=True))
+
+    def digest(self, name):
+        with default_storage.open(name) as f:
+            return file_digest(f)
+
+    def process(self, executor, jobs):
+        futures = [executor.submit(render, default_storage.path(source), *params)
+            for _, _, _, source, _, params in jobs]
+        for (model, field, name, source, key, params), future in zip(jobs, futures):
+            try:
+                output = future.result()
+            except Exception as e:
+                print('Failed %s: %s' % (name, e))
+                continue
+
+            new_name = default_storage.save(
+                '%s/%s.jpg' % (os.path.dirname(source), os.path.splitext(os.path.basename(source))[0]),
+                ContentFile(output))
+            self.renditions[key] = new_name
+            if new_name != source:
+                self.sources[new_name] = source
+            self.relink(model, field, name, new_name)
+
+            self.done += 1
+            self.bytes_before += default_storage.size(name)
+            self.bytes_after += len(output)
+
+    def relink(self, model, field, name, new_name):
+        """
+        Переключает ссылки на новое изображение. Экземпляры сохраняются через
+        модель: сигналы пересчитывают ссылки MediaFile, размеры, версии постов
+        и сбрасывают кэши (fm.cache, fm.fragments).
+        """
+        if new_name == name:
+            return
+        image_field = model._meta.get_field(field)
+        fields = [field] + [f for f in (image_field.width_field, image_field.height_field) if f]
+        for instance in model.objects.filter(pk__in=list(
+                model.objects.filter(**{field: name}).values_list('pk', flat=True))):
+            setattr(instance, field, new_name)
+            instance.save(update_fields=fields)
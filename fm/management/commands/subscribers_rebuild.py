@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from fm.models import User, Post, Friend, Subscriber
+from fm.subscribers import NOTIFIABLE
+
+class Command(BaseCommand):
+    help = 'Rebuilds PUSH-notification subscribers from follows and friends'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', dest='chunk_size', nargs='?', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        regids = dict(User.objects.filter(NOTIFIABLE).values_list('pk', 'android_regid'))
+
+        sources = (
+            # (user, post или author)
+            ('post_id', Post.follows.through.objects.filter(user_id__in=regids) \
+                .values_list('user_id', 'post_id')),
+            ('post_id', Post.objects.filter(author_id__in=regids).values_list('author_id', 'pk')),
+            ('author_id', Friend.objects.filter(author_id__in=regids, follow=True) \
+                .values_list('author_id', 'friend_id')),
+        )
+
+        with transaction.atomic():
+            Subscriber.objects.all().delete()
+            for field, source in sources:
+                rows = source.iterator(chunk_size=chunk_size)
+                while True:
+                    # Строки читаются и вставляются пачками, без копии всей
+                    # таблицы в памяти; повторы (автор следит за своим постом)
+                    # пропускает ограничение unique_together
+                    chunk = [
+                        Subscriber(user_id=user_id, android_regid=regids[user_id], **{field: pk})
+                        for user_id, pk in islice(rows, chunk_size)]
+                    if not chunk:
+                        break
+                    Subscriber.objects.bulk_create(chunk, ignore_conflicts=True)
+
+        print('Subscribers: %d' % Subscriber.objects.count())
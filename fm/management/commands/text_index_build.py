@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+import os
+
+from django.core.management.base import BaseCommand
+
+from fm import textindex
+from fm.cache import cache
+from fm.models import Post
+
+class Command(BaseCommand):
+    help = 'Builds the text similarity index of posts from scratch (later kept current on save)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', dest='chunk_size', nargs='?', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # Новый файл собирается рядом и подменяет старый целиком; процессы
+        # переключаются на него при следующем обращении (см. textindex.matrix)
+        target = textindex.path()
+        tmp = target + '.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+        last = Post.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        vectors = textindex.matrix(last + 1, tmp)
+        rows = Post.objects.order_by('pk').values_list('pk', 'title', 'description') \
+            .iterator(chunk_size=options['chunk_size'])
+        count = 0
+        for pk, title, description in rows:
+            vectors[pk] = textindex.vectorize(title, description)
+            count += 1
+        vectors.flush()
+        os.replace(tmp, target)
+        cache.invalidate('similar')
+        print('Posts indexed: %d, dimension: %d' % (count, textindex.dimension()))
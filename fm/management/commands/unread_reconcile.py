@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+from django.core.management.base import BaseCommand
+
+from fm import unread
+from fm.models import Unread
+
+class Command(BaseCommand):
+    help = 'Recounts unread counters from posts and comments and fixes drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', dest='chunk_size', nargs='?', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        user_ids = list(Unread.objects.order_by('pk').values_list('pk', flat=True))
+        fixed = 0
+        for start in range(0, len(user_ids), chunk_size):
+            rows = unread.actual(Unread.objects.filter(pk__in=user_ids[start:start + chunk_size])) \
+                .values_list('pk', 'feed', 'comments', 'actual_feed', 'actual_comments')
+            for pk, feed, comments, actual_feed, actual_comments in rows:
+                if (feed, comments) == (actual_feed, actual_comments):
+                    continue
+                # Событие между выборкой и записью может потеряться - его поправит следующая сверка
+                Unread.objects.filter(pk=pk).update(
+                    feed=actual_feed, comments=actual_comments)
+                fixed += 1
+
+        print('Counters: %d, fixed: %d' % (len(user_ids), fixed))
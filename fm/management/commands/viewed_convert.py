@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from fm import viewed
+from fm.models import Post
+
+class Command(BaseCommand):
+    help = 'Converts viewed posts from Post.viewed table into compressed bitmaps'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', dest='chunk_size', nargs='?', type=int, default=500,
+            help='Users per transaction')
+        parser.add_argument('--delete', dest='delete', action='store_true',
+            help='Delete converted rows from Post.viewed table')
+
+    def handle(self, *args, **options):
+        through = Post.viewed.through.objects
+        user_ids = list(through.order_by('user_id').values_list('user_id', flat=True).distinct())
+        chunk_size = options['chunk_size']
+        rows = added = 0
+
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            posts = {}
+            for user_id, post_id in through.filter(user_id__in=chunk) \
+                    .values_list('user_id', 'post_id').iterator():
+                posts.setdefault(user_id, []).append(post_id)
+                rows += 1
+
+            with transaction.atomic():
+                for user_id, post_ids in posts.items():
+                    added += viewed.add_many(user_id, post_ids)
+                if options['delete']:
+                    through.filter(user_id__in=chunk).delete()
+            print('Users: %d/%d' % (min(start + chunk_size, len(user_ids)), len(user_ids)))
+
+        print('Rows: %d, added to bitmaps: %d' % (rows, added))
+        if not viewed.bitmap_enabled():
+            print('Set FM_VIEWED_BITMAP = True to read viewed posts from bitmaps')
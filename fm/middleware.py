@@ -0,0 +1,275 @@
+import hashlib
+import hmac
+import math
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.http import JsonResponse
+
+from fm import profiling
+from fm.hashers import Overloaded
+
+# Значения по умолчанию для всех представлений; каждый класс представления
+# может переопределить их атрибутом load_limits или методом get_load_limits()
+LOAD_LIMITS = {
+    'concurrency': None,    # одновременных запросов на процесс (bulkhead)
+    'rate': None,           # запросов на пользователя: '60/min'
+    'burst': None,          # запросов подряд, по умолчанию равно числу запросов за период
+    'latency': None,        # целевое время ответа, сек.
+}
+
+PERIODS = {'s': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600, 'hour': 3600}
+
+
+def parse_rate(rate):
+    num, period = rate.split('/')
+    return int(num), PERIODS[period]
+
+
+class Bulkhead(object):
+    """
+    Ограничитель одновременных запросов с адаптивным пределом:
+    пока среднее время ответа выше целевого, предел уменьшается,
+    пока ниже - постепенно возвращается к максимальному.
+    """
+    def __init__(self, limit, latency=None):
+        self.max_limit = limit
+        self.limit = float(limit)
+        self.latency = latency
+        self.average = 0.0
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.active >= max(1, int(self.limit)):
+                return False
+            self.active += 1
+            return True
+
+    def release(self, elapsed):
+        with self.lock:
+            self.active -= 1
+            self.average = 0.8 * self.average + 0.2 * elapsed if self.average else elapsed
+            if self.latency:
+                if self.average > self.latency:
+                    self.limit = max(1.0, self.limit * 0.9)
+                else:
+                    self.limit = min(float(self.max_limit), self.limit + 0.1)
+
+
+class LoadSheddingMiddleware(object):
+    """
+    Защищает дорогие представления от перегрузки:
+    - ограничивает число одновременных запросов к каждому представлению (503);
+    - ограничивает частоту запросов каждого пользователя скользящим окном,
+      счетчики которого хранятся в общем кэше (429);
+    - сбрасывает запросы, слишком долго ждавшие в очереди балансировщика
+      (заголовок X-Request-Start), и запросы к представлениям, время ответа
+      которых выше целевого (503);
+    - отвечает 503 на переполнение пула хэширования паролей (fm.hashers)
+      и вне API, например при входе в админку.
+    Ответы 503 и 429 содержат заголовок Retry-After.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.bulkheads = {}
+        self.lock = threading.Lock()
+        self.max_queue_time = getattr(settings, 'FM_MAX_QUEUE_TIME', None)
+
+    def __call__(self, request):
+        request._fm_bulkhead = None
+        response = self.get_response(request)
+        bulkhead = request._fm_bulkhead
+        if bulkhead is not None:
+            bulkhead.release(time.time() - request._fm_started)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None) or getattr(view_func, 'cls', None)
+        if view_class is None:
+            return None
+
+        scope, limits = self.get_limits(view_class, request)
+
+        queue_time = self.get_queue_time(request)
+        if self.max_queue_time and queue_time > self.max_queue_time:
+            return self.reject(503, 'Сервер перегружен, повторите запрос позже.', 1)
+
+        if limits['rate']:
+            wait = self.check_rate(scope, request, limits)
+            if wait:
+                return self.reject(429, 'Слишком много запросов.', wait)
+
+        if limits['concurrency']:
+            bulkhead = self.get_bulkhead(scope, limits)
+            if not bulkhead.acquire():
+                return self.reject(503, 'Сервер перегружен, повторите запрос позже.', 1)
+            request._fm_bulkhead = bulkhead
+            request._fm_started = time.time()
+        return None
+
+    def process_exception(self, request, exception):
+        # Представления DRF сами отвечают на APIException, сюда доходят
+        # исключения остальных представлений
+        if isinstance(exception, Overloaded):
+            return self.reject(503, str(exception.detail), exception.wait)
+        return None
+
+    def get_limits(self, view_class, request):
+        limits = dict(LOAD_LIMITS)
+        limits.update(getattr(settings, 'FM_LOAD_LIMITS', {}))
+        if hasattr(view_class, 'get_load_limits'):
+            scope, view_limits = view_class.get_load_limits(request)
+        else:
+            scope, view_limits = view_class.__name__, getattr(view_class, 'load_limits', {})
+        limits.update(view_limits)
+        return scope, limits
+
+    def get_bulkhead(self, scope, limits):
+        bulkhead = self.bulkheads.get(scope)
+        if bulkhead is None:
+            with self.lock:
+                bulkhead = self.bulkheads.setdefault(scope,
+                    Bulkhead(limits['concurrency'], limits['latency']))
+        return bulkhead
+
+    def get_queue_time(self, request):
+        # nginx: proxy_set_header X-Request-Start "t=${msec}";
+        start = request.META.get('HTTP_X_REQUEST_START', '')
+        try:
+            start = float(start[2:] if start.startswith('t=') else start)
+        except ValueError:
+            return 0
+        return max(0, time.time() - start)
+
+    def get_ident(self, request):
+        # JWT проверяется позже, в самом представлении; для ограничения
+        # достаточно отпечатка токена, без запроса пользователя из БД
+        auth = request.META.get('HTTP_AUTHORIZATION')
+        if auth:
+            return hashlib.sha1(auth.encode('utf-8')).hexdigest()
+        return request.META.get('REMOTE_ADDR', '')
+
+    def check_rate(self, scope, request, limits):
+        """
+        Учитывает запрос пользователя. Возвращает 0 или время в секундах,
+        через которое стоит повторить запрос.
+
+        Скользящее окно из двух фиксированных: число запросов в текущем окне
+        плюс число запросов в предыдущем с весом еще не прошедшей его доли.
+        Окно длиной burst / rate вмещает burst запросов, в среднем выходит
+        rate. Счетчик окна увеличивается атомарно (add + incr) в кэше
+        FM_RATE_CACHE_ALIAS, общем для всех процессов: из одновременных
+        запросов сверх предела проходят не больше оставшихся.
+        """
+        num, period = parse_rate(limits['rate'])
+        capacity = limits['burst'] or num
+        window = capacity * period / num
+        store = caches[getattr(settings, 'FM_RATE_CACHE_ALIAS', 'default')]
+
+        now = time.time()
+        index, elapsed = divmod(now / window, 1)
+        key = 'fm-rate:%s:%s:' % (scope, self.get_ident(request))
+        current = key + str(int(index))
+        timeout = int(window * 2) + 1
+        store.add(current, 0, timeout)
+        try:
+            count = store.incr(current)
+        except ValueError:
+            # Счетчик вытеснен между add и incr
+            store.add(current, 1, timeout)
+            count = 1
+        previous = store.get(key + str(int(index) - 1), 0)
+        if previous * (1 - elapsed) + count <= capacity:
+            return 0
+
+        # Отклоненный запрос не расходует предел
+        try:
+            store.decr(current)
+        except ValueError:
+            pass
+        count -= 1
+        if count + 1 > capacity:
+            wait = 1 - elapsed
+        else:
+            # Ждем, пока вес предыдущего окна не освободит место
+            wait = 1 - (capacity - count - 1) / previous - elapsed
+        return max(1, int(math.ceil(wait * window)))
+
+    def reject(self, status, detail, retry_after):
+        response = JsonResponse({'detail': detail}, status=status)
+        response['Retry-After'] = str(retry_after)
+        return response
+
+
+class ProfilingMiddleware(object):
+    """
+    Профилирование запросов к представлениям fm.views:
+    - по заголовку X-Profile: 1 от сотрудника, вошедшего в админку (сессия),
+      или по заголовку X-Profile со значением FM_PROFILE_SECRET (для API
+      с JWT, который проверяется только в представлении);
+    - для FM_PROFILE_SAMPLE процентов запросов.
+    У профилируемых запросов стек снимается раз в FM_PROFILE_INTERVAL сек.
+    и записываются SQL-запросы; у остальных ничего не оборачивается, а если
+    ответ дольше FM_PROFILE_SLOW сек., сохраняется только время. Профили
+    хранятся в кольцевом буфере процесса (fm.profiling) и видны сотрудникам
+    на странице admin/profiles/.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample = getattr(settings, 'FM_PROFILE_SAMPLE', 0)
+        self.slow = getattr(settings, 'FM_PROFILE_SLOW', None)
+        self.interval = getattr(settings, 'FM_PROFILE_INTERVAL', 0.005)
+        self.secret = getattr(settings, 'FM_PROFILE_SECRET', None)
+
+    def __call__(self, request):
+        request._fm_sampler = None
+        started = time.time()
+        try:
+            response = self.get_response(request)
+        finally:
+            sampler = request._fm_sampler
+            if sampler is not None:
+                sampler.stop()
+                connection.execute_wrappers.remove(request._fm_trace)
+        duration = time.time() - started
+
+        if sampler is not None:
+            profile = profiling.record(request, response, duration, request._fm_profile_reason,
+                request._fm_trace, sampler.stacks)
+            response['X-Profile-Id'] = str(profile['id'])
+        elif self.slow and duration > self.slow:
+            profiling.record(request, response, duration, 'slow')
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None) or getattr(view_func, 'cls', None)
+        if view_class is None or view_class.__module__ != 'fm.views':
+            return None
+
+        header = request.META.get('HTTP_X_PROFILE')
+        if header and self.allowed(request, header):
+            request._fm_profile_reason = 'header'
+        elif self.sample and random.random() * 100 < self.sample:
+            request._fm_profile_reason = 'sample'
+        else:
+            return None
+        # То же, что connection.execute_wrapper(), но только на время представления
+        request._fm_trace = profiling.QueryTrace()
+        connection.execute_wrappers.append(request._fm_trace)
+        request._fm_sampler = profiling.Sampler(threading.get_ident(), self.interval)
+        request._fm_sampler.start()
+        return None
+
+    def allowed(self, request, header):
+        # Проверяется до запуска выборки стеков: посторонние запросы
+        # с заголовком не должны нагружать сервер
+        if self.secret and hmac.compare_digest(header, self.secret):
+            return True
+        user = getattr(request, 'user', None)
+        return header == '1' and user is not None and user.is_staff
@@ -0,0 +1,56 @@
+# Generated by Django 2.2.28 on 2026-10-19 12:34
+
+import math
+from datetime import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+from django.utils import timezone
+
+
+# Копия fm.ranking.hot_score на момент миграции: миграция не должна зависеть
+# от текущих моделей и модулей приложения
+def hot_score(created, likes=0, comments=0, follows=0):
+    weights = getattr(settings, 'FM_HOT_WEIGHTS', {'likes': 1.0, 'comments': 2.0, 'follows': 1.5})
+    decay = getattr(settings, 'FM_HOT_DECAY', 45000)
+
+    activity = weights['likes'] * likes + weights['comments'] * comments + \
+        weights['follows'] * follows
+    order = math.log10(max(activity, 1))
+
+    if timezone.is_aware(created):
+        created = timezone.make_naive(created, timezone.utc)
+    seconds = (created - datetime(2018, 1, 1)).total_seconds()
+    return round(order + seconds / decay, 7)
+
+
+def fill_hot(apps, schema_editor):
+    Post = apps.get_model('fm', 'Post')
+    Comment = apps.get_model('fm', 'Comment')
+
+    def counts(model):
+        return dict(model.objects.order_by().values_list('post_id').annotate(num=Count('pk')))
+
+    likes = counts(Post.likes.through)
+    follows = counts(Post.follows.through)
+    comments = counts(Comment)
+    for pk, created in Post.objects.values_list('pk', 'created').iterator():
+        Post.objects.filter(pk=pk).update(hot=hot_score(created,
+            likes=likes.get(pk, 0), comments=comments.get(pk, 0), follows=follows.get(pk, 0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fm', '0002_auto_20180622_1029'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='hot',
+            field=models.FloatField(db_index=True, default=0, editable=False, help_text='Рейтинг для сортировки "горячих" постов', verbose_name='Рейтинг'),
+        ),
+        migrations.RunPython(fill_hot, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-19 12:42
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fm', '0005_subscriber'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ViewedChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.IntegerField(db_index=True)),
+                ('count', models.IntegerField(default=0)),
+                ('data', models.BinaryField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='viewed_chunks', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'key')},
+            },
+        ),
+    ]
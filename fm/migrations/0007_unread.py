@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-19 12:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fm', '0006_viewedchunk'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Unread',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='unread', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('feed', models.IntegerField(default=0, verbose_name='Новых постов')),
+                ('comments', models.IntegerField(default=0, verbose_name='Новых комментариев')),
+                ('feed_seen', models.DateTimeField(verbose_name='Лента просмотрена')),
+                ('comments_seen', models.DateTimeField(verbose_name='Отслеживаемые просмотрены')),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-19 12:46
+
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def fill_modified(apps, schema_editor):
+    Post = apps.get_model('fm', 'Post')
+    Post.objects.update(modified=F('created'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fm', '0007_unread'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='modified',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Изменен'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False, help_text='Увеличивается при любом изменении поста, отметок, комментариев', verbose_name='Версия'),
+        ),
+        migrations.RunPython(fill_modified, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 2.2.28 on 2026-10-19 12:48
+
+from django.core.files.images import get_image_dimensions
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+import fm.helpers
+import fm.models
+import functools
+
+
+def fill_image_size(apps, schema_editor):
+    Post = apps.get_model('fm', 'Post')
+    # values_list: экземпляры модели сами попытались бы прочитать файлы
+    rows = Post.objects.exclude(image='').exclude(image__isnull=True).values_list('pk', 'image')
+    broken = []
+    for pk, name in rows.iterator():
+        try:
+            with default_storage.open(name) as f:
+                width, height = get_image_dimensions(f, close=True)
+        except OSError:
+            width = height = None
+        if width and height:
+            Post.objects.filter(pk=pk).update(image_width=width, image_height=height)
+        else:
+            # Файла нет или он не читается: ссылку не трогаем, размеры
+            # остаются пустыми (fm.models.SafeImageField)
+            broken.append(pk)
+    if broken:
+        print('\n  Posts with unreadable images: %s' % ', '.join(map(str, broken)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fm', '0008_post_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='image_height',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='Высота изображения'),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='image_width',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='Ширина изображения'),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='image',
+            field=fm.models.SafeImageField(blank=True, height_field='image_height', null=True, upload_to=functools.partial(fm.helpers.get_upload_path, *(), **{'path': 'posts_images'}), verbose_name='Изображение', width_field='image_width'),
+        ),
+        migrations.RunPython(fill_image_size, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-19 12:50
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fm', '0009_post_image_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255, verbose_name='Тема')),
+                ('message', models.TextField(verbose_name='Текст')),
+                ('from_email', models.CharField(blank=True, max_length=255, verbose_name='Отправитель')),
+                ('recipients', models.TextField(help_text='По одному адресу в строке', verbose_name='Получатели')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+                ('attempts', models.IntegerField(default=0, verbose_name='Попыток')),
+                ('next_attempt', models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text='Пусто - попытки исчерпаны', null=True, verbose_name='Следующая попытка')),
+                ('last_error', models.TextField(blank=True, verbose_name='Последняя ошибка')),
+            ],
+            options={
+                'verbose_name': 'Письмо',
+                'verbose_name_plural': 'Исходящие письма',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-19 12:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fm', '0010_outboxemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostNeighbors',
+            fields=[
+                ('post', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='neighbors', serialize=False, to='fm.Post')),
+                ('count', models.IntegerField(default=0)),
+                ('data', models.BinaryField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-19 13:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fm', '0011_postneighbors'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MinHashBand',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.BigIntegerField(db_index=True)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='minhash_bands', to='fm.Post')),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def clear_referenced(apps, schema_editor):
+    # Файлам без ссылок срок хранения отсчитывается заново, от миграции
+    MediaFile = apps.get_model('fm', 'MediaFile')
+    MediaFile.objects.filter(refs__gt=0).update(released=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fm', '0012_minhashband'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='released',
+            field=models.DateTimeField(blank=True, default=django.utils.timezone.now, null=True, verbose_name='Без ссылок с'),
+        ),
+        migrations.RunPython(clear_referenced, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:32
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    # Повторные подписки (одновременные подписки без ограничения) удаляем,
+    # оставляя самую раннюю запись
+    Subscriber = apps.get_model('fm', 'Subscriber')
+    for field in ('post', 'author'):
+        duplicates = Subscriber.objects.filter(**{field + '__isnull': False}) \
+            .values('user', field).order_by().annotate(first=Min('pk'), num=Count('pk')) \
+            .filter(num__gt=1)
+        for row in duplicates.iterator():
+            Subscriber.objects.filter(user=row['user'], **{field: row[field]}) \
+                .exclude(pk=row['first']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fm', '0013_mediafile_released'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='subscriber',
+            unique_together={('user', 'author'), ('user', 'post')},
+        ),
+    ]
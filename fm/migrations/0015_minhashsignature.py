@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-19 14:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fm', '0014_subscriber_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MinHashSignature',
+            fields=[
+                ('post', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='minhash_signature', serialize=False, to='fm.Post')),
+                ('data', models.BinaryField()),
+            ],
+        ),
+    ]
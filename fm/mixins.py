@@ -1,6 +1,11 @@
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from rest_framework.response import Response
 
+from fm import fragments
+from fm.versions import get_version
+
 class MultipleFieldLookupMixin(object):
     """
     Apply this mixin to any view or viewset to get multiple field filtering
@@ -28,3 +33,79 @@ class ListHeaderMixin(object):
 
         serializer = self.get_serializer(queryset, many=True)
         return Response({list_name: serializer.data})
+
+class ConditionalMixin(object):
+    """
+    Условные GET-запросы по версии поста: ETag и Last-Modified в ответе,
+    304 на If-None-Match/If-Modified-Since после одного запроса версии,
+    без аннотаций и сериализации. Версия берется из поста с id
+    self.kwargs[version_url_kwarg] (см. fm.versions); представления, ответ
+    которых зависит и от других данных, переопределяют get_version().
+    """
+    version_url_kwarg = 'post'
+
+    def get_version(self):
+        """
+        (версия, время изменения) или None, если пост не найден. Время
+        может быть None - тогда проверяется только ETag.
+        """
+        return get_version(self.kwargs.get(self.version_url_kwarg))
+
+    def get_etag(self, request, version):
+        # В ответе есть поля текущего пользователя (isLike, isFollow, isMy),
+        # тело зависит от формата (JSON или MessagePack)
+        return quote_etag('%s-%d-%s-%s-%s' % (self.__class__.__name__,
+            int(self.kwargs[self.version_url_kwarg]), version, request.user.pk,
+            request.accepted_renderer.format))
+
+    def get(self, request, *args, **kwargs):
+        current = self.get_version()
+        if current is None:
+            return super(ConditionalMixin, self).get(request, *args, **kwargs)
+
+        version, modified = current
+        etag = self.get_etag(request, version)
+        last_modified = int(modified.timestamp()) if modified is not None else None
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super(ConditionalMixin, self).get(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+class SparseFieldsMixin(object):
+    """
+    Параметры GET-запроса ?fields=id,title,countLike и ?embed=comments,similar
+    передаются сериализатору (см. fm.serializers.DynamicFieldsMixin);
+    wants() позволяет не строить в SQL то, что не запрошено.
+    """
+    def get_query_list(self, name):
+        request = getattr(self, 'request', None)
+        if request is None or request.method != 'GET' or name not in request.query_params:
+            return None
+        return {value.strip() for value in request.query_params[name].split(',') if value.strip()}
+
+    def wants(self, name):
+        fields = self.get_query_list('fields')
+        return fields is None or name in fields
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.get_query_list('fields'))
+        kwargs.setdefault('embed', self.get_query_list('embed'))
+        return super(SparseFieldsMixin, self).get_serializer(*args, **kwargs)
+
+class PostFragmentsMixin(object):
+    """
+    GET-списки постов собираются из кэша фрагментов (fm.fragments): запрос
+    списка выбирает только сами посты, общая часть строк берется из кэша,
+    флаги пользователя - одним запросом.
+    """
+    def use_fragments(self):
+        return fragments.enabled() and self.request.method == 'GET'
+
+    def get_serializer_context(self):
+        context = super(PostFragmentsMixin, self).get_serializer_context()
+        context['fragments'] = self.use_fragments()
+        return context
@@ -1,12 +1,14 @@
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import BaseUserManager
 from django.contrib.auth.models import AbstractBaseUser
 from django.contrib.auth.models import PermissionsMixin
 from django.utils.translation import ugettext_lazy as _
 
 from functools import partial
-from fm.helpers import get_upload_path, save_resized_image
+from fm.helpers import get_upload_path, save_resized_image, \
+    PROFILE_PHOTO_SIZE, POST_IMAGE_SIZE
 
 
 class UserManager(BaseUserManager):
@@ -87,8 +89,9 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self.email
 
     def save(self, *args, **kwargs):
-        if not kwargs or ('update_fields' in kwargs) and ('profile_photo' in kwargs['update_fields']):
-            self.profile_photo = save_resized_image(self.profile_photo, 400, 1)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'profile_photo' in update_fields:
+            self.profile_photo = save_resized_image(self.profile_photo, *PROFILE_PHOTO_SIZE)
         super(User, self).save(*args, **kwargs)
 
     class Meta:
@@ -104,6 +107,17 @@ class Friend(models.Model):
     follow = models.BooleanField(default=False)
 
 
+class SafeImageField(models.ImageField):
+    """
+    ImageField, который при загрузке объекта без сохраненных размеров
+    не падает, если файл недоступен: размеры остаются пустыми.
+    """
+    def update_dimension_fields(self, instance, force=False, *args, **kwargs):
+        try:
+            super(SafeImageField, self).update_dimension_fields(instance, force, *args, **kwargs)
+        except OSError:
+            pass
+
 class Post(models.Model):
     QUESTION = 0
     POSITIVE = 1
@@ -125,9 +139,14 @@ class Post(models.Model):
         verbose_name='Название')
     description = models.TextField(blank=True,
         verbose_name='Описание', help_text=_('Текст поста'))
-    image = models.ImageField(
+    image = SafeImageField(
         upload_to=partial(get_upload_path, path='posts_images'), blank=True, null=True,
+        width_field='image_width', height_field='image_height',
         verbose_name='Изображение')
+    image_width = models.PositiveIntegerField(null=True, blank=True, editable=False,
+        verbose_name='Ширина изображения')
+    image_height = models.PositiveIntegerField(null=True, blank=True, editable=False,
+        verbose_name='Высота изображения')
     tags = models.ManyToManyField('Tag',
         verbose_name='Теги')
     city = models.ForeignKey('city', related_name='post_city', null=True, on_delete=models.SET_NULL,
@@ -141,14 +160,21 @@ class Post(models.Model):
         related_name='post_follows', verbose_name='Отслеживают')
     viewed = models.ManyToManyField(settings.AUTH_USER_MODEL, blank=True,
         related_name='posts_viewed', verbose_name=_('Прочитали'))
+    hot = models.FloatField(default=0, db_index=True, editable=False,
+        verbose_name='Рейтинг', help_text=_('Рейтинг для сортировки "горячих" постов'))
+    version = models.PositiveIntegerField(default=1, editable=False,
+        verbose_name='Версия', help_text=_('Увеличивается при любом изменении поста, отметок, комментариев'))
+    modified = models.DateTimeField(default=timezone.now, editable=False,
+        verbose_name='Изменен')
 
     def __str__(self):
         return self.title
 
     def save(self, *args, **kwargs):
-        if not kwargs or ('update_fields' in kwargs) and ('image' in kwargs['update_fields']):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'image' in update_fields:
             if self.image:
-                self.image = save_resized_image(self.image, 800, 16/9)
+                self.image = save_resized_image(self.image, *POST_IMAGE_SIZE)
         super(Post, self).save(*args, **kwargs)
 
 
@@ -209,3 +235,148 @@ class City(models.Model):
         verbose_name = 'Город'
         verbose_name_plural = 'Города'
         ordering = ('name', )
+
+class MediaFileManager(models.Manager):
+    def add_refs(self, name, delta):
+        """
+        Меняет счетчик ссылок файла; когда ссылок не остается, запоминает
+        время (от него media_gc отсчитывает срок хранения).
+        """
+        if not name:
+            return 0
+        # В UPDATE условие видит значение refs до изменения
+        released = models.Case(
+            models.When(refs__gt=-delta, then=models.Value(None)),
+            models.When(released__isnull=True, then=models.Value(timezone.now())),
+            default=models.F('released'), output_field=models.DateTimeField())
+        return self.filter(name=name).update(refs=models.F('refs') + delta, released=released)
+
+class MediaFile(models.Model):
+    """
+    Загруженный файл в хранилище с адресацией по содержимому.
+    """
+    name = models.CharField(max_length=255, unique=True,
+        verbose_name='Файл')
+    source = models.CharField(max_length=100, db_index=True, blank=True,
+        verbose_name='Источник', help_text=_('Хэш исходного изображения и параметры обработки'))
+    refs = models.IntegerField(default=0,
+        verbose_name='Ссылок')
+    created = models.DateTimeField(auto_now_add=True,
+        verbose_name='Создан')
+    released = models.DateTimeField(null=True, blank=True, default=timezone.now,
+        verbose_name='Без ссылок с')
+
+    objects = MediaFileManager()
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = 'Медиафайл'
+        verbose_name_plural = 'Медиафайлы'
+
+class Subscriber(models.Model):
+    """
+    Получатель PUSH-уведомлений о новых комментариях к посту (post)
+    или о новых постах автора (author) с готовым registration_id.
+    Хранится только для пользователей с включенными уведомлениями.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+        related_name='subscriptions', on_delete=models.CASCADE)
+    post = models.ForeignKey('Post', null=True, blank=True,
+        related_name='subscribers', on_delete=models.CASCADE)
+    author = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True,
+        related_name='subscribers', on_delete=models.CASCADE)
+    android_regid = models.TextField()
+
+    class Meta:
+        unique_together = (('user', 'post'), ('user', 'author'))
+
+class ViewedChunk(models.Model):
+    """
+    Прочитанные пользователем посты одного диапазона id (key = id >> 16)
+    в виде сжатого контейнера (см. fm.bitmap). Замена таблицы Post.viewed.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+        related_name='viewed_chunks', on_delete=models.CASCADE)
+    key = models.IntegerField(db_index=True)
+    count = models.IntegerField(default=0)
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = (('user', 'key'), )
+
+class Unread(models.Model):
+    """
+    Счетчики непрочитанного для значков в приложении: новые посты друзей,
+    за которыми следит пользователь, и новые комментарии к отслеживаемым постам.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, primary_key=True,
+        related_name='unread', on_delete=models.CASCADE)
+    feed = models.IntegerField(default=0,
+        verbose_name='Новых постов')
+    comments = models.IntegerField(default=0,
+        verbose_name='Новых комментариев')
+    feed_seen = models.DateTimeField(
+        verbose_name='Лента просмотрена')
+    comments_seen = models.DateTimeField(
+        verbose_name='Отслеживаемые просмотрены')
+
+class OutboxEmail(models.Model):
+    """
+    Письмо в очереди на отправку (см. fm.outbox и команду outbox_worker).
+    После успешной отправки удаляется.
+    """
+    subject = models.CharField(max_length=255,
+        verbose_name='Тема')
+    message = models.TextField(
+        verbose_name='Текст')
+    from_email = models.CharField(max_length=255, blank=True,
+        verbose_name='Отправитель')
+    recipients = models.TextField(
+        verbose_name='Получатели', help_text=_('По одному адресу в строке'))
+    created = models.DateTimeField(auto_now_add=True,
+        verbose_name='Создано')
+    attempts = models.IntegerField(default=0,
+        verbose_name='Попыток')
+    next_attempt = models.DateTimeField(null=True, db_index=True, default=timezone.now,
+        verbose_name='Следующая попытка', help_text=_('Пусто - попытки исчерпаны'))
+    last_error = models.TextField(blank=True,
+        verbose_name='Последняя ошибка')
+
+    def __str__(self):
+        return self.subject
+
+    class Meta:
+        verbose_name = 'Письмо'
+        verbose_name_plural = 'Исходящие письма'
+
+class PostNeighbors(models.Model):
+    """
+    Похожие посты по совместным лайкам, подпискам и просмотрам (item-item),
+    рассчитываются командой recommend_build. data - массив uint32 id соседей,
+    за ним массив float32 их оценок (см. fm.recommend).
+    """
+    post = models.OneToOneField(Post, primary_key=True,
+        related_name='neighbors', on_delete=models.CASCADE)
+    count = models.IntegerField(default=0)
+    data = models.BinaryField()
+    updated = models.DateTimeField(auto_now=True)
+
+class MinHashBand(models.Model):
+    """
+    Ключ полосы MinHash-подписи вопроса для поиска дубликатов (см. fm.duplicates):
+    у похожих вопросов хотя бы один ключ совпадает с высокой вероятностью.
+    """
+    post = models.ForeignKey(Post,
+        related_name='minhash_bands', on_delete=models.CASCADE)
+    key = models.BigIntegerField(db_index=True)
+
+class MinHashSignature(models.Model):
+    """
+    MinHash-подпись вопроса (см. fm.duplicates): массив uint32, по которому
+    оценивается сходство кандидатов без повторного разбора их текста.
+    """
+    post = models.OneToOneField(Post, primary_key=True,
+        related_name='minhash_signature', on_delete=models.CASCADE)
+    data = models.BinaryField()
@@ -0,0 +1,53 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.utils import timezone
+
+from fm.models import OutboxEmail
+
+
+def enqueue(subject, message, from_email, recipient_list):
+    """
+    Ставит письмо в очередь вместо отправки внутри запроса.
+    """
+    return OutboxEmail.objects.create(subject=subject, message=message,
+        from_email=from_email or '', recipients='\n'.join(recipient_list))
+
+
+def retry_delay(attempts):
+    # 1, 4, 9, 16... минут
+    return timedelta(minutes=attempts * attempts)
+
+
+def deliver(connection, limit=100):
+    """
+    Отправляет до limit готовых к отправке писем через одно открытое
+    соединение (закрывает его вызывающий). Возвращает (отправлено, ошибок).
+    Рассчитано на один обработчик очереди.
+    """
+    max_attempts = getattr(settings, 'FM_EMAIL_MAX_ATTEMPTS', 5)
+    emails = list(OutboxEmail.objects.filter(next_attempt__lte=timezone.now())
+        .order_by('next_attempt', 'pk')[:limit])
+    sent = failed = 0
+    for email in emails:
+        message = EmailMessage(email.subject, email.message,
+            email.from_email or None, email.recipients.split('\n'), connection=connection)
+        try:
+            # Открывает соединение, если оно еще не открыто или закрыто после ошибки
+            connection.open()
+            message.send()
+        except Exception as e:
+            # Соединение могло оборваться: следующее письмо откроет новое
+            connection.close()
+            email.attempts += 1
+            email.last_error = '%s: %s' % (e.__class__.__name__, e)
+            email.next_attempt = timezone.now() + retry_delay(email.attempts) \
+                if email.attempts < max_attempts else None
+            email.save(update_fields=('attempts', 'last_error', 'next_attempt'))
+            failed += 1
+            continue
+        # Письма могут содержать пароли: после отправки не храним
+        OutboxEmail.objects.filter(pk=email.pk).delete()
+        sent += 1
+    return sent, failed
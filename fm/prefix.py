@@ -0,0 +1,172 @@
+import heapq
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db.models import Count, Q
+
+from fm.cache import cache
+from fm.models import User, Tag, City
+
+# Транслитерация, чтобы "mosk" находило "Москва", а "хан" - "Han"
+TRANSLIT = {
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh',
+    'з': 'z', 'и': 'i', 'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o',
+    'п': 'p', 'р': 'r', 'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'c',
+    'ч': 'ch', 'ш': 'sh', 'щ': 'sch', 'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu',
+    'я': 'ya',
+}
+TRANSLIT_TABLE = str.maketrans(TRANSLIT)
+
+# Сколько ключей просматривать для запроса из одной буквы: под нее подходит
+# заметная доля индекса, ответ ограничен по времени ценой точности ранжирования
+SHORT_SCAN = 5000
+
+
+def normalize(text):
+    return ' '.join(text.casefold().replace('ё', 'е').split())
+
+
+def keys_for(text):
+    """
+    Ключи индекса для строки: каждое слово с его позиции до конца строки
+    ("han solo" -> "han solo", "solo") и их транслитерация.
+    """
+    text = normalize(text)
+    words = text.split(' ')
+    keys = set()
+    for i in range(len(words)):
+        key = ' '.join(words[i:])
+        if key:
+            keys.add(key)
+            keys.add(key.translate(TRANSLIT_TABLE))
+    return keys
+
+
+class PrefixIndex(object):
+    """
+    Отсортированный массив ключей с поиском по префиксу бинарным поиском.
+    Ключи и id хранятся в параллельных списках (entries), вес (популярность)
+    и отображаемый текст - в словаре по id. Изменения вносятся точечно
+    в копию списков, поэтому поиск работает без блокировки.
+    """
+    def __init__(self, load):
+        self.load = load
+        self.lock = threading.Lock()
+        self.loaded = None
+        self.version = None
+        self.entries = ([], [])
+        self.items = {}
+
+    def fresh(self, version):
+        ttl = getattr(settings, 'FM_PREFIX_TTL', 300)
+        return self.loaded is not None and self.version == version and time.time() - self.loaded < ttl
+
+    def ensure_loaded(self):
+        # Массовые изменения (import_ndjson) сбрасывают пространство "prefix"
+        # fm.cache - все процессы перестраивают индексы, не дожидаясь FM_PREFIX_TTL
+        version = cache.version('prefix')
+        if self.fresh(version):
+            return
+        with self.lock:
+            if not self.fresh(version):
+                self.rebuild()
+                self.version = version
+
+    def rebuild(self):
+        items = {pk: [text, weight] for pk, text, weight in self.load()}
+        entries = sorted((key, pk) for pk, (text, _) in items.items() for key in keys_for(text))
+        self.entries = ([key for key, _ in entries], [pk for _, pk in entries])
+        self.items = items
+        self.loaded = time.time()
+
+    def search(self, query, limit=10):
+        self.ensure_loaded()
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        (keys, ids), items = self.entries, self.items
+        scan = SHORT_SCAN if len(prefix) == 1 else None
+        # Запрос ищется как есть и в транслитерации ("хан" -> "han")
+        found = set()
+        for variant in {prefix, prefix.translate(TRANSLIT_TABLE)}:
+            i = bisect_left(keys, variant)
+            end = len(keys) if scan is None else min(len(keys), i + scan)
+            while i < end and keys[i].startswith(variant):
+                found.add(ids[i])
+                i += 1
+        found = [(pk, items[pk]) for pk in found if pk in items]
+        found = heapq.nsmallest(limit, found, key=lambda item: (-item[1][1], item[1][0]))
+        return [(pk, text) for pk, (text, _) in found]
+
+    # Точечные изменения под self.lock (не теряются при перестроении); до первой
+    # загрузки не нужны. Вносятся только в индекс текущего процесса
+    def put(self, pk, text):
+        if self.loaded is None:
+            return
+        with self.lock:
+            old = self.items.get(pk)
+            if old is not None and old[0] == text:
+                return
+            keys, ids = list(self.entries[0]), list(self.entries[1])
+            if old is not None:
+                self._remove_keys(keys, ids, pk, old[0])
+            for key in keys_for(text):
+                i = bisect_left(keys, key)
+                keys.insert(i, key)
+                ids.insert(i, pk)
+            self.items[pk] = [text, old[1] if old else 0]
+            self.entries = (keys, ids)
+
+    def remove(self, pk):
+        if self.loaded is None:
+            return
+        with self.lock:
+            old = self.items.pop(pk, None)
+            if old is not None:
+                keys, ids = list(self.entries[0]), list(self.entries[1])
+                self._remove_keys(keys, ids, pk, old[0])
+                self.entries = (keys, ids)
+
+    def add_weight(self, pk, delta):
+        with self.lock:
+            item = self.items.get(pk)
+            if item is not None:
+                item[1] += delta
+
+    def set_weight(self, pk, weight):
+        with self.lock:
+            item = self.items.get(pk)
+            if item is not None:
+                item[1] = weight
+
+    def _remove_keys(self, keys, ids, pk, text):
+        for key in keys_for(text):
+            i = bisect_left(keys, key)
+            while i < len(keys) and keys[i] == key:
+                if ids[i] == pk:
+                    del keys[i]
+                    del ids[i]
+                    break
+                i += 1
+
+
+def load_tags():
+    return Tag.objects.annotate(weight=Count('post')).values_list('pk', 'tag', 'weight')
+
+
+def load_cities():
+    return City.objects.annotate(weight=Count('post_city')).values_list('pk', 'name', 'weight')
+
+
+def load_users():
+    users = User.objects.filter(is_active=True, is_staff=False) \
+        .annotate(weight=Count('friend_to', filter=Q(friend_to__follow=True)))
+    for user in users.only('pk', 'first_name', 'last_name', 'email').iterator():
+        yield user.pk, user.get_full_name(), user.weight
+
+
+tags = PrefixIndex(load_tags)
+cities = PrefixIndex(load_cities)
+users = PrefixIndex(load_users)
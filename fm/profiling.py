@@ -0,0 +1,161 @@
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, HttpResponse
+from django.shortcuts import render
+from django.utils import timezone
+
+# Последние профили запросов этого процесса
+profiles = deque(maxlen=getattr(settings, 'FM_PROFILE_BUFFER', 50))
+profile_ids = itertools.count(1)
+
+QUERY_LIMIT = 200
+
+
+def short_path(path):
+    for prefix in (settings.BASE_DIR, sys.prefix):
+        if path.startswith(prefix):
+            return os.path.relpath(path, prefix)
+    return path
+
+
+class Sampler(threading.Thread):
+    """
+    Раз в interval секунд снимает стек потока запроса и считает
+    одинаковые стеки. Сам запрос при этом не замедляется трассировкой.
+    """
+    def __init__(self, thread_id, interval):
+        super(Sampler, self).__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, short_path(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class QueryTrace(object):
+    """
+    Обертка выполнения SQL (connection.execute_wrapper): число, общее время
+    и первые QUERY_LIMIT запросов с временем выполнения.
+    """
+    def __init__(self):
+        self.queries = []
+        self.count = 0
+        self.total = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.total += elapsed
+            if len(self.queries) < QUERY_LIMIT:
+                self.queries.append((sql, elapsed))
+
+
+def record(request, response, duration, reason, trace=None, stacks=None):
+    # Без trace (медленный ответ непрофилируемого запроса) SQL не записывался
+    profile = {
+        'id': next(profile_ids),
+        'time': timezone.now(),
+        'method': request.method,
+        'path': request.get_full_path(),
+        'status': response.status_code,
+        'user': str(getattr(request, 'user', '')),
+        'duration': duration,
+        'reason': reason,
+        'query_count': trace.count if trace is not None else None,
+        'query_time': trace.total if trace is not None else None,
+        'queries': trace.queries if trace is not None else [],
+        'stacks': stacks or Counter(),
+    }
+    profiles.append(profile)
+    return profile
+
+
+def call_tree(stacks, min_share=0.005):
+    """
+    Дерево вызовов из стеков: строки (глубина, функция, выборок, доля)
+    в порядке обхода; ветви меньше min_share от всех выборок отбрасываются.
+    """
+    total = sum(stacks.values())
+    root = {}
+    for stack, count in stacks.items():
+        node = root
+        for name in stack:
+            entry = node.setdefault(name, [0, {}])
+            entry[0] += count
+            node = entry[1]
+
+    rows = []
+
+    def walk(node, depth):
+        for name, (count, children) in sorted(node.items(), key=lambda item: -item[1][0]):
+            if count < total * min_share:
+                continue
+            rows.append((depth, name, count, 100.0 * count / total))
+            walk(children, depth + 1)
+
+    if total:
+        walk(root, 0)
+    return rows
+
+
+def collapsed(stacks):
+    """
+    Стеки в формате "a;b;c число" для flamegraph.pl и speedscope.
+    """
+    return ''.join('%s %d\n' % (';'.join(stack), count) for stack, count in stacks.items())
+
+
+def find_profile(pk):
+    for profile in list(profiles):
+        if profile['id'] == pk:
+            return profile
+    raise Http404('Профиль не найден (буфер хранит последние %d)' % profiles.maxlen)
+
+
+@staff_member_required
+def profile_list(request):
+    return render(request, 'admin/fm/profiles.html', {
+        'title': 'Профили запросов',
+        'profiles': reversed(list(profiles)),
+    })
+
+
+@staff_member_required
+def profile_detail(request, pk):
+    profile = find_profile(pk)
+    if request.GET.get('format') == 'collapsed':
+        response = HttpResponse(collapsed(profile['stacks']), content_type='text/plain; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="profile-%d.txt"' % pk
+        return response
+    return render(request, 'admin/fm/profile.html', {
+        'title': 'Профиль %s %s' % (profile['method'], profile['path']),
+        'profile': profile,
+        'samples': sum(profile['stacks'].values()),
+        'tree': call_tree(profile['stacks']),
+        'queries': [(sql, elapsed * 1000) for sql, elapsed in profile['queries']],
+    })
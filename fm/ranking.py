@@ -0,0 +1,70 @@
+import math
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+
+from fm.models import Post, Comment
+
+# Точка отсчета для временной составляющей рейтинга
+HOT_EPOCH = datetime(2018, 1, 1)
+
+# Вес каждого вида активности
+HOT_WEIGHTS = {'likes': 1.0, 'comments': 2.0, 'follows': 1.5}
+
+# За сколько секунд новизна "стоит" порядок (x10) активности
+HOT_DECAY = 45000
+
+
+def hot_score(created, likes=0, comments=0, follows=0):
+    """
+    Рейтинг "горячих" постов.
+
+    Логарифм взвешенной активности плюс время создания: каждые HOT_DECAY
+    секунд новизны равны десятикратному росту активности. Рейтинг не меняется
+    со временем сам по себе, поэтому его можно хранить в индексируемой колонке
+    и пересчитывать только при изменении активности.
+    """
+    weights = getattr(settings, 'FM_HOT_WEIGHTS', HOT_WEIGHTS)
+    decay = getattr(settings, 'FM_HOT_DECAY', HOT_DECAY)
+
+    activity = weights['likes'] * likes + weights['comments'] * comments + \
+        weights['follows'] * follows
+    order = math.log10(max(activity, 1))
+
+    if timezone.is_aware(created):
+        created = timezone.make_naive(created, timezone.utc)
+    seconds = (created - HOT_EPOCH).total_seconds()
+
+    return round(order + seconds / decay, 7)
+
+
+def _counts(model, post_ids):
+    rows = model.objects.filter(post_id__in=post_ids).order_by() \
+        .values_list('post_id').annotate(num=Count('pk'))
+    return dict(rows)
+
+
+def refresh_hot(post_ids):
+    """
+    Пересчитывает рейтинг указанных постов по текущим счетчикам.
+    Три агрегирующих запроса вместо JOIN с Count(distinct).
+    """
+    post_ids = list(post_ids)
+    if not post_ids:
+        return 0
+
+    likes = _counts(Post.likes.through, post_ids)
+    follows = _counts(Post.follows.through, post_ids)
+    comments = _counts(Comment, post_ids)
+
+    posts = Post.objects.filter(pk__in=post_ids).values_list('pk', 'created', 'hot')
+    updated = 0
+    for pk, created, old in posts:
+        score = hot_score(created, likes=likes.get(pk, 0),
+            comments=comments.get(pk, 0), follows=follows.get(pk, 0))
+        if score != old:
+            Post.objects.filter(pk=pk).update(hot=score)
+            updated += 1
+    return updated
@@ -0,0 +1,54 @@
+from array import array
+
+from django.conf import settings
+
+from fm.models import Post, PostNeighbors
+
+
+def pack(ids, scores):
+    """
+    Соседи поста в виде байтов: массив uint32 id, за ним массив float32 оценок.
+    """
+    return array('I', ids).tobytes() + array('f', scores).tobytes()
+
+
+def unpack(data, count):
+    ids = array('I')
+    ids.frombytes(bytes(data[:count * 4]))
+    scores = array('f')
+    scores.frombytes(bytes(data[count * 4:count * 8]))
+    return ids, scores
+
+
+def neighbors(post_id):
+    """
+    [(id, оценка)] похожих постов по убыванию оценки.
+    """
+    row = PostNeighbors.objects.filter(pk=post_id).values_list('count', 'data').first()
+    if row is None:
+        return []
+    return list(zip(*unpack(row[1], row[0])))
+
+
+def recommended(user_id, limit):
+    """
+    id постов для пользователя по убыванию суммы оценок: соседи его
+    последних FM_RECOMMEND_SEEDS лайков, кроме уже понравившихся и своих.
+    """
+    seeds = list(Post.likes.through.objects.filter(user_id=user_id).order_by('-id')
+        .values_list('post_id', flat=True)[:getattr(settings, 'FM_RECOMMEND_SEEDS', 20)])
+    if not seeds:
+        return []
+
+    scores = {}
+    for count, data in PostNeighbors.objects.filter(pk__in=seeds).values_list('count', 'data'):
+        for post_id, score in zip(*unpack(data, count)):
+            scores[post_id] = scores.get(post_id, 0.0) + score
+
+    exclude = set(Post.likes.through.objects.filter(user_id=user_id, post_id__in=list(scores))
+        .values_list('post_id', flat=True))
+    exclude.update(Post.objects.filter(author_id=user_id, pk__in=list(scores))
+        .values_list('pk', flat=True))
+    ranked = sorted((post_id for post_id in scores if post_id not in exclude),
+        key=lambda post_id: -scores[post_id])
+    return ranked[:limit]
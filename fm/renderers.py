@@ -0,0 +1,95 @@
+import datetime
+import decimal
+import uuid
+
+import msgpack
+
+from django.conf import settings
+from django.db.models.fields.files import FieldFile
+from django.db.models.query import QuerySet
+from django.utils.encoding import force_str
+from django.utils import timezone
+from django.utils.functional import Promise
+from rest_framework import ISO_8601
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer
+from rest_framework.settings import api_settings
+
+# MessagePack для мобильных клиентов: выбирается заголовками
+# Accept/Content-Type: application/msgpack (см. REST_FRAMEWORK в settings).
+# Сериализаторы уже отдают даты строками в DATETIME_FORMAT и абсолютные адреса
+# картинок; default() приводит к тем же видам то, что передано в Response
+# напрямую, как это делает JSONEncoder DRF.
+
+
+def format_value(value, output_format):
+    if output_format is None or isinstance(value, str):
+        return value
+    if output_format.lower() == ISO_8601:
+        value = value.isoformat()
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+    return value.strftime(output_format)
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        request = (renderer_context or {}).get('request')
+
+        def default(value):
+            if isinstance(value, datetime.datetime):
+                return format_value(value, api_settings.DATETIME_FORMAT)
+            if isinstance(value, datetime.date):
+                return format_value(value, api_settings.DATE_FORMAT)
+            if isinstance(value, datetime.time):
+                return format_value(value, api_settings.TIME_FORMAT)
+            if isinstance(value, datetime.timedelta):
+                return str(value.total_seconds())
+            if isinstance(value, decimal.Decimal):
+                return str(value) if api_settings.COERCE_DECIMAL_TO_STRING else float(value)
+            if isinstance(value, (uuid.UUID, Promise)):
+                return force_str(value)
+            if isinstance(value, FieldFile):
+                if not value:
+                    return None
+                return request.build_absolute_uri(value.url) if request is not None else value.url
+            if isinstance(value, QuerySet):
+                return list(value)
+            if isinstance(value, (set, frozenset)):
+                return list(value)
+            raise TypeError('Object of type %s is not MessagePack serializable' % type(value).__name__)
+
+        return msgpack.packb(data, default=default, use_bin_type=True)
+
+
+def make_naive(value):
+    """
+    Даты из расширения Timestamp приходят в UTC; при USE_TZ = False
+    приводятся к местному времени без зоны, как остальные даты проекта.
+    """
+    if isinstance(value, datetime.datetime):
+        return timezone.make_naive(value)
+    if isinstance(value, dict):
+        return {key: make_naive(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [make_naive(item) for item in value]
+    return value
+
+
+class MessagePackParser(BaseParser):
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            # Расширение Timestamp MessagePack приходит как datetime
+            data = msgpack.unpackb(stream.read(), raw=False, timestamp=3, strict_map_key=False)
+        except ValueError as e:
+            raise ParseError('MessagePack parse error - %s' % e)
+        return data if settings.USE_TZ else make_naive(data)
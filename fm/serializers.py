@@ -1,7 +1,9 @@
 from django.conf import settings
-from django.core.mail import send_mail
+from django.db import models
 from rest_framework import serializers
-from fm.models import User, Post, Friend, Comment, Tag, City
+from fm.models import User, Post, Friend, Comment, Tag, City, Unread
+from fm.helpers import filter_ordered
+from fm import fragments, outbox, textindex
 
 class CreatableSlugRelatedField(serializers.SlugRelatedField):
     """
@@ -64,7 +66,35 @@ class AuthorSerializer(serializers.ModelSerializer):
         model = User
         fields = ('name', 'profile_photo')
 
-class PostSerializer(serializers.ModelSerializer):
+class DynamicFieldsMixin(object):
+    """
+    Принимает необязательные аргументы fields (оставить только эти поля)
+    и embed (из вложенных списков Meta.embedded_fields оставить только эти).
+    """
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        embed = kwargs.pop('embed', None)
+        super(DynamicFieldsMixin, self).__init__(*args, **kwargs)
+
+        drop = set()
+        if fields is not None:
+            drop.update(set(self.fields) - set(fields) - {'id'})
+        if embed is not None:
+            drop.update(set(getattr(self.Meta, 'embedded_fields', ())) - set(embed))
+        for name in drop:
+            self.fields.pop(name, None)
+
+class PostListSerializer(serializers.ListSerializer):
+    """
+    С context['fragments'] строки собираются из кэша фрагментов (fm.fragments).
+    """
+    def to_representation(self, data):
+        if not self.context.get('fragments'):
+            return super(PostListSerializer, self).to_representation(data)
+        posts = data.all() if isinstance(data, models.Manager) else data
+        return fragments.render(list(posts), self.child)
+
+class PostSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     isMy = serializers.SerializerMethodField()
     countLike = serializers.IntegerField(read_only=True)
     isLike = serializers.BooleanField(read_only=True)
@@ -82,7 +112,8 @@ class PostSerializer(serializers.ModelSerializer):
         request = self.context.get("request")
         if request and hasattr(request, "user"):
             user = request.user
-        return obj.author == user
+        # Сравнение по id не загружает автора, если поле author не запрошено
+        return user is not None and obj.author_id == user.pk
 
     def get_isBest(self, obj):
         best_note = self.context.get("best_note")
@@ -94,6 +125,7 @@ class PostSerializer(serializers.ModelSerializer):
             'created', 'isMy', 'countLike', 'isLike', 'countComnt',
             'isFollow', 'isBest', 'tags', 'city', 'author')
         read_only_fields = ('id', 'created')
+        list_serializer_class = PostListSerializer
 
 class CommentSerializer(serializers.ModelSerializer):
     isMy = serializers.SerializerMethodField()
@@ -132,13 +164,27 @@ class CitySerializer(serializers.ModelSerializer):
         model = City
         fields = ('name', )
 
+class UnreadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Unread
+        fields = ('feed', 'comments')
+
 class PostExtendedSerializer(PostSerializer):
     comments = serializers.SerializerMethodField()
     notes = serializers.SerializerMethodField()
     countSimilar = serializers.SerializerMethodField()
     similar = serializers.SerializerMethodField()
 
-    def get_comments(self, obj):
+    def to_representation(self, obj):
+        # Вложенные части вычисляются заранее, поля ниже только возвращают
+        # результат. Не запрошенные через ?fields=/?embed= не вычисляются вовсе
+        self.extended = {
+            name: getattr(self, 'fetch_' + name)(obj)
+            for name in self.Meta.embedded_fields if name in self.fields
+        }
+        return super(PostExtendedSerializer, self).to_representation(obj)
+
+    def fetch_comments(self, obj):
         if obj.typeContent == Post.QUESTION:
             return None
         comments = obj.post_comments.all()[0:3]
@@ -146,7 +192,7 @@ class PostExtendedSerializer(PostSerializer):
             context=self.context, many=True, read_only=True)
         return serializer.data
 
-    def get_notes(self, obj):
+    def fetch_notes(self, obj):
         if obj.typeContent in [Post.POSITIVE, Post.NEGATIVE]:
             return None
         posts = Post.objects.filter(note__post=obj)[0:3]
@@ -154,18 +200,37 @@ class PostExtendedSerializer(PostSerializer):
             context=self.context, many=True, read_only=True)
         return serializer.data
 
-    def get_similar(self, obj):
-        tags = obj.tags.all()
-        posts = Post.objects.filter(tags__in=tags).exclude(pk=obj.pk).distinct()[0:3]
+    def fetch_similar(self, obj):
+        found = textindex.similar(obj.pk)
+        if found:
+            posts = filter_ordered(Post.objects.all(), [pk for pk, _ in found[0:3]])
+        else:
+            tags = obj.tags.all()
+            posts = Post.objects.filter(tags__in=tags).exclude(pk=obj.pk).distinct()[0:3]
         serializer = PostSerializer(posts,
             context=self.context, many=True, read_only=True)
         return serializer.data
 
-    def get_countSimilar(self, obj):
+    def fetch_countSimilar(self, obj):
+        found = textindex.similar(obj.pk)
+        if found:
+            return len(found)
         tags = obj.tags.all()
         num = Post.objects.filter(tags__in=tags).exclude(pk=obj.pk).distinct().count()
         return num
 
+    def get_comments(self, obj):
+        return self.extended['comments']
+
+    def get_notes(self, obj):
+        return self.extended['notes']
+
+    def get_similar(self, obj):
+        return self.extended['similar']
+
+    def get_countSimilar(self, obj):
+        return self.extended['countSimilar']
+
     class Meta:
         model = Post
         fields = ('id', 'typeContent', 'title', 'description', 'image',
@@ -173,6 +238,7 @@ class PostExtendedSerializer(PostSerializer):
             'isFollow', 'isBest', 'tags', 'author', 'comments', 'notes',
             'countSimilar', 'similar')
         read_only_fields = ('id', 'created')
+        embedded_fields = ('comments', 'notes', 'similar', 'countSimilar')
 
 class NoteSerializer(serializers.ModelSerializer):
     note = PostSerializer(read_only=True)
@@ -208,7 +274,7 @@ class PasswordResetSerializer(serializers.Serializer):
         user = User.objects.get(email=self.validated_data['email'])
         password = User.objects.make_random_password()
         user.set_password(password)
-        user.save()
+        user.save(update_fields=['password'])
 
         subject = 'Восстановление пароля'
         message = 'Здравствуйте, {0}!\n\nВаш новый пароль: {1}\n\n--\n\nС уважением,\nВаш Friendmarket'. \
@@ -216,4 +282,4 @@ class PasswordResetSerializer(serializers.Serializer):
 
         email_from = getattr(settings, 'DEFAULT_FROM_EMAIL')
 
-        send_mail(subject, message, email_from, [user.email], fail_silently=True)
+        outbox.enqueue(subject, message, email_from, [user.email])
@@ -1,17 +1,23 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 from django.dispatch import receiver
-from django.db.models import Q
 from django.conf import settings
-from django.core.mail import send_mail
 
 import json
 from urllib.request import Request, urlopen
 
-from fm.models import User, Post, Comment
+from fm import duplicates, outbox, prefix, subscribers, textindex, unread, versions
+from fm.cache import cache
+from fm.models import User, Post, Friend, Comment, Tag, City, MediaFile, Subscriber
+from fm.ranking import hot_score, refresh_hot
+
+FCM_URL = "https://fcm.googleapis.com/fcm/send"
+FCM_KEY = "AAAA521LTfA:APA91bFiWuoIlaMAXFW29x5AYGDNm4ROt4Sc0Q3hQ6mnoV5Ekj8Edy366JVM7RVWcI3hIsrcPuEQkHayFFDeF10ELlxAdV5C28vjhOQg-3qnoSOS5hDmaD40QbOvFdDzKUsWPlzBEhA7"
+# Не больше registration_ids в одном запросе к FCM
+FCM_BATCH = 1000
 
 def fcm_send(data):
-    url = "https://fcm.googleapis.com/fcm/send"
-    key = "AAAA521LTfA:APA91bFiWuoIlaMAXFW29x5AYGDNm4ROt4Sc0Q3hQ6mnoV5Ekj8Edy366JVM7RVWcI3hIsrcPuEQkHayFFDeF10ELlxAdV5C28vjhOQg-3qnoSOS5hDmaD40QbOvFdDzKUsWPlzBEhA7"
+    url = FCM_URL
+    key = FCM_KEY
 
     request = json.dumps(data, separators=(",", ":")).encode("utf-8")
 
@@ -30,28 +36,27 @@ def notify_comment(sender, instance, created, **kwargs):
     if not created:
     	return None
 
-    # Находим всех кто следит за этим постом + владельца поста;
-    # выбираем только тех у кого включены оповещения и исключаем автора комментария;
-    # исключаем тех у кого нет registration_id от FireBase (вдруг есть такие);
-    # без сортировки, только неповторяющиеся, списком токенов
-    filt = Q(post_follows=instance.post) | Q(pk=instance.post.author_id)
+    # Пост, автора, рекомендацию и родительский комментарий получаем одним запросом
+    comment = Comment.objects.select_related('post', 'author', 'note', 'parent__author') \
+        .get(pk=instance.pk)
 
-    if instance.parent is not None:
-        # Сообщение об ответе на коментарий
-        filt |= Q(pk=instance.parent.author_id)
+    # Подписчики поста (следящие за ним + владелец) с включенными оповещениями,
+    # кроме автора комментария - одно чтение по индексу
+    ids = subscribers.post_recipients(comment.post_id, exclude=comment.author_id)
 
-    ids = User.objects.filter(filt) \
-        .filter(enable_notif=True).exclude(pk=instance.author_id) \
-        .exclude(android_regid__exact='').exclude(android_regid__isnull=True) \
-        .order_by().distinct().values_list('android_regid', flat=True)
+    if comment.parent is not None:
+        # Сообщение об ответе на коментарий
+        parent_author = comment.parent.author
+        if parent_author.pk != comment.author_id and subscribers.is_notifiable(parent_author):
+            ids.add(parent_author.android_regid)
 
     if not ids:
         return None
 
-    body = "{}: {}".format(instance.author.get_full_name(),
-        instance.note.title if instance.post.typeContent is Post.QUESTION else 
-        instance.comment)
-    data = {"title": instance.post.title, "body": body, "post": instance.post.pk, "comment": instance.pk}
+    body = "{}: {}".format(comment.author.get_full_name(),
+        comment.note.title if comment.post.typeContent == Post.QUESTION and comment.note else 
+        comment.comment)
+    data = {"title": comment.post.title, "body": body, "post": comment.post_id, "comment": comment.pk}
     payload = {"registration_ids": list(ids), "data": data}
 
     if settings.DEBUG:
@@ -65,14 +70,11 @@ def notify_post(sender, instance, created, **kwargs):
     if not created:
         return None
 
-    # Находим всех пользователей которые следят за автором поста
-    # выбираем из них тех у кого включены оповещения;
-    # исключаем тех у кого нет registration_id от FireBase (вдруг есть такие);
-    # без сортировки, только неповторяющиеся, списком токенов
-    ids = User.objects.filter(my_friends__friend=instance.author, my_friends__follow=True) \
-        .filter(enable_notif=True) \
-        .exclude(android_regid__exact='').exclude(android_regid__isnull=True) \
-        .order_by().distinct().values_list('android_regid', flat=True)
+    # Автор следит за комментариями к своему посту
+    subscribers.subscribe([instance.author_id], post_id=instance.pk)
+
+    # Все пользователи, которые следят за автором поста, с включенными оповещениями
+    ids = subscribers.author_recipients(instance.author_id)
 
     if not ids:
         return None
@@ -96,4 +98,280 @@ def send_greetings(sender, instance, created, **kwargs):
 
     email_from = getattr(settings, 'DEFAULT_FROM_EMAIL')
 
-    send_mail(subject, message, email_from, [instance.email], fail_silently=True)
+    outbox.enqueue(subject, message, email_from, [instance.email])
+
+@receiver(post_save, sender=Post)
+def init_hot(sender, instance, created, **kwargs):
+    if not created:
+        return None
+
+    instance.hot = hot_score(instance.created)
+    Post.objects.filter(pk=instance.pk).update(hot=instance.hot)
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def comment_hot(sender, instance, created=True, **kwargs):
+    if not created:
+        return None
+
+    refresh_hot([instance.post_id])
+
+@receiver(m2m_changed, sender=Post.likes.through)
+@receiver(m2m_changed, sender=Post.follows.through)
+def activity_hot(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return None
+
+    # При изменении со стороны пользователя pk_set содержит id постов;
+    # очистку со стороны пользователя догонит периодический пересчет
+    if not reverse:
+        refresh_hot([instance.pk])
+    elif pk_set:
+        refresh_hot(pk_set)
+
+# Поля с файлами, для которых ведется счетчик ссылок в MediaFile
+MEDIA_FIELDS = {User: 'profile_photo', Post: 'image'}
+
+def media_refs(name, delta):
+    MediaFile.objects.add_refs(name, delta)
+
+@receiver(pre_save, sender=User)
+@receiver(pre_save, sender=Post)
+def media_remember(sender, instance, update_fields=None, **kwargs):
+    field = MEDIA_FIELDS[sender]
+    instance._media_old = None
+    if instance._state.adding or (update_fields is not None and field not in update_fields):
+        return None
+
+    instance._media_old = sender.objects.filter(pk=instance.pk) \
+        .values_list(field, flat=True).first()
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Post)
+def media_count(sender, instance, created, update_fields=None, **kwargs):
+    field = MEDIA_FIELDS[sender]
+    if not created and update_fields is not None and field not in update_fields:
+        return None
+
+    old = getattr(instance, '_media_old', None)
+    new = getattr(instance, field).name
+    if old != new:
+        media_refs(new, 1)
+        media_refs(old, -1)
+
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Post)
+def media_release(sender, instance, **kwargs):
+    media_refs(getattr(instance, MEDIA_FIELDS[sender]).name, -1)
+
+@receiver(m2m_changed, sender=Post.follows.through)
+def follows_subscribers(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add' or action == 'post_remove':
+        change = subscribers.subscribe if action == 'post_add' else subscribers.unsubscribe
+        if not reverse:
+            change(pk_set, post_id=instance.pk)
+        else:
+            for post_id in pk_set:
+                change([instance.pk], post_id=post_id)
+    elif action == 'post_clear':
+        # Подписка автора на свой пост не зависит от отслеживания
+        if not reverse:
+            Subscriber.objects.filter(post=instance).exclude(user_id=instance.author_id).delete()
+        else:
+            Subscriber.objects.filter(user=instance, post__isnull=False) \
+                .exclude(post__author=instance).delete()
+
+@receiver(post_save, sender=Friend)
+def friend_subscribers(sender, instance, **kwargs):
+    change = subscribers.subscribe if instance.follow else subscribers.unsubscribe
+    change([instance.author_id], author_id=instance.friend_id)
+
+@receiver(post_delete, sender=Friend)
+def friend_unsubscribe(sender, instance, **kwargs):
+    subscribers.unsubscribe([instance.author_id], author_id=instance.friend_id)
+
+@receiver(pre_save, sender=User)
+def notif_remember(sender, instance, update_fields=None, **kwargs):
+    instance._notif_old = None
+    if instance._state.adding:
+        return None
+    if update_fields is not None and not {'enable_notif', 'android_regid'} & set(update_fields):
+        return None
+
+    instance._notif_old = User.objects.filter(pk=instance.pk) \
+        .values_list('enable_notif', 'android_regid').first()
+
+@receiver(post_save, sender=User)
+def notif_subscribers(sender, instance, created, **kwargs):
+    old = getattr(instance, '_notif_old', None)
+    if created or old is None or old == (instance.enable_notif, instance.android_regid):
+        return None
+
+    was_notifiable = bool(old[0] and old[1])
+    if was_notifiable and subscribers.is_notifiable(instance):
+        Subscriber.objects.filter(user=instance).update(android_regid=instance.android_regid)
+    else:
+        subscribers.resync_user(instance)
+
+@receiver(post_save, sender=Post)
+def unread_post(sender, instance, created, **kwargs):
+    if created:
+        unread.increment(unread.feed_readers(instance), unread.FEED)
+
+@receiver(post_save, sender=Comment)
+def unread_comment(sender, instance, created, **kwargs):
+    if created:
+        unread.increment(unread.comment_readers(instance), unread.COMMENTS)
+
+# Индексы автодополнения (fm.prefix) обновляются точечно в текущем процессе;
+# в остальных процессах изменения появятся после перестроения по FM_PREFIX_TTL
+
+@receiver(post_save, sender=Tag)
+def prefix_tag(sender, instance, **kwargs):
+    prefix.tags.put(instance.pk, instance.tag)
+
+@receiver(post_save, sender=City)
+def prefix_city(sender, instance, **kwargs):
+    prefix.cities.put(instance.pk, instance.name)
+
+@receiver(post_save, sender=User)
+def prefix_user(sender, instance, **kwargs):
+    if instance.is_active and not instance.is_staff:
+        prefix.users.put(instance.pk, instance.get_full_name())
+    else:
+        prefix.users.remove(instance.pk)
+
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=City)
+@receiver(post_delete, sender=User)
+def prefix_remove(sender, instance, **kwargs):
+    index = {Tag: prefix.tags, City: prefix.cities, User: prefix.users}[sender]
+    index.remove(instance.pk)
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def prefix_tag_weight(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove') or reverse:
+        return None
+    for tag_id in pk_set:
+        prefix.tags.add_weight(tag_id, 1 if action == 'post_add' else -1)
+
+@receiver(post_save, sender=Post)
+def prefix_city_weight(sender, instance, created, **kwargs):
+    if created and instance.city_id:
+        prefix.cities.add_weight(instance.city_id, 1)
+
+@receiver(post_save, sender=Friend)
+@receiver(post_delete, sender=Friend)
+def prefix_user_weight(sender, instance, **kwargs):
+    followers = Friend.objects.filter(friend_id=instance.friend_id, follow=True).count()
+    prefix.users.set_weight(instance.friend_id, followers)
+
+# Версия поста для ETag (fm.mixins.ConditionalMixin)
+
+@receiver(post_save, sender=Post)
+def version_post(sender, instance, created, **kwargs):
+    if not created:
+        versions.bump([instance.pk])
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def version_comment(sender, instance, **kwargs):
+    versions.bump([instance.post_id])
+
+@receiver(m2m_changed, sender=Post.likes.through)
+@receiver(m2m_changed, sender=Post.follows.through)
+@receiver(m2m_changed, sender=Post.tags.through)
+def version_relations(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return None
+    if not reverse:
+        versions.bump([instance.pk])
+    elif pk_set:
+        versions.bump(pk_set)
+
+# Сброс двухуровневого кэша (fm.cache): пространства "posts", "comments", "tags",
+# "cities", "users" - списки, "post:<id>" и "user:<id>" - отдельные объекты,
+# "fragments" - общие части постов в списках
+
+AUTHOR_FIELDS = ('first_name', 'last_name', 'profile_photo')
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def cache_post(sender, instance, **kwargs):
+    cache.invalidate('posts', 'post:%d' % instance.pk)
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def cache_comment(sender, instance, **kwargs):
+    cache.invalidate('comments', 'post:%d' % instance.post_id)
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def cache_tag(sender, instance, created=False, **kwargs):
+    cache.invalidate('tags')
+    # Новый тег (CreatableSlugRelatedField) еще не входит ни в один фрагмент
+    if not created:
+        cache.invalidate('fragments')
+
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+def cache_city(sender, instance, created=False, **kwargs):
+    cache.invalidate('cities')
+    if not created:
+        cache.invalidate('fragments')
+
+@receiver(post_save, sender=Friend)
+@receiver(post_delete, sender=Friend)
+def cache_friend(sender, instance, **kwargs):
+    cache.invalidate('user:%d' % instance.author_id, 'user:%d' % instance.friend_id)
+
+@receiver(pre_save, sender=User)
+def cache_user_remember(sender, instance, update_fields=None, **kwargs):
+    instance._author_old = None
+    if instance._state.adding:
+        return None
+    if update_fields is not None and not set(AUTHOR_FIELDS) & set(update_fields):
+        return None
+
+    instance._author_old = User.objects.filter(pk=instance.pk) \
+        .values_list(*AUTHOR_FIELDS).first()
+
+@receiver(post_save, sender=User)
+def cache_user(sender, instance, **kwargs):
+    cache.invalidate('users', 'user:%d' % instance.pk)
+    # Имя и фото автора входят во фрагменты его постов (fm.fragments): сбрасываем
+    # их, только если эти поля изменились, а не при любом сохранении (вход в систему)
+    old = getattr(instance, '_author_old', None)
+    if old is not None and old != (instance.first_name, instance.last_name, instance.profile_photo.name):
+        cache.invalidate('fragments')
+
+@receiver(post_delete, sender=User)
+def cache_user_delete(sender, instance, **kwargs):
+    cache.invalidate('users', 'user:%d' % instance.pk, 'fragments')
+
+@receiver(m2m_changed, sender=Post.likes.through)
+@receiver(m2m_changed, sender=Post.follows.through)
+@receiver(m2m_changed, sender=Post.tags.through)
+def cache_relations(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return None
+    post_ids = (pk_set or ()) if reverse else [instance.pk]
+    cache.invalidate('posts', *['post:%d' % pk for pk in post_ids])
+
+# Индекс похожих по тексту постов (fm.textindex)
+
+@receiver(post_save, sender=Post)
+def text_index(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'title', 'description'} & set(update_fields):
+        textindex.update(instance)
+
+@receiver(post_delete, sender=Post)
+def text_index_remove(sender, instance, **kwargs):
+    textindex.remove(instance.pk)
+
+# Поиск дубликатов вопросов (fm.duplicates)
+
+@receiver(post_save, sender=Post)
+def duplicates_index(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'title', 'description', 'typeContent'} & set(update_fields):
+        duplicates.index(instance)
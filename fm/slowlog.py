@@ -0,0 +1,152 @@
+import hashlib
+import logging
+import re
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.shortcuts import render
+from django.utils import timezone
+
+logger = logging.getLogger('fm.slowlog')
+
+# Статистика медленных запросов этого процесса по отпечаткам
+queries = {}
+lock = threading.Lock()
+local = threading.local()
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+PARAM_RE = re.compile(r'%s|\?')
+LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+SPACE_RE = re.compile(r'\s+')
+
+EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+
+def normalize(sql):
+    """
+    SQL без значений: строки, числа и параметры заменяются на ?,
+    списки IN (?, ?, ...) - на (...).
+    """
+    sql = STRING_RE.sub('?', sql)
+    sql = NUMBER_RE.sub('?', sql)
+    sql = PARAM_RE.sub('?', sql)
+    sql = LIST_RE.sub('(...)', sql)
+    return SPACE_RE.sub(' ', sql).strip()
+
+
+def fingerprint(sql):
+    return hashlib.sha1(normalize(sql).encode('utf-8')).hexdigest()[:12]
+
+
+def caller():
+    """
+    (представление, место вызова): класс представления или ModelAdmin
+    и первая строка кода проекта в стеке.
+    """
+    site = view = None
+    frame = sys._getframe(2)
+    while frame is not None:
+        path = frame.f_code.co_filename
+        if site is None and path.startswith(settings.BASE_DIR) and path != __file__ \
+                and 'site-packages' not in path:
+            site = '%s:%d %s' % (path[len(settings.BASE_DIR) + 1:], frame.f_lineno, frame.f_code.co_name)
+        owner = frame.f_locals.get('self')
+        if owner is not None and (hasattr(owner, 'as_view') or hasattr(owner, 'changelist_view')):
+            view = owner.__class__.__name__
+            break
+        frame = frame.f_back
+    return view or '-', site or '-'
+
+
+def explain(connection, sql, params):
+    prefix = EXPLAIN.get(connection.vendor)
+    if prefix is None or not sql.lstrip().upper().startswith('SELECT'):
+        return ''
+    # Отдельный курсор: результат исходного запроса еще не прочитан
+    local.explaining = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            return '\n'.join(' '.join(str(value) for value in row) for row in cursor.fetchall())
+    except Exception as e:
+        return 'EXPLAIN failed: %s' % e
+    finally:
+        local.explaining = False
+
+
+def slow_query_wrapper(execute, sql, params, many, context):
+    """
+    Обертка выполнения SQL для всех соединений (см. FmConfig.ready):
+    запросы дольше FM_SLOW_QUERY сек. попадают в журнал и в статистику
+    по отпечатку, для каждого нового отпечатка один раз снимается план.
+    """
+    if getattr(local, 'explaining', False):
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    result = execute(sql, params, many, context)
+    elapsed = time.perf_counter() - started
+    if elapsed >= getattr(settings, 'FM_SLOW_QUERY', 0.2):
+        record(context['connection'], sql, None if many else params, elapsed)
+    return result
+
+
+def record(connection, sql, params, elapsed):
+    key = fingerprint(sql)
+    view, site = caller()
+    logger.warning('Slow query %s (%.1f ms) in %s at %s: %s', key, elapsed * 1000, view, site, sql[:1000])
+
+    with lock:
+        entry = queries.get(key)
+        if entry is None:
+            if len(queries) >= getattr(settings, 'FM_SLOW_QUERY_MAX', 500):
+                return
+            entry = queries[key] = {
+                'fingerprint': key, 'sql': normalize(sql), 'plan': None,
+                'count': 0, 'total': 0.0, 'max': 0.0, 'views': {}, 'sites': {},
+            }
+        entry['count'] += 1
+        entry['total'] += elapsed
+        entry['max'] = max(entry['max'], elapsed)
+        entry['last'] = timezone.now()
+        entry['views'][view] = entry['views'].get(view, 0) + 1
+        entry['sites'][site] = entry['sites'].get(site, 0) + 1
+        need_plan = entry['plan'] is None
+        if need_plan:
+            entry['plan'] = ''
+
+    if need_plan and params is not None:
+        entry['plan'] = explain(connection, sql, params)
+
+
+def install(connection, **kwargs):
+    if slow_query_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(slow_query_wrapper)
+
+
+@staff_member_required
+def slow_query_report(request):
+    order = request.GET.get('o', 'total')
+    if order not in ('total', 'count', 'max'):
+        order = 'total'
+    with lock:
+        entries = [dict(entry, views=dict(entry['views']), sites=dict(entry['sites']))
+            for entry in queries.values()]
+    for entry in entries:
+        entry['avg'] = entry['total'] / entry['count']
+        entry['views'] = sorted(entry['views'].items(), key=lambda item: -item[1])
+        entry['sites'] = sorted(entry['sites'].items(), key=lambda item: -item[1])
+    entries.sort(key=lambda entry: -entry[order])
+    return render(request, 'admin/fm/slow_queries.html', {
+        'title': 'Медленные SQL-запросы',
+        'entries': entries,
+        'threshold': getattr(settings, 'FM_SLOW_QUERY', 0.2) * 1000,
+    })
@@ -0,0 +1,34 @@
+import os
+import posixpath
+import uuid
+
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage
+
+from fm.helpers import file_digest
+
+
+class HashedFileSystemStorage(FileSystemStorage):
+    """
+    Хранилище, в котором имя файла - это хэш его содержимого.
+    Одинаковые файлы хранятся один раз: повторная запись не выполняется.
+    Каждый файл учитывается в MediaFile для подсчета ссылок.
+    """
+    def get_available_name(self, name, max_length=None):
+        # Одинаковое имя означает одинаковое содержимое, суффиксы не нужны
+        return name
+
+    def _save(self, name, content):
+        dirname = posixpath.dirname(name)
+        ext = os.path.splitext(name)[1].lower()
+        name = posixpath.join(dirname, file_digest(content) + ext)
+        apps.get_model('fm', 'MediaFile').objects.get_or_create(name=name)
+        if self.exists(name):
+            return name
+
+        # Пишем во временный файл и атомарно переименовываем,
+        # чтобы параллельная запись того же файла была безопасной
+        tmp = super(HashedFileSystemStorage, self)._save(
+            posixpath.join(dirname, '.%s.tmp' % uuid.uuid4().hex), content)
+        os.replace(self.path(tmp), self.path(name))
+        return name
@@ -0,0 +1,58 @@
+from django.db.models import Q
+
+from fm.models import User, Post, Friend, Subscriber
+
+# Пользователи, которым можно отправлять уведомления
+NOTIFIABLE = Q(enable_notif=True) & ~Q(android_regid='') & Q(android_regid__isnull=False)
+
+
+def is_notifiable(user):
+    return bool(user.enable_notif and user.android_regid)
+
+
+def subscribe(user_ids, post_id=None, author_id=None):
+    # get_or_create: одновременная подписка того же пользователя
+    # упирается в unique_together и находит уже созданную запись
+    users = User.objects.filter(NOTIFIABLE, pk__in=user_ids).values_list('pk', 'android_regid')
+    for pk, regid in users:
+        Subscriber.objects.get_or_create(user_id=pk, post_id=post_id, author_id=author_id,
+            defaults={'android_regid': regid})
+
+
+def unsubscribe(user_ids, post_id=None, author_id=None):
+    Subscriber.objects.filter(user_id__in=user_ids, post_id=post_id, author_id=author_id).delete()
+
+
+def subscriptions_of(user_id):
+    """
+    Все подписки пользователя по исходным данным: свои и отслеживаемые
+    посты, отслеживаемые авторы.
+    """
+    posts = set(Post.follows.through.objects.filter(user_id=user_id).values_list('post_id', flat=True))
+    posts.update(Post.objects.filter(author_id=user_id).values_list('pk', flat=True))
+    authors = Friend.objects.filter(author_id=user_id, follow=True).values_list('friend_id', flat=True)
+    return [(post_id, None) for post_id in posts] + [(None, author_id) for author_id in authors]
+
+
+def resync_user(user):
+    """
+    Пересоздает подписки пользователя после изменения настроек уведомлений.
+    """
+    Subscriber.objects.filter(user=user).delete()
+    if not is_notifiable(user):
+        return
+    Subscriber.objects.bulk_create([
+        Subscriber(user_id=user.pk, post_id=post_id, author_id=author_id,
+            android_regid=user.android_regid)
+        for post_id, author_id in subscriptions_of(user.pk)], ignore_conflicts=True)
+
+
+def post_recipients(post_id, exclude=None):
+    regids = Subscriber.objects.filter(post_id=post_id)
+    if exclude is not None:
+        regids = regids.exclude(user_id=exclude)
+    return set(regids.values_list('android_regid', flat=True))
+
+
+def author_recipients(author_id):
+    return set(Subscriber.objects.filter(author_id=author_id).values_list('android_regid', flat=True))
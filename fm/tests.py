@@ -1,7 +1,45 @@
+import csv
+import importlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import BytesIO
+from unittest import mock, skipUnless
+
+from PIL import Image
+
+from django.apps import apps
+from django.contrib.auth.hashers import make_password
+from django.core import mail
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models.query import QuerySet
+from django.test import RequestFactory, TestCase
 from django.urls import reverse
 from rest_framework import status
-from rest_framework.test import APITestCase
-from fm.models import User
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
+from fm.models import User, Post, Friend, Comment, Tag, City, MediaFile, MinHashBand, MinHashSignature, \
+    OutboxEmail, Subscriber, ViewedChunk
+from fm import duplicates, hashers, outbox, prefix, profiling, recommend, slowlog, textindex, unread, viewed
+from fm.cache import TwoTierCache
+from fm.helpers import save_resized_image, POST_IMAGE_SIZE
+from fm.bitmap import Container, ARRAY_LIMIT
+from fm.middleware import Bulkhead, LoadSheddingMiddleware
+from fm.ranking import hot_score
+from fm.management.commands.push_campaign import Command as PushCommand
+
+try:
+    import msgpack
+    from fm.renderers import MessagePackParser, MessagePackRenderer
+except ImportError:
+    msgpack = None
 
 class UserTests(APITestCase):
     def test_create_user(self):
@@ -43,3 +81,918 @@ class UserTests(APITestCase):
     	self.assertEqual(User.objects.get().gender, 'M')
     	self.assertEqual(User.objects.get().enable_notif, True)
     	self.assertEqual(User.objects.get().ndroid_regid, '1234567890')
+
+
+class HotScoreTests(TestCase):
+    def test_newer_post_wins_at_equal_activity(self):
+        now = datetime(2018, 6, 1)
+        self.assertGreater(hot_score(now, likes=5), hot_score(now - timedelta(days=1), likes=5))
+
+    def test_activity_outweighs_small_age(self):
+        now = datetime(2018, 6, 1)
+        self.assertGreater(hot_score(now - timedelta(hours=1), likes=50, comments=10),
+            hot_score(now, likes=1))
+
+
+@mock.patch('fm.signals.fcm_send')
+class HotFeedTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='wedge@rogue.org')
+        self.client.force_authenticate(self.user)
+
+    def test_sort_hot(self, fcm_send):
+        quiet = Post.objects.create(author=self.user, title='Quiet')
+        popular = Post.objects.create(author=self.user, title='Popular')
+        Post.objects.filter(pk=popular.pk).update(created=datetime.now() - timedelta(hours=1))
+        others = [User.objects.create(email='pilot%d@rogue.org' % i) for i in range(20)]
+        popular.likes.add(*others)
+
+        response = self.client.get(reverse('posts-list'), {'sort': 'hot'})
+        self.assertEqual([post['id'] for post in response.data['results']], [popular.pk, quiet.pk])
+        response = self.client.get(reverse('posts-list'))
+        self.assertEqual([post['id'] for post in response.data['results']], [quiet.pk, popular.pk])
+
+
+@mock.patch('fm.signals.fcm_send')
+class ExportTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create(email='admiral@home-one.org', is_staff=True)
+        self.client.force_login(self.staff)
+
+    def rows(self, response):
+        return list(csv.DictReader(b''.join(response.streaming_content).decode('utf-8').splitlines()))
+
+    def test_csv_rows_and_date_filter(self, fcm_send):
+        old = User.objects.create(email='old@rebels.org')
+        new = User.objects.create(email='new@rebels.org')
+        Post.objects.filter(pk=Post.objects.create(author=old, title='Yavin').pk) \
+            .update(created=datetime(2018, 1, 10))
+        post = Post.objects.create(author=new, title='Hoth')
+        post.tags.add(Tag.objects.create(tag='ice'), Tag.objects.create(tag='snow'))
+        post.likes.add(old, new)
+        Post.objects.filter(pk=post.pk).update(created=datetime(2018, 6, 10))
+
+        url = reverse('admin-export', kwargs={'kind': 'users', 'fmt': 'csv'})
+        response = self.client.get(url, {'my_posts__created__gte': '01.06.2018'})
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        rows = self.rows(response)
+        self.assertEqual([(row['email'], row['posts_count'], row['likes_count']) for row in rows],
+            [('new@rebels.org', '1', '1')])
+
+        response = self.client.get(url, {'my_posts__created__lte': '01.06.2018'})
+        self.assertEqual([row['email'] for row in self.rows(response)], ['old@rebels.org'])
+
+        url = reverse('admin-export', kwargs={'kind': 'posts', 'fmt': 'csv'})
+        rows = self.rows(self.client.get(url))
+        self.assertEqual([(row['title'], row['likes_count'], row['tags']) for row in rows],
+            [('Yavin', '0', ''), ('Hoth', '2', 'ice|snow')])
+
+
+@mock.patch('fm.signals.fcm_send')
+class AdminSearchTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_superuser(email='admiral@home-one.org', password='its-a-trap')
+        self.client.force_login(self.staff)
+        self.posts = [Post.objects.create(author=self.staff, title=title)
+            for title in ('Hoth base', 'Endor moon', 'Hoth again', 'Bespin')]
+
+    def search(self, term):
+        with self.settings(FM_ADMIN_SEARCH_WINDOW=2):
+            response = self.client.get(reverse('admin:fm_post_changelist'), {'q': term})
+        found = sorted(post.pk for post in response.context['cl'].result_list)
+        return found, [str(message) for message in response.context['messages']]
+
+    def test_window_is_reported(self, fcm_send):
+        found, messages = self.search('Hoth')
+        self.assertEqual(found, [self.posts[2].pk])
+        self.assertEqual(len(messages), 1)
+
+    def test_full_search_when_window_is_empty(self, fcm_send):
+        self.assertEqual(self.search('Endor'), ([self.posts[1].pk], []))
+
+
+class ImportTests(TestCase):
+    def setUp(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        patcher = self.settings(FM_TEXT_INDEX=os.path.join(state_dir, 'text.f32'), FM_CACHE_ALIAS='default')
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        self.path = os.path.join(state_dir, 'dump.ndjson')
+
+    def test_rows_and_media_refs(self):
+        MediaFile.objects.create(name='posts_images/falcon.jpg')
+        MediaFile.objects.create(name='profile_photos/default.png', refs=1)
+        records = [
+            {'type': 'user', 'id': 10, 'email': 'han@falcon.net', 'created': '2018-06-01T10:00:00'},
+            {'type': 'post', 'id': 20, 'author': 10, 'title': 'Где купить гипердвигатель?',
+                'image': 'posts_images/falcon.jpg', 'image_width': 640, 'image_height': 360,
+                'tags': ['ship', 'parts'], 'city': 'Mos Eisley'},
+            {'type': 'post', 'id': 21, 'author': 10, 'title': 'Falcon', 'typeContent': Post.POSITIVE,
+                'image': 'posts_images/falcon.jpg', 'image_width': 640, 'image_height': 360},
+            {'type': 'comment', 'id': 30, 'author': 10, 'post': 20, 'comment': 'Try Watto'},
+        ]
+        with open(self.path, 'w') as f:
+            f.writelines(json.dumps(record) + '\n' for record in records)
+        with mock.patch('sys.stdout'):
+            call_command('import_ndjson', self.path)
+
+        post = Post.objects.get(pk=20)
+        self.assertEqual((post.author.email, post.city.name), ('han@falcon.net', 'Mos Eisley'))
+        self.assertEqual(set(post.tags.values_list('tag', flat=True)), {'ship', 'parts'})
+        self.assertEqual(Comment.objects.get().post_id, 20)
+        self.assertEqual(dict(MediaFile.objects.values_list('name', 'refs')),
+            {'posts_images/falcon.jpg': 2, 'profile_photos/default.png': 2})
+        self.assertEqual(set(MinHashBand.objects.values_list('post_id', flat=True)), {20})
+
+
+class BulkheadTests(TestCase):
+    def test_rejects_over_limit(self):
+        bulkhead = Bulkhead(2)
+        self.assertTrue(bulkhead.acquire())
+        self.assertTrue(bulkhead.acquire())
+        self.assertFalse(bulkhead.acquire())
+        bulkhead.release(0.01)
+        self.assertTrue(bulkhead.acquire())
+
+    def test_limit_shrinks_when_slow(self):
+        bulkhead = Bulkhead(10, latency=0.1)
+        for _ in range(20):
+            bulkhead.acquire()
+            bulkhead.release(1.0)
+        self.assertLess(bulkhead.limit, 2)
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        patcher = self.settings(FM_RATE_CACHE_ALIAS='default')
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        caches['default'].clear()
+        self.middleware = LoadSheddingMiddleware(lambda request: None)
+        self.limits = {'rate': '1/min', 'burst': None}
+
+    def check(self):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION='JWT falcon')
+        return self.middleware.check_rate('PostList', request, self.limits)
+
+    def test_limit(self):
+        self.assertEqual(self.check(), 0)
+        self.assertGreater(self.check(), 0)
+
+    def test_racing_requests_at_limit_one(self):
+        # Оба запроса создают счетчик окна прежде, чем любой из них его увеличит
+        barrier = threading.Barrier(2)
+        add = LocMemCache.add
+
+        def add_and_wait(cache, *args, **kwargs):
+            result = add(cache, *args, **kwargs)
+            barrier.wait(5)
+            return result
+
+        results = []
+        with mock.patch.object(LocMemCache, 'add', add_and_wait):
+            threads = [threading.Thread(target=lambda: results.append(self.check())) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(sorted(results)[0], 0)
+        self.assertGreater(sorted(results)[1], 0)
+
+
+class MediaStorageTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings = self.settings(MEDIA_ROOT=self.media_root)
+        self.settings.enable()
+        self.user = User.objects.create(email='leia@alderaan.net')
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def upload(self):
+        output = BytesIO()
+        Image.new('RGB', (320, 240), 'red').save(output, format='PNG')
+        return SimpleUploadedFile('photo.png', output.getvalue(), content_type='image/png')
+
+    def test_same_upload_stored_once(self):
+        first = Post.objects.create(author=self.user, title='First', image=self.upload())
+        with mock.patch('fm.helpers.render_image') as render_image:
+            second = Post.objects.create(author=self.user, title='Second', image=self.upload())
+        render_image.assert_not_called()
+        self.assertEqual((second.image_width, second.image_height), (320, 180))
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(MediaFile.objects.get().refs, 2)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'posts_images'))), 1)
+
+        first.delete()
+        second.delete()
+        self.assertEqual(MediaFile.objects.get().refs, 0)
+
+    def test_grace_counts_from_release(self):
+        post = Post.objects.create(author=self.user, title='First', image=self.upload())
+        self.assertIsNone(MediaFile.objects.get().released)
+        MediaFile.objects.update(created=datetime.now() - timedelta(days=2))
+        post.delete()
+        with mock.patch('sys.stdout'):
+            call_command('media_gc')
+        self.assertTrue(MediaFile.objects.exists())
+
+        # Повторное использование файла отсчитывает срок заново
+        MediaFile.objects.update(released=datetime.now() - timedelta(days=2))
+        post = Post(author=self.user, title='Second', image=self.upload())
+        self.assertEqual(save_resized_image(post.image, *POST_IMAGE_SIZE), MediaFile.objects.get().name)
+        with mock.patch('sys.stdout'):
+            call_command('media_gc')
+        self.assertTrue(MediaFile.objects.exists())
+
+        MediaFile.objects.update(released=datetime.now() - timedelta(days=2))
+        with mock.patch('sys.stdout'):
+            call_command('media_gc')
+        self.assertFalse(MediaFile.objects.exists())
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'posts_images')), [])
+
+    def test_missing_image_is_kept(self):
+        post = Post.objects.create(author=self.user, title='First', image=self.upload())
+        Post.objects.filter(pk=post.pk).update(image='posts_images/lost.jpg',
+            image_width=None, image_height=None)
+        migration = importlib.import_module('fm.migrations.0009_post_image_size')
+        with mock.patch('sys.stdout'):
+            migration.fill_image_size(apps, None)
+
+        post = Post.objects.get(pk=post.pk)
+        self.assertEqual(post.image.name, 'posts_images/lost.jpg')
+        self.assertEqual((post.image_width, post.image_height), (None, None))
+
+    def rerender(self, *args):
+        with mock.patch('sys.stdout'):
+            call_command('rerender_media', '-w', '1', *args)
+        with open(os.path.join(self.media_root, '.renditions.json')) as f:
+            return json.load(f)
+
+    def test_rerender_from_source(self):
+        post = Post.objects.create(author=self.user, title='First', image=self.upload())
+        uploaded = post.image.name
+        version = Post.objects.get(pk=post.pk).version
+
+        # Изображение обработано при загрузке с теми же параметрами
+        self.assertEqual(self.rerender(), {'renditions': {}, 'sources': {}})
+
+        manifest = self.rerender('-q', '60')
+        post.refresh_from_db()
+        self.assertNotEqual(post.image.name, uploaded)
+        self.assertEqual(manifest['sources'], {post.image.name: uploaded})
+        self.assertEqual((post.image_width, post.image_height), (320, 180))
+        self.assertGreater(post.version, version)
+        self.assertEqual(MediaFile.objects.get(name=post.image.name).refs, 1)
+        self.assertEqual(MediaFile.objects.get(name=uploaded).refs, 0)
+
+        # Повторный запуск ничего не перекодирует
+        with mock.patch('fm.management.commands.rerender_media.render') as render:
+            self.rerender('-q', '60')
+        render.assert_not_called()
+
+        # Другие параметры применяются к исходнику, а не к результату команды
+        manifest = self.rerender('-q', '50')
+        post.refresh_from_db()
+        self.assertEqual(manifest['sources'][post.image.name], uploaded)
+
+
+@mock.patch('fm.signals.fcm_send')
+class SubscriberTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create(email='han@falcon.net', android_regid='han')
+        self.reader = User.objects.create(email='chewie@falcon.net', android_regid='chewie')
+        self.post = Post.objects.create(author=self.author, title='Kessel run')
+        self.post.follows.add(self.reader)
+
+    def recipients(self, fcm_send):
+        return set(fcm_send.call_args[0][0]['registration_ids'])
+
+    def test_comment_notifies_followers_and_author(self, fcm_send):
+        Comment.objects.create(author=self.reader, post=self.post, comment='Grrr')
+        self.assertEqual(self.recipients(fcm_send), {'han'})
+        Comment.objects.create(author=self.author, post=self.post, comment='Punch it')
+        self.assertEqual(self.recipients(fcm_send), {'chewie'})
+
+    def test_disabled_notifications_are_skipped(self, fcm_send):
+        self.reader.enable_notif = False
+        self.reader.save()
+        Comment.objects.create(author=self.author, post=self.post, comment='Punch it')
+        fcm_send.assert_not_called()
+
+        self.reader.enable_notif = True
+        self.reader.android_regid = 'chewie2'
+        self.reader.save()
+        Comment.objects.create(author=self.author, post=self.post, comment='Again')
+        self.assertEqual(self.recipients(fcm_send), {'chewie2'})
+
+    def test_new_post_notifies_friends(self, fcm_send):
+        Friend.objects.create(author=self.reader, friend=self.author, follow=True)
+        Post.objects.create(author=self.author, title='Bespin')
+        self.assertEqual(self.recipients(fcm_send), {'chewie'})
+
+    def test_rebuild_matches_signals(self, fcm_send):
+        self.post.follows.add(self.author)
+        Friend.objects.create(author=self.reader, friend=self.author, follow=True)
+        self.assertEqual(Subscriber.objects.filter(post=self.post).count(), 2)
+        rows = set(Subscriber.objects.values_list('user_id', 'post_id', 'author_id', 'android_regid'))
+
+        with mock.patch('sys.stdout'):
+            call_command('subscribers_rebuild', '-s', '1')
+        self.assertEqual(set(Subscriber.objects.values_list(
+            'user_id', 'post_id', 'author_id', 'android_regid')), rows)
+        self.assertEqual(Subscriber.objects.count(), 3)
+
+
+class ViewedBitmapTests(TestCase):
+    def test_container_switches_to_bitmap(self):
+        container = Container()
+        self.assertEqual(container.add_many([5, 3, 5]), 2)
+        self.assertEqual(list(container), [3, 5])
+        container.add_many(range(0, 2 * ARRAY_LIMIT, 2))
+        self.assertIsNotNone(container.bits)
+        restored = Container.from_bytes(container.to_bytes())
+        self.assertEqual(len(restored), ARRAY_LIMIT + 2)
+        self.assertIn(3, restored)
+        self.assertNotIn(1, restored)
+
+    def test_add_many_and_unviewed(self):
+        user = User.objects.create(email='leia@alderaan.org')
+        self.assertEqual(viewed.add_many(user.pk, [1, 2, 70000]), 3)
+        self.assertEqual(viewed.add_many(user.pk, [2, 70001]), 1)
+        self.assertEqual(viewed.count(user.pk), 4)
+        self.assertTrue(viewed.contains(user.pk, 70000))
+        self.assertEqual(viewed.unviewed(user.pk, [3, 2, 70002, 1]), [3, 70002])
+
+    def test_concurrent_first_mark(self):
+        user = User.objects.create(email='leia@alderaan.org')
+        get = QuerySet.get
+        calls = []
+
+        def race(queryset, *args, **kwargs):
+            # Другой запрос создает строку диапазона между проверкой
+            # и вставкой в get_or_create
+            if queryset.model is ViewedChunk and not calls:
+                calls.append(kwargs)
+                container = Container()
+                container.add_many([1])
+                ViewedChunk.objects.bulk_create([ViewedChunk(user=user, key=0,
+                    data=container.to_bytes(), count=1)])
+                raise ViewedChunk.DoesNotExist
+            return get(queryset, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'get', race):
+            self.assertEqual(viewed.add_many(user.pk, [1, 2]), 1)
+        self.assertTrue(calls)
+        self.assertEqual(viewed.unviewed(user.pk, [1, 2, 3]), [3])
+        self.assertEqual(viewed.count(user.pk), 2)
+
+
+@mock.patch('fm.signals.fcm_send')
+class UnreadTests(TestCase):
+    def setUp(self):
+        self.author = User.objects.create(email='han@falcon.net')
+        self.reader = User.objects.create(email='chewie@falcon.net')
+        Friend.objects.create(author=self.reader, friend=self.author, follow=True)
+        self.counters = unread.counters(self.reader)
+
+    def test_counters_follow_new_content(self, fcm_send):
+        post = Post.objects.create(author=self.author, title='Kessel run')
+        post.follows.add(self.reader)
+        Comment.objects.create(author=self.author, post=post, comment='Punch it')
+        Comment.objects.create(author=self.reader, post=post, comment='Grrr')
+        self.counters.refresh_from_db()
+        self.assertEqual((self.counters.feed, self.counters.comments), (1, 1))
+
+        row = unread.actual().get(pk=self.reader.pk)
+        self.assertEqual((row.actual_feed, row.actual_comments), (1, 1))
+
+        unread.reset(self.reader.pk, unread.FEED)
+        row = unread.actual().get(pk=self.reader.pk)
+        self.assertEqual((row.feed, row.actual_feed, row.comments), (0, 0, 1))
+
+    def test_reading_comments_resets_counter(self, fcm_send):
+        post = Post.objects.create(author=self.author, title='Kessel run')
+        other = Post.objects.create(author=self.author, title='Bespin')
+        Comment.objects.create(author=self.author, post=post, comment='Punch it')
+        client = APIClient()
+        client.force_authenticate(self.reader)
+
+        post.follows.add(self.reader)
+        Comment.objects.create(author=self.author, post=post, comment='Chewie, we are home')
+        # Комментарии неотслеживаемого поста не входят в счетчик
+        client.get(reverse('posts-comments-list', kwargs={'post': other.pk}))
+        self.counters.refresh_from_db()
+        self.assertEqual(self.counters.comments, 1)
+
+        response = client.get(reverse('posts-comments-list', kwargs={'post': post.pk}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.counters.refresh_from_db()
+        self.assertEqual(self.counters.comments, 0)
+
+
+class PrefixIndexTests(TestCase):
+    def test_search_ranks_by_weight(self):
+        index = prefix.PrefixIndex(lambda: [(1, 'Москва', 3), (2, 'Мурманск', 10), (3, 'Minsk', 1)])
+        self.assertEqual([pk for pk, _ in index.search('м')], [2, 1, 3])
+        self.assertEqual([pk for pk, _ in index.search('m')], [2, 1, 3])
+        self.assertEqual(index.search('MOSK'), [(1, 'Москва')])
+
+        index.put(4, 'Han Solo')
+        index.remove(2)
+        self.assertEqual(index.search('sol'), [(4, 'Han Solo')])
+        self.assertEqual([pk for pk, _ in index.search('m')], [1, 3])
+
+    def test_translit_query(self):
+        index = prefix.PrefixIndex(lambda: [(1, 'Han Solo', 5), (2, 'Хан', 1), (3, 'Lando', 1)])
+        self.assertEqual(index.search('хан'), [(1, 'Han Solo'), (2, 'Хан')])
+        self.assertEqual(index.search('han'), [(1, 'Han Solo'), (2, 'Хан')])
+
+    def test_short_prefix_scan_is_bounded(self):
+        index = prefix.PrefixIndex(lambda: [(pk, 'a%05d' % pk, pk) for pk in range(50)])
+        with mock.patch('fm.prefix.SHORT_SCAN', 10):
+            self.assertEqual([pk for pk, _ in index.search('a', limit=3)], [9, 8, 7])
+            self.assertEqual([pk for pk, _ in index.search('a0', limit=3)], [49, 48, 47])
+
+
+@mock.patch('fm.signals.fcm_send')
+class ConditionalTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='lando@bespin.net')
+        self.post = Post.objects.create(author=self.user, title='Cloud City')
+        self.client.force_authenticate(self.user)
+        self.url = reverse('posts-detail', kwargs={'post': self.post.pk})
+
+    def test_not_modified_until_post_changes(self, fcm_send):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.post.likes.add(self.user)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def assertChanges(self, url, change):
+        etag = self.client.get(url)['ETag']
+        change()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_extended_depends_on_embedded_posts_and_authors(self, fcm_send):
+        url = reverse('posts-extended', kwargs={'post': self.post.pk})
+        tag = Tag.objects.create(tag='gas')
+        self.post.tags.add(tag)
+
+        # Новый похожий пост, его отметки и имя автора
+        similar = Post.objects.create(author=self.user, title='Tibanna')
+        self.assertChanges(url, lambda: similar.tags.add(tag))
+        self.assertChanges(url, lambda: similar.likes.add(self.user))
+        self.user.first_name = 'Lando'
+        self.assertChanges(url, lambda: self.user.save(update_fields=['first_name']))
+
+
+@mock.patch('fm.signals.fcm_send')
+class SparseFieldsTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='lando@bespin.net')
+        self.post = Post.objects.create(author=self.user, title='Cloud City')
+        self.client.force_authenticate(self.user)
+
+    def test_only_requested_fields(self, fcm_send):
+        response = self.client.get(reverse('posts-list'), {'fields': 'title,countLike'})
+        self.assertEqual(response.data['results'][0], {'id': self.post.pk, 'title': 'Cloud City', 'countLike': 0})
+
+        url = reverse('posts-extended', kwargs={'post': self.post.pk})
+        response = self.client.get(url, {'embed': 'countSimilar'})
+        self.assertIn('countSimilar', response.data)
+        self.assertNotIn('similar', response.data)
+        self.assertIn('title', response.data)
+
+    def test_fragments_match_full_serialization(self, fcm_send):
+        other = User.objects.create(email='han@falcon.net')
+        Post.objects.create(author=other, title='Falcon').likes.add(self.user)
+        with self.settings(FM_POST_FRAGMENTS=False):
+            expected = self.client.get(reverse('posts-list')).data['results']
+        self.assertEqual(self.client.get(reverse('posts-list')).data['results'], expected)
+        self.assertEqual(self.client.get(reverse('posts-list')).data['results'], expected)
+
+        self.post.likes.add(self.user)
+        rows = self.client.get(reverse('posts-list')).data['results']
+        row = next(row for row in rows if row['id'] == self.post.pk)
+        self.assertEqual((row['countLike'], row['isLike']), (1, True))
+
+    def test_fragments_reset_only_by_shared_changes(self, fcm_send):
+        def resets(change):
+            with mock.patch('fm.signals.cache.invalidate') as invalidate:
+                change()
+            return any('fragments' in call[0] for call in invalidate.call_args_list)
+
+        tag = Tag.objects.create(tag='gas')
+        self.assertFalse(resets(lambda: Tag.objects.create(tag='mining')))
+        self.assertFalse(resets(lambda: City.objects.create(name='Bespin')))
+        tag.tag = 'tibanna'
+        self.assertTrue(resets(tag.save))
+
+        # Полное сохранение при входе в систему не трогает имя и фото
+        self.user.last_login = datetime.now()
+        self.assertFalse(resets(self.user.save))
+        self.user.last_name = 'Calrissian'
+        self.assertTrue(resets(self.user.save))
+
+    def test_tag_filter_without_duplicates(self, fcm_send):
+        self.post.tags.add(Tag.objects.create(tag='gas'), Tag.objects.create(tag='mining'))
+        url = reverse('posts-list')
+        # Фрагменты и ?fields= без счетчиков обходятся без аннотаций Count
+        responses = [self.client.get(url, {'tag': ['gas', 'mining']})]
+        with self.settings(FM_POST_FRAGMENTS=False):
+            responses.append(self.client.get(url, {'tag': ['gas', 'mining'], 'fields': 'id,title'}))
+        for response in responses:
+            self.assertEqual(response.data['count'], 1)
+            self.assertEqual([row['id'] for row in response.data['results']], [self.post.pk])
+
+
+class OutboxTests(TestCase):
+    def test_greeting_is_queued_and_delivered(self):
+        User.objects.create(email='obiwan@jedi.org')
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxEmail.objects.count(), 1)
+
+        self.assertEqual(outbox.deliver(mail.get_connection()), (1, 0))
+        self.assertEqual(mail.outbox[0].to, ['obiwan@jedi.org'])
+        self.assertFalse(OutboxEmail.objects.exists())
+
+    def test_failed_send_is_retried_later(self):
+        outbox.enqueue('Hello', 'There', None, ['kenobi@jedi.org'])
+        connection = mail.get_connection()
+        with mock.patch.object(connection, 'send_messages', side_effect=OSError('down')):
+            self.assertEqual(outbox.deliver(connection), (0, 1))
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.attempts, 1)
+        self.assertGreater(email.next_attempt, datetime.now(email.next_attempt.tzinfo))
+        self.assertEqual(outbox.deliver(connection), (0, 0))
+
+
+@mock.patch('fm.signals.fcm_send')
+class PushCampaignTests(TestCase):
+    def setUp(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        self.checkpoint = os.path.join(state_dir, 'campaign.checkpoint')
+        self.users = [User.objects.create(email='pilot%d@rogue.org' % i, android_regid='pilot%d' % i)
+            for i in range(6)]
+        User.objects.create(email='quiet@rogue.org', android_regid='quiet', enable_notif=False)
+        self.sent = []
+        self.broken = set()
+
+    def send(self, payload):
+        regids = payload['registration_ids']
+        if self.broken & set(regids):
+            raise CommandError('FCM returned 500')
+        self.sent.extend(regids)
+        return {'success': len(regids), 'failure': 0}
+
+    def campaign(self, *args):
+        with mock.patch('fm.management.commands.push_campaign.FCMClient.send', side_effect=self.send), \
+                mock.patch('sys.stdout'):
+            call_command('push_campaign', 'test', '-c', self.checkpoint, '-r', '0', '-w', '1', *args)
+
+    def test_segments(self, fcm_send):
+        city = City.objects.create(name='Mos Eisley')
+        Post.objects.create(author=self.users[0], title='Cantina', city=city)
+        post = Post.objects.create(author=self.users[5], title='Droids')
+        post.tags.add(Tag.objects.create(tag='droids'))
+        post.follows.add(self.users[1], self.users[2])
+        User.objects.filter(pk=self.users[2].pk).update(last_login=datetime.now())
+
+        self.campaign('--city', 'Mos Eisley')
+        self.assertEqual(self.sent, ['pilot0'])
+        self.sent = []
+        self.campaign('--tag', 'droids')
+        self.assertEqual(sorted(self.sent), ['pilot1', 'pilot2'])
+        self.sent = []
+        self.campaign('--tag', 'droids', '--active', '1')
+        self.assertEqual(self.sent, ['pilot2'])
+
+    def test_resume_without_duplicates(self, fcm_send):
+        chunks = PushCommand.chunks
+
+        def interrupted(command, *args):
+            for num, chunk in enumerate(chunks(command, *args)):
+                if num == 3:
+                    raise KeyboardInterrupt
+                yield chunk
+
+        with mock.patch.object(PushCommand, 'chunks', interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                self.campaign('-s', '1')
+        self.assertEqual(self.sent, ['pilot0', 'pilot1', 'pilot2'])
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)['sent'], 3)
+
+        # FCM отвечает ошибкой на одну пачку: остальные отправляются,
+        # а она остается в контрольной точке
+        self.broken.add('pilot4')
+        self.campaign('-s', '1')
+        self.assertEqual(self.sent, ['pilot0', 'pilot1', 'pilot2', 'pilot3', 'pilot5'])
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        self.assertEqual(state['failed_ranges'], [[self.users[4].pk, self.users[4].pk, 1]])
+        self.assertEqual((state['sent'], state['failed']), (5, 1))
+
+        # Следующий запуск отправляет только ее
+        self.broken.clear()
+        self.campaign('-s', '1')
+        self.assertEqual(self.sent, ['pilot0', 'pilot1', 'pilot2', 'pilot3', 'pilot5', 'pilot4'])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+
+class ProfilingTests(TestCase):
+    def test_call_tree(self):
+        stacks = Counter({('main', 'view', 'query'): 3, ('main', 'view'): 1, ('main', 'render'): 1})
+        self.assertEqual(profiling.call_tree(stacks), [
+            (0, 'main', 5, 100.0), (1, 'view', 4, 80.0), (2, 'query', 3, 60.0), (1, 'render', 1, 20.0)])
+        self.assertIn('main;view;query 3\n', profiling.collapsed(stacks))
+
+
+@mock.patch('fm.signals.fcm_send')
+class ProfilingMiddlewareTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='wedge@rogue.org')
+        self.url = reverse('posts-list')
+        # Сессия - для проверки в middleware, JWT заменяет force_authenticate
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, header):
+        with mock.patch('fm.profiling.Sampler') as sampler:
+            response = self.client.get(self.url, HTTP_X_PROFILE=header)
+        return response, sampler.called
+
+    def test_header_requires_staff_or_secret(self, fcm_send):
+        self.client.force_login(self.user)
+        response, sampled = self.get('1')
+        self.assertFalse(sampled)
+        self.assertNotIn('X-Profile-Id', response)
+
+        self.user.is_staff = True
+        self.user.save()
+        response, sampled = self.get('1')
+        self.assertTrue(sampled)
+        profile = profiling.find_profile(int(response['X-Profile-Id']))
+        self.assertGreater(profile['query_count'], 0)
+
+    def test_secret_header(self, fcm_send):
+        with self.settings(FM_PROFILE_SECRET='kessel'):
+            self.client.force_login(self.user)
+            self.assertFalse(self.get('1')[1])
+            self.assertFalse(self.get('kessel-run')[1])
+            self.assertTrue(self.get('kessel')[1])
+
+
+class SlowQueryTests(TestCase):
+    def test_fingerprint_ignores_values(self):
+        self.assertEqual(slowlog.normalize("SELECT * FROM t WHERE a = 'x' AND b IN (%s, %s) LIMIT 21"),
+            'SELECT * FROM t WHERE a = ? AND b IN (...) LIMIT ?')
+        self.assertEqual(slowlog.fingerprint('SELECT 1 FROM t WHERE id IN (?)'),
+            slowlog.fingerprint('SELECT  2 FROM t WHERE id IN (?, ?, ?)'))
+
+    def test_slow_query_is_recorded_with_plan(self):
+        with self.settings(FM_SLOW_QUERY=0), mock.patch.dict(slowlog.queries, clear=True):
+            list(Post.objects.filter(title='Hoth'))
+            entry = next(entry for entry in slowlog.queries.values() if 'fm_post' in entry['sql'])
+            self.assertEqual(entry['count'], 1)
+            self.assertIn('fm_post', entry['plan'])
+
+
+class TwoTierCacheTests(TestCase):
+    def setUp(self):
+        patcher = self.settings(FM_CACHE_ALIAS='default', FM_CACHE_BUS_INTERVAL=0, FM_CACHE_L1_SIZE=2)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        # Два экземпляра с общим L2 - как два процесса
+        self.first, self.second = TwoTierCache(), TwoTierCache()
+        self.first.l2.clear()
+
+    def test_invalidation_reaches_other_process(self):
+        self.first.set('post:1', 'detail', 'old')
+        self.assertEqual(self.second.get('post:1', 'detail'), 'old')
+        self.assertEqual(self.second.get('post:1', 'detail'), 'old')
+        self.first.invalidate('post:1')
+        self.assertIsNone(self.second.get('post:1', 'detail'))
+        self.assertEqual(self.second.stats['post'],
+            {'l1_hits': 1, 'l2_hits': 1, 'misses': 1, 'evictions': 0, 'invalidations': 0})
+
+    def test_lru_eviction(self):
+        for key in ('a', 'b', 'c'):
+            self.first.set('tags', key, key)
+        self.assertEqual(list(self.first.entries), [('tags', 'b'), ('tags', 'c')])
+        self.assertEqual(self.first.stats['tags']['evictions'], 1)
+
+    def test_invalidation_does_not_scan_l1(self):
+        self.first.set('tags', 'all', ['hoth'])
+        self.first.invalidate('tags')
+        # Запись старой версии остается в L1, но не совпадает при чтении
+        self.assertEqual(list(self.first.entries), [('tags', 'all')])
+        self.assertIsNone(self.first.get('tags', 'all'))
+        self.assertEqual(list(self.first.entries), [])
+
+    def test_versions_are_bounded_and_checked_on_read(self):
+        with self.settings(FM_CACHE_NAMESPACES=2, FM_CACHE_BUS_INTERVAL=60):
+            for namespace in ('post:1', 'post:2', 'post:3'):
+                self.first.get(namespace, 'detail')
+            self.assertEqual(list(self.first.versions), ['post:2', 'post:3'])
+
+            # В пределах интервала версия читаемого пространства не сверяется,
+            # остальные пространства не запрашиваются вовсе
+            with mock.patch.object(LocMemCache, 'get_many') as get_many, \
+                    mock.patch.object(LocMemCache, 'get', return_value=None) as get:
+                self.first.version('post:3')
+            get.assert_not_called()
+            get_many.assert_not_called()
+
+    def test_model_signal_invalidates(self):
+        with mock.patch('fm.signals.cache', self.first):
+            self.first.set('tags', 'all', [])
+            Tag.objects.create(tag='hoth')
+            self.assertIsNone(self.first.get('tags', 'all'))
+
+
+@mock.patch('fm.signals.fcm_send')
+class RecommendTests(TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        self.users = [User.objects.create(email='user%d@hoth.org' % i) for i in range(4)]
+        self.posts = [Post.objects.create(author=self.users[0], title='Post %d' % i) for i in range(4)]
+
+    def build(self):
+        with mock.patch('sys.stdout'):
+            call_command('recommend_build', d=self.state_dir)
+
+    def test_neighbors_of_recent_likes(self, fcm_send):
+        first, second, third, _ = self.posts
+        first.likes.add(self.users[1], self.users[2], self.users[3])
+        second.likes.add(self.users[1], self.users[2])
+        self.build()
+        self.assertEqual(recommend.recommended(self.users[3].pk, 10), [second.pk])
+
+        # Повторный запуск учитывает только изменившихся пользователей
+        third.likes.add(self.users[3])
+        self.build()
+        self.assertEqual([pk for pk, _ in recommend.neighbors(third.pk)], [first.pk])
+        self.assertEqual(recommend.recommended(self.users[1].pk, 10), [third.pk])
+
+
+@mock.patch('fm.signals.fcm_send')
+class TextIndexTests(TestCase):
+    def setUp(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        patcher = self.settings(FM_TEXT_INDEX=os.path.join(state_dir, 'text.f32'), FM_CACHE_ALIAS='default')
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        self.user = User.objects.create(email='leia@alderaan.org')
+
+    def test_similar_by_words_and_spelling(self, fcm_send):
+        first = Post.objects.create(author=self.user, title='Где купить велосипед в Москве?')
+        with mock.patch('sys.stdout'):
+            call_command('text_index_build')
+        # Посты после построения индекса добавляются при сохранении
+        second = Post.objects.create(author=self.user, title='Купить велосипеды, Москва')
+        Post.objects.create(author=self.user, title='Лучший ресторан грузинской кухни')
+        self.assertEqual([pk for pk, _ in textindex.search(first.pk)], [second.pk])
+
+        second.delete()
+        self.assertEqual(textindex.search(first.pk), [])
+
+    def test_cached_similar_sees_new_posts(self, fcm_send):
+        first = Post.objects.create(author=self.user, title='Где купить велосипед в Москве?')
+        with mock.patch('sys.stdout'):
+            call_command('text_index_build')
+        self.assertEqual(textindex.similar(first.pk), [])
+        second = Post.objects.create(author=self.user, title='Купить велосипеды, Москва')
+        self.assertEqual([pk for pk, _ in textindex.similar(first.pk)], [second.pk])
+
+    def test_tag_fallback_has_same_fields(self, fcm_send):
+        tag = Tag.objects.create(tag='bikes')
+        first = Post.objects.create(author=self.user, title='Велосипед')
+        second = Post.objects.create(author=self.user, title='Самокат')
+        first.tags.add(tag)
+        second.tags.add(tag)
+        second.likes.add(self.user)
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with self.settings(FM_POST_FRAGMENTS=False):
+            response = client.get(reverse('posts-similar', kwargs={'post': first.pk}))
+        row = response.data['results'][0]
+        self.assertEqual((row['id'], row['countLike'], row['isLike']), (second.pk, 1, True))
+
+
+@mock.patch('fm.signals.fcm_send')
+class DuplicatesTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='chewie@kashyyyk.org')
+        self.client.force_authenticate(self.user)
+
+    def test_finds_similar_questions_only(self, fcm_send):
+        question = Post.objects.create(author=self.user, title='Где купить хороший велосипед в Москве?')
+        Post.objects.create(author=self.user, title='Где купить хороший велосипед в Москве?',
+            typeContent=Post.POSITIVE)
+        Post.objects.create(author=self.user, title='Посоветуйте ресторан грузинской кухни')
+
+        found = duplicates.find('Где купить велосипед в Москве')
+        self.assertEqual([pk for pk, _ in found], [question.pk])
+        self.assertGreater(found[0][1], 0.5)
+
+        response = self.client.get(reverse('posts-duplicates'), {'title': 'купить хороший велосипед в Москве'})
+        self.assertEqual([post['id'] for post in response.data], [question.pk])
+
+    def test_candidates_ranked_by_bands(self, fcm_send):
+        title = 'Где купить хороший горный велосипед в Москве недорого?'
+        Post.objects.create(author=self.user, title='Где купить хороший велосипед?')
+        question = Post.objects.create(author=self.user, title=title)
+        MinHashSignature.objects.all().delete()
+        with mock.patch('sys.stdout'):
+            call_command('duplicates_rebuild')
+        self.assertEqual(MinHashSignature.objects.count(), 2)
+
+        # Подписи кандидатов берутся из БД, подписывается только запрос
+        with self.settings(FM_DUPLICATE_CANDIDATES=1), \
+                mock.patch('fm.duplicates.signature', wraps=duplicates.signature) as signature:
+            found = duplicates.find(title)
+        self.assertEqual([pk for pk, _ in found], [question.pk])
+        self.assertEqual(signature.call_count, 1)
+
+
+@skipUnless(msgpack, 'msgpack is not installed')
+@mock.patch('fm.signals.fcm_send')
+class MessagePackTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='r2d2@tatooine.org')
+        self.client.force_authenticate(self.user)
+
+    def test_create_and_list(self, fcm_send):
+        body = msgpack.packb({'title': 'Droids', 'tags': ['astromech'], 'city': 'Mos Eisley'})
+        response = self.client.post(reverse('posts-list'), body, content_type='application/msgpack',
+            HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(msgpack.unpackb(response.content)['tags'], ['astromech'])
+
+        response = self.client.get(reverse('posts-list'), HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        post = msgpack.unpackb(response.content)['results'][0]
+        self.assertEqual(post['city'], 'Mos Eisley')
+        self.assertEqual(post['author']['name'], 'r2d2@tatooine.org')
+        created = Post.objects.get().created
+        self.assertEqual(post['created'], created.strftime('%d.%m.%Y %H:%M'))
+
+    def test_raw_values(self, fcm_send):
+        data = {'when': datetime(2018, 6, 22, 10, 29), 'photo': self.user.profile_photo}
+        context = {'request': APIRequestFactory().get('/')}
+        self.assertEqual(msgpack.unpackb(MessagePackRenderer().render(data, renderer_context=context)),
+            {'when': '22.06.2018 10:29', 'photo': 'http://testserver/media/profile_photos/default.png'})
+
+    def test_parsed_timestamps_are_naive(self, fcm_send):
+        when = datetime(2018, 6, 22, 10, 29, tzinfo=dt_timezone.utc)
+        body = msgpack.packb({'when': when, 'log': [when]}, datetime=True)
+        with self.settings(TIME_ZONE='Europe/Moscow'):
+            data = MessagePackParser().parse(BytesIO(body))
+        self.assertEqual(data, {'when': datetime(2018, 6, 22, 13, 29), 'log': [datetime(2018, 6, 22, 13, 29)]})
+
+
+@mock.patch('fm.signals.fcm_send')
+class PooledHasherTests(TestCase):
+    def setUp(self):
+        patcher = self.settings(FM_PBKDF2_ITERATIONS=1000)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def test_rehash_on_login(self, fcm_send):
+        user = User.objects.create(email='yoda@dagobah.org')
+        user.password = make_password('swamp', hasher='pbkdf2_sha1')
+        user.save()
+        completed = hashers.pool.stats['completed']
+
+        self.assertTrue(user.check_password('swamp'))
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$1000$'))
+        self.assertGreater(hashers.pool.stats['completed'], completed)
+
+    def test_overloaded(self, fcm_send):
+        with self.settings(FM_HASH_QUEUE=0):
+            self.assertRaises(hashers.Overloaded, make_password, 'swamp')
+
+    def test_overloaded_admin_login(self, fcm_send):
+        User.objects.create_superuser(email='yoda@dagobah.org', password='swamp')
+        with self.settings(FM_HASH_QUEUE=0):
+            response = self.client.post(reverse('admin:login'), {
+                'username': 'yoda@dagobah.org', 'password': 'swamp'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
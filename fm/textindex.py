@@ -0,0 +1,127 @@
+import fcntl
+import math
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+from django.conf import settings
+
+from fm.cache import cache
+
+# Векторный индекс текста постов для поиска похожих. Вектор поста - хэшированные
+# слова и символьные триграммы слов (устойчивы к опечаткам и окончаниям) из
+# заголовка и описания, нормированные по длине. Матрица float32 (строка = id
+# поста) лежит в файле FM_TEXT_INDEX и отображается в память каждым процессом:
+# запись строки при сохранении поста сразу видна всем процессам на машине.
+# Списки похожих кэшируются в пространстве "similar" fm.cache: любое изменение
+# индекса может добавить пост в чужой список, поэтому сбрасывается все пространство.
+
+WORD_RE = re.compile(r'\w+')
+TITLE_WEIGHT = 2.0
+GROW_ROWS = 4096
+
+local = threading.local()
+
+
+def dimension():
+    return getattr(settings, 'FM_TEXT_DIM', 256)
+
+
+def features(text):
+    words = [word for word in WORD_RE.findall(text.lower().replace('ё', 'е')) if not word.isdigit()]
+    for word in words:
+        yield word
+        padded = '<%s>' % word
+        for i in range(len(padded) - 2):
+            yield padded[i:i + 3]
+
+
+def vectorize(title, description):
+    """
+    Нормированный вектор текста: хэширование признаков со знаком
+    и логарифмическим весом частоты, заголовок весит вдвое больше.
+    """
+    dim = dimension()
+    counts = {}
+    for text, weight in ((title, TITLE_WEIGHT), (description, 1.0)):
+        for feature in features(text or ''):
+            counts[feature] = counts.get(feature, 0.0) + weight
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature, count in counts.items():
+        code = zlib.crc32(feature.encode('utf-8'))
+        vector[code % dim] += (1.0 + math.log(count)) * (1 if code & 0x80000000 else -1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def path():
+    return getattr(settings, 'FM_TEXT_INDEX', '/var/tmp/friendmarket_text.f32')
+
+
+def matrix(rows=0, filename=None):
+    """
+    Отображение файла индекса в память (не меньше rows строк). Файл только
+    растет; если другой процесс его увеличил или подменил (text_index_build),
+    отображение пересоздается.
+    """
+    dim = dimension()
+    filename = filename or path()
+    if rows and (not os.path.exists(filename) or os.path.getsize(filename) < rows * dim * 4):
+        with open(filename, 'ab') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_size < rows * dim * 4:
+                f.truncate((rows + GROW_ROWS) * dim * 4)
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    if not stat.st_size:
+        return None
+
+    key = (filename, stat.st_ino, stat.st_size)
+    if getattr(local, 'key', None) != key:
+        local.matrix = np.memmap(filename, dtype=np.float32, mode='r+',
+            shape=(stat.st_size // (dim * 4), dim))
+        local.key = key
+    return local.matrix
+
+
+def update(post):
+    # Индекс создается командой text_index_build; до этого посты не индексируются
+    if not os.path.exists(path()):
+        return
+    vectors = matrix(post.pk + 1)
+    vectors[post.pk] = vectorize(post.title, post.description)
+    cache.invalidate('similar')
+
+
+def remove(post_id):
+    vectors = matrix()
+    if vectors is not None and post_id < len(vectors):
+        vectors[post_id] = 0
+        cache.invalidate('similar')
+
+
+def similar(post_id):
+    """
+    [(id, оценка)] - до FM_TEXT_TOP постов с косинусной мерой не ниже
+    FM_TEXT_MIN_SCORE, по убыванию. Одно умножение матрицы на вектор,
+    результат кэшируется до изменения индекса.
+    """
+    return cache.get_or_set('similar', post_id, lambda: search(post_id))
+
+
+def search(post_id):
+    vectors = matrix()
+    if vectors is None or post_id >= len(vectors) or not vectors[post_id].any():
+        return []
+    scores = vectors @ vectors[post_id]
+    scores[post_id] = 0
+    top = min(getattr(settings, 'FM_TEXT_TOP', 50), len(scores) - 1)
+    best = np.argpartition(-scores, top)[:top]
+    best = best[np.argsort(-scores[best], kind='stable')]
+    min_score = getattr(settings, 'FM_TEXT_MIN_SCORE', 0.2)
+    return [(int(pk), float(scores[pk])) for pk in best if scores[pk] >= min_score]
@@ -0,0 +1,62 @@
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from fm.models import Post, Friend, Comment, Unread
+
+FEED = 'feed'
+COMMENTS = 'comments'
+
+
+def feed_readers(post):
+    # Пользователи, которые следят за автором поста
+    return Friend.objects.filter(friend_id=post.author_id, follow=True) \
+        .exclude(author_id=post.author_id).values_list('author_id', flat=True)
+
+
+def comment_readers(comment):
+    # Пользователи, которые следят за постом, кроме автора комментария
+    return Post.follows.through.objects.filter(post_id=comment.post_id) \
+        .exclude(user_id=comment.author_id).values_list('user_id', flat=True)
+
+
+def increment(user_ids, field):
+    """
+    Увеличивает счетчик одним запросом. Пользователи без строки счетчиков
+    пропускаются: строка создается при первом чтении.
+    """
+    Unread.objects.filter(user_id__in=list(user_ids)).update(**{field: F(field) + 1})
+
+
+def reset(user_id, field):
+    Unread.objects.filter(user_id=user_id).update(**{field: 0, field + '_seen': timezone.now()})
+
+
+def counters(user):
+    now = timezone.now()
+    unread, _ = Unread.objects.get_or_create(user=user,
+        defaults={'feed_seen': now, 'comments_seen': now})
+    return unread
+
+
+def count_rows(queryset, field):
+    # Группировка по полю, равному внешнему пользователю: одна строка с числом
+    rows = queryset.order_by().values(field).annotate(num=Count('pk')).values('num')
+    return Coalesce(Subquery(rows, output_field=IntegerField()), 0)
+
+
+def actual(queryset=None):
+    """
+    Счетчики, посчитанные заново по исходным данным (для сверки).
+    """
+    posts = Post.objects.filter(
+        author__friend_to__author=OuterRef('user_id'), author__friend_to__follow=True,
+        created__gt=OuterRef('feed_seen')).exclude(author=OuterRef('user_id'))
+    comments = Comment.objects.filter(
+        post__follows=OuterRef('user_id'),
+        created__gt=OuterRef('comments_seen')).exclude(author=OuterRef('user_id'))
+    if queryset is None:
+        queryset = Unread.objects.all()
+    return queryset.annotate(
+        actual_feed=count_rows(posts, 'author__friend_to__author'),
+        actual_comments=count_rows(comments, 'post__follows'))
@@ -12,15 +12,19 @@ urlpatterns = [
     path('profile/questions/', views.ProfileQuestions.as_view(), name='profile-questions'),
     path('profile/notes/', views.ProfileNotes.as_view(), name='profile-notes'),
     path('profile/follows/', views.ProfileFollows.as_view(), name='profile-follows'),
+    path('profile/unread/', views.ProfileUnread.as_view(), name='profile-unread'),
     path('feed/', views.PostList.as_view(), name='feed-list'),
     path('friends/', views.FriendList.as_view(), name='friends-list'),
     path('friends/<int:id>/follow/', views.FriendFollow.as_view(), name='friends-follow'),
 
     path('users/', views.UserList.as_view(), name='users-list'),
+    path('users/suggest/', views.UserSuggest.as_view(), name='users-suggest'),
     path('users/<int:user>/', views.UserDetail.as_view(), name='users-detail'),
     # path('users/<int:user>/friend/', views.UserFriend.as_view()),
 
     path('posts/', views.PostList.as_view(), name='posts-list'),
+    path('posts/recommended/', views.PostRecommended.as_view(), name='posts-recommended'),
+    path('posts/duplicates/', views.PostDuplicates.as_view(), name='posts-duplicates'),
     path('posts/<int:post>/', views.PostDetail.as_view(), name='posts-detail'),
     path('posts/<int:post>/extended/', views.PostExtended.as_view(), name='posts-extended'),
     path('posts/<int:post>/attach/', views.PostAttach.as_view(), name='posts-attach'),
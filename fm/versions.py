@@ -0,0 +1,23 @@
+from django.db.models import F, Q
+from django.utils import timezone
+
+from fm.models import Post
+
+
+def bump(post_ids):
+    """
+    Увеличивает версию постов и вопросов, к которым они прикреплены
+    как рекомендации (вопрос показывает рекомендации целиком).
+    """
+    post_ids = list(post_ids)
+    if not post_ids:
+        return
+    Post.objects.filter(Q(pk__in=post_ids) | Q(post_comments__note_id__in=post_ids)) \
+        .update(version=F('version') + 1, modified=timezone.now())
+
+
+def get_version(post_id):
+    """
+    (version, modified) поста одним запросом по первичному ключу или None.
+    """
+    return Post.objects.filter(pk=post_id).values_list('version', 'modified').first()
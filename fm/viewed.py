@@ -0,0 +1,87 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+
+from fm.bitmap import Container, CHUNK_BITS, group, split
+from fm.models import ViewedChunk
+
+
+def bitmap_enabled():
+    return getattr(settings, 'FM_VIEWED_BITMAP', False)
+
+
+def add_many(user_id, post_ids):
+    """
+    Отмечает посты прочитанными. Затрагивает по одной строке
+    на каждый диапазон из 65536 id.
+    """
+    chunks = group(post_ids)
+    if not chunks:
+        return 0
+
+    # Сначала создаем недостающие строки, затем блокируем и меняем их:
+    # при одновременной первой отметке get_or_create получает IntegrityError
+    # и читает строку, созданную другим запросом
+    added = 0
+    with transaction.atomic():
+        existing = set(ViewedChunk.objects.filter(user_id=user_id, key__in=list(chunks))
+            .values_list('key', flat=True))
+        for key in set(chunks) - existing:
+            ViewedChunk.objects.get_or_create(user_id=user_id, key=key,
+                defaults={'data': Container().to_bytes()})
+
+        rows = ViewedChunk.objects.select_for_update() \
+            .filter(user_id=user_id, key__in=list(chunks))
+        for row in rows:
+            container = Container.from_bytes(row.data)
+            num = container.add_many(chunks[row.key])
+            if not num:
+                continue
+            added += num
+            ViewedChunk.objects.filter(pk=row.pk).update(
+                data=container.to_bytes(), count=len(container))
+    return added
+
+
+def contains(user_id, post_id):
+    key, low = split(post_id)
+    data = ViewedChunk.objects.filter(user_id=user_id, key=key) \
+        .values_list('data', flat=True).first()
+    return data is not None and low in Container.from_bytes(data)
+
+
+def count(user_id):
+    return ViewedChunk.objects.filter(user_id=user_id) \
+        .aggregate(num=Sum('count'))['num'] or 0
+
+
+def unviewed(user_id, post_ids):
+    """
+    Возвращает те из post_ids, которые пользователь еще не видел (в том же порядке).
+    """
+    post_ids = list(post_ids)
+    chunks = group(post_ids)
+    containers = {key: Container.from_bytes(data) for key, data in
+        ViewedChunk.objects.filter(user_id=user_id, key__in=list(chunks))
+            .values_list('key', 'data')}
+    result = []
+    for post_id in post_ids:
+        key, low = split(post_id)
+        container = containers.get(key)
+        if container is None or low not in container:
+            result.append(post_id)
+    return result
+
+
+def post_counts(key):
+    """
+    Сколько пользователей видели каждый пост диапазона key: {post_id: count}.
+    Проходит по всем строкам диапазона, предназначено для выгрузок.
+    """
+    counts = {}
+    rows = ViewedChunk.objects.filter(key=key).values_list('data', flat=True)
+    for data in rows.iterator():
+        for low in Container.from_bytes(data):
+            counts[low] = counts.get(low, 0) + 1
+    base = key << CHUNK_BITS
+    return {base + low: num for low, num in counts.items()}
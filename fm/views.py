@@ -1,25 +1,71 @@
 from django.shortcuts import get_object_or_404
 from django.db import models
-from django.db.models import Count, Exists, Q, OuterRef, Value
+from django.db.models import Count, Exists, Q, OuterRef, Sum, Value
 
 from rest_framework import status, generics, permissions
 from rest_framework.response import Response
 
-from fm.mixins import MultipleFieldLookupMixin, ListHeaderMixin
+from fm import duplicates, prefix, recommend, textindex, unread, viewed
+from fm.helpers import filter_ordered
+from fm.cache import cache
+from fm.mixins import MultipleFieldLookupMixin, ListHeaderMixin, ConditionalMixin, \
+    SparseFieldsMixin, PostFragmentsMixin
 from fm.models import User, Post, Friend, Comment, Tag, City
 
 from fm.serializers import PostSerializer, UserDetailsSerializer, \
     ProfileSerializer, FriendSerializer, FriendListSerializer, \
     CommentSerializer, PostLikeSerializer, PostFollowSerializer, \
     TagSerializer, PostExtendedSerializer, NoteSerializer, \
-    NoteBestSerializer, PostAttachSerializer, CitySerializer
+    NoteBestSerializer, PostAttachSerializer, CitySerializer, \
+    UnreadSerializer
 
 from fm.permissions import IsOwnerOrReadOnly
 
+def annotate_posts(posts, view):
+    """
+    Вычисляемые поля поста (countLike, isLike, countComnt, isFollow) и связанные
+    объекты; то, что не запрошено через ?fields=, в запрос не попадает.
+    """
+    if getattr(view, 'use_fragments', None) is not None and view.use_fragments():
+        # Счетчики и связанные объекты придут из кэша фрагментов
+        return posts
+
+    user = view.request.user
+    annotations = {}
+    if view.wants('countLike'):
+        annotations['countLike'] = Count('likes', distinct=True)
+    if view.wants('isLike'):
+        annotations['isLike'] = Exists(Post.likes.through.objects.filter(
+            post=OuterRef('pk'), user=user))
+    if view.wants('countComnt'):
+        annotations['countComnt'] = Count('post_comments', distinct=True)
+    if view.wants('isFollow'):
+        annotations['isFollow'] = Exists(Post.follows.through.objects.filter(
+            post=OuterRef('pk'), user=user))
+    posts = posts.annotate(**annotations)
+
+    related = [name for name in ('author', 'city') if view.wants(name)]
+    if related:
+        posts = posts.select_related(*related)
+    if view.wants('tags'):
+        posts = posts.prefetch_related('tags')
+    return posts
+
 class UserList(generics.ListAPIView):
     queryset = User.objects.all()
     serializer_class = UserDetailsSerializer
 
+class UserSuggest(generics.GenericAPIView):
+    """
+    Автодополнение имен пользователей: до ?limit= пользователей, имя или
+    фамилия которых начинается с ?q=, сначала те, у кого больше подписчиков.
+    """
+    list_name = 'users'
+
+    def get(self, request, *args, **kwargs):
+        found = prefix.users.search(request.query_params.get('q', ''), suggest_limit(request))
+        return Response({self.list_name: [{'id': pk, 'name': text} for pk, text in found]})
+
 class UserDetail(generics.RetrieveAPIView):
     queryset = User.objects.all()
     serializer_class = UserDetailsSerializer
@@ -38,6 +84,16 @@ class ProfileDetail(generics.RetrieveUpdateAPIView):
         obj = get_object_or_404(User.objects, email=self.request.user)
         return obj
 
+class ProfileUnread(generics.RetrieveAPIView):
+    """
+    Возвращает число новых постов в ленте и новых комментариев
+    к отслеживаемым постам с момента их последнего просмотра.
+    """
+    serializer_class = UnreadSerializer
+
+    def get_object(self):
+        return unread.counters(self.request.user)
+
 class ProfileQuestions(generics.ListAPIView):
     """
     Возвращает список собственных вопросов пользователя.
@@ -79,6 +135,10 @@ class ProfileFollows(generics.ListAPIView):
             countComnt=Count('post_comments', distinct=True))
         return posts
 
+    def get(self, request, *args, **kwargs):
+        unread.reset(request.user.pk, unread.COMMENTS)
+        return self.list(request, *args, **kwargs)
+
 class FriendList(generics.ListAPIView):
     """
     Возвращает список всех друзей пользователя.
@@ -105,24 +165,26 @@ class FriendFollow(generics.CreateAPIView, generics.DestroyAPIView):
         Friend.objects.filter(author=self.request.user, friend=instance) \
             .delete()
 
-class PostList(generics.ListCreateAPIView):
+class PostList(PostFragmentsMixin, SparseFieldsMixin, generics.ListCreateAPIView):
     """
-    get: Выводит список всех вопросов и рекомендаций.
+    get: Выводит список всех вопросов и рекомендаций (?sort=hot — сначала "горячие",
+    ?fields=id,title,countLike — только перечисленные поля).
     post: Создает новый вопрос или рекомендацию с указанными параметрами.
     """
     serializer_class = PostSerializer
     results_field = 'posts'
+    load_limits = {'concurrency': 16, 'latency': 1.0}
+    search_load_limits = {'concurrency': 4, 'rate': '20/min', 'latency': 2.0}
+
+    @classmethod
+    def get_load_limits(cls, request):
+        # Полнотекстовый поиск дорогой: у него отдельный, более строгий лимит
+        if request.method == 'GET' and request.GET.get('search'):
+            return cls.__name__ + ':search', cls.search_load_limits
+        return cls.__name__, cls.load_limits
 
     def get_queryset(self):
-        user_likes = Post.likes.through.objects.filter(
-            post=OuterRef('pk'), user=self.request.user)
-        user_follows = Post.follows.through.objects.filter(
-            post=OuterRef('pk'), user=self.request.user)
-        posts = Post.objects.annotate(
-            countLike=Count('likes', distinct=True),
-            isLike=Exists(user_likes),
-            countComnt=Count('post_comments', distinct=True),
-            isFollow=Exists(user_follows))
+        posts = annotate_posts(Post.objects.all(), self)
 
         post_type = self.request.query_params.getlist('type')
         post_type = list(filter(None, post_type))
@@ -137,7 +199,10 @@ class PostList(generics.ListCreateAPIView):
         tags = self.request.query_params.getlist('tag')
         tags = list(filter(None, tags))
         if tags:
-            posts = posts.filter(tags__tag__in=tags)
+            # Подзапрос вместо JOIN: пост с несколькими из тегов не повторяется
+            # и без группировки, которую дают только аннотации Count
+            posts = posts.filter(pk__in=Post.tags.through.objects
+                .filter(tag__tag__in=tags).values('post_id'))
 
         # TODO: Не использовать JOIN здесь. Сначала получить список id городов по их именам,
         # а потом фильтровать по этому списку id.
@@ -146,6 +211,10 @@ class PostList(generics.ListCreateAPIView):
         if city:
             posts = posts.filter(city__name__in=city)
 
+        sort = self.request.query_params.get('sort', None)
+        if sort == 'hot':
+            posts = posts.order_by('-hot', '-created')
+
         return posts
 
     def perform_create(self, serializer):
@@ -154,11 +223,16 @@ class PostList(generics.ListCreateAPIView):
     def get(self, request, *args, **kwargs):
         # Добавляю все полученные посты в прочитанные
         posts = self.get_queryset()
-        self.request.user.posts_viewed.add(*posts)
+        if viewed.bitmap_enabled():
+            viewed.add_many(self.request.user.pk, posts.values_list('pk', flat=True))
+        else:
+            self.request.user.posts_viewed.add(*posts)
+        if request.resolver_match.url_name == 'feed-list':
+            unread.reset(request.user.pk, unread.FEED)
 
         return self.list(request, *args, **kwargs)
 
-class PostDetail(generics.RetrieveUpdateDestroyAPIView):
+class PostDetail(ConditionalMixin, SparseFieldsMixin, generics.RetrieveUpdateDestroyAPIView):
     """
     get: Выводит указанный вопрос или рекомендацию.
     put: Редактирует указанный вопрос или рекомендацию.
@@ -170,18 +244,9 @@ class PostDetail(generics.RetrieveUpdateDestroyAPIView):
     # permission_classes = (IsAuthenticated, IsOwnerOrReadOnly)
 
     def get_queryset(self):
-        user_likes = Post.likes.through.objects.filter(
-            post=OuterRef('pk'), user=self.request.user)
-        user_follows = Post.follows.through.objects.filter(
-            post=OuterRef('pk'), user=self.request.user)
-        post = Post.objects.annotate(
-            countLike=Count('likes', distinct=True),
-            isLike=Exists(user_likes),
-            countComnt=Count('post_comments', distinct=True),
-            isFollow=Exists(user_follows))
-        return post
+        return annotate_posts(Post.objects.all(), self)
 
-class CommentList(generics.ListCreateAPIView):
+class CommentList(ConditionalMixin, generics.ListCreateAPIView):
     """
     get: Выводит список всех коментариев к указанной рекомендации.
     post: Создает новый комментарий к указанной рекомендации.
@@ -199,6 +264,13 @@ class CommentList(generics.ListCreateAPIView):
     def perform_create(self, serializer):
         serializer.save(author=self.request.user, post_id=self.get_post().pk)
 
+    def get(self, request, *args, **kwargs):
+        # Комментарии отслеживаемого поста прочитаны, в том числе при ответе 304
+        if Post.follows.through.objects.filter(post_id=self.kwargs['post'],
+                user_id=request.user.pk).exists():
+            unread.reset(request.user.pk, unread.COMMENTS)
+        return super(CommentList, self).get(request, *args, **kwargs)
+
 class CommentDetail(MultipleFieldLookupMixin, generics.RetrieveUpdateDestroyAPIView):
     """
     get: Выводит указанный комментарий к посту.
@@ -265,9 +337,16 @@ class PostFollow(generics.CreateAPIView, generics.DestroyAPIView):
     def perform_destroy(self, instance):
         instance.follows.remove(self.request.user)
 
+def suggest_limit(request, default=10, maximum=50):
+    try:
+        return max(1, min(maximum, int(request.query_params.get('limit', default))))
+    except ValueError:
+        return default
+
 class TagList(generics.ListAPIView):
     """
     Выводит список всех имеющихся тэгов.
+    С параметром ?q= - до ?limit= популярных тэгов, начинающихся с q.
     """
     serializer_class = TagSerializer
     pagination_class = None
@@ -275,14 +354,17 @@ class TagList(generics.ListAPIView):
     list_name = 'tags'
 
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
-        tags = [val['tag'] for val in serializer.data]
+        if 'q' in request.query_params:
+            found = prefix.tags.search(request.query_params['q'], suggest_limit(request))
+            return Response({self.list_name: [text for _, text in found]})
+        tags = cache.get_or_set('tags', 'all', lambda: [val['tag'] for val in
+            self.get_serializer(self.get_queryset(), many=True).data])
         return Response({self.list_name: tags})
 
 class CityList(generics.ListAPIView):
     """
     Выводит список всех имеющихся городов.
+    С параметром ?q= - до ?limit= популярных городов, начинающихся с q.
     """
     serializer_class = CitySerializer
     pagination_class = None
@@ -290,47 +372,99 @@ class CityList(generics.ListAPIView):
     list_name = 'cities'
 
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
-        cities = [val['name'] for val in serializer.data]
+        if 'q' in request.query_params:
+            found = prefix.cities.search(request.query_params['q'], suggest_limit(request))
+            return Response({self.list_name: [text for _, text in found]})
+        cities = cache.get_or_set('cities', 'all', lambda: [val['name'] for val in
+            self.get_serializer(self.get_queryset(), many=True).data])
         return Response({self.list_name: cities})
 
-class PostSimilar(generics.ListAPIView):
+class PostSimilar(PostFragmentsMixin, SparseFieldsMixin, generics.ListAPIView):
     """
-    Выводит список всех похожих (по тэгам) вопросов и рекомендаций.
+    Выводит список похожих вопросов и рекомендаций: по тексту (fm.textindex),
+    а если индекс не построен или похожих нет - по тэгам.
     """
     serializer_class = PostSerializer
 
     def get_queryset(self):
         # TODO: Возвращать 404 если нет такого поста
         post_id = self.kwargs['post']
+        found = textindex.similar(post_id)
+        if found:
+            return filter_ordered(annotate_posts(Post.objects.all(), self), [pk for pk, _ in found])
         tags = Post.tags.through.objects.filter(post_id=post_id).values('tag_id')
-        posts = Post.objects.filter(tags__in=tags).exclude(pk=post_id).distinct()
-        return posts
+        posts = Post.objects.filter(pk__in=Post.tags.through.objects.filter(tag_id__in=tags)
+            .values('post_id')).exclude(pk=post_id)
+        return annotate_posts(posts, self)
+
+class PostRecommended(PostFragmentsMixin, SparseFieldsMixin, generics.ListAPIView):
+    """
+    Рекомендованные пользователю посты: похожие (по совместным лайкам,
+    подпискам и просмотрам, см. команду recommend_build) на его последние
+    понравившиеся, до ?limit= штук.
+    """
+    serializer_class = PostSerializer
+    pagination_class = None
+
+    def get_queryset(self):
+        post_ids = recommend.recommended(self.request.user.pk,
+            suggest_limit(self.request, default=20, maximum=100))
+        return filter_ordered(annotate_posts(Post.objects.all(), self), post_ids)
+
+class PostDuplicates(PostFragmentsMixin, SparseFieldsMixin, generics.ListAPIView):
+    """
+    Возможные дубликаты вопроса, пока пользователь его набирает: до ?limit=
+    существующих вопросов, похожих на ?title= и ?description= (fm.duplicates).
+    """
+    serializer_class = PostSerializer
+    pagination_class = None
+
+    def get_queryset(self):
+        found = duplicates.find(self.request.query_params.get('title', ''),
+            self.request.query_params.get('description', ''), suggest_limit(self.request, default=5))
+        return filter_ordered(annotate_posts(Post.objects.all(), self), [pk for pk, _ in found])
 
-class PostExtended(generics.RetrieveAPIView):
+class PostExtended(ConditionalMixin, SparseFieldsMixin, generics.RetrieveAPIView):
     """
     Выводит расширенную информацию об указанном вопросе или рекомендации:
     список похожих вопросов/рекомендаций, комментарии, рекомендации.
+    ?embed=comments,notes,similar,countSimilar — только перечисленные списки.
     """
     serializer_class = PostExtendedSerializer
     lookup_url_kwarg = 'post'
+    load_limits = {'concurrency': 8, 'rate': '120/min', 'latency': 0.5}
 
     def get_post(self):
         post = get_object_or_404(Post.objects, pk=self.kwargs['post'])
         return post
 
     def get_queryset(self):
-        user_likes = Post.likes.through.objects.filter(
-            post=OuterRef('pk'), user=self.request.user)
-        user_follows = Post.follows.through.objects.filter(
-            post=OuterRef('pk'), user=self.request.user)
-        post = Post.objects.annotate(
-            countLike=Count('likes', distinct=True),
-            isLike=Exists(user_likes),
-            countComnt=Count('post_comments', distinct=True),
-            isFollow=Exists(user_follows))
-        return post
+        return annotate_posts(Post.objects.all(), self)
+
+    def get_version(self):
+        """
+        Ответ включает рекомендации и похожие посты, а также имена и фото
+        авторов: к версии поста добавляются число и сумма версий этих постов
+        и версия пространства "fragments" (сбрасывается при изменении
+        автора, см. fm.signals). Время изменения автора не хранится,
+        поэтому проверяется только ETag.
+        """
+        current = super(PostExtended, self).get_version()
+        if current is None:
+            return None
+        pk = int(self.kwargs['post'])
+        found = textindex.similar(pk)
+        if found:
+            similar = [post_id for post_id, _ in found[0:3]]
+        else:
+            tags = Post.tags.through.objects.filter(post_id=pk).values('tag_id')
+            similar = Post.tags.through.objects.filter(tag_id__in=tags).values('post_id')
+        notes = Comment.objects.filter(post_id=pk, note__isnull=False).values('note_id')
+        related = Post.objects.filter(Q(pk__in=notes) | Q(pk__in=similar)).exclude(pk=pk) \
+            .aggregate(num=Count('pk'), versions=Sum('version'))
+        version = '%d.%d.%d.%d.%d' % (current[0], related['num'], related['versions'] or 0,
+            len(found), cache.version('fragments'))
+        return version, None
 
     def get_serializer_context(self):
         context = super(PostExtended, self).get_serializer_context()
@@ -339,7 +473,7 @@ class PostExtended(generics.RetrieveAPIView):
         })
         return context
 
-class NoteList(generics.ListCreateAPIView):
+class NoteList(ConditionalMixin, PostFragmentsMixin, SparseFieldsMixin, generics.ListCreateAPIView):
     """
     get: Выводит список рекомендаций к указанному вопросу.
     post: Добавляет новую рекомендацию к указанному вопросу.
@@ -355,16 +489,7 @@ class NoteList(generics.ListCreateAPIView):
 
     def get_queryset(self):
         post = self.get_post()
-        user_likes = Post.likes.through.objects.filter(
-            post=OuterRef('pk'), user=self.request.user)
-        user_follows = Post.follows.through.objects.filter(
-            post=OuterRef('pk'), user=self.request.user)
-        notes = Post.objects.filter(note__post=post).annotate(
-            countLike=Count('likes', distinct=True),
-            isLike=Exists(user_likes),
-            countComnt=Count('post_comments', distinct=True),
-            isFollow=Exists(user_follows))
-        return notes
+        return annotate_posts(Post.objects.filter(note__post=post), self)
 
         # TODO: Выдача коментариев с прикрепленными постами
         # comments = Comment.objects.filter(post=self.get_post())
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 
 import os
 import datetime
+import importlib.util
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -51,6 +52,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'fm.middleware.LoadSheddingMiddleware',
+    'fm.middleware.ProfilingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -79,6 +82,90 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'friendmarket.wsgi.application'
 
+# Сброс нагрузки: запросы, ждавшие в очереди балансировщика дольше (сек.), получают 503;
+# ограничения для всех представлений (см. fm.middleware.LOAD_LIMITS)
+FM_MAX_QUEUE_TIME = 1.0
+FM_LOAD_LIMITS = {}
+
+# Кэш счетчиков частоты запросов: общий для всех процессов, с атомарным incr
+# (в бою - Memcached/Redis; у файлового кэша incr не атомарен между процессами)
+FM_RATE_CACHE_ALIAS = 'shared'
+
+# Прочитанные посты хранятся в сжатых битовых картах (fm.viewed) вместо таблицы Post.viewed.
+# Включается после переноса существующих данных командой viewed_convert
+FM_VIEWED_BITMAP = False
+
+# Период полного перестроения индексов автодополнения (fm.prefix), сек. Новые
+# и измененные теги, города, пользователи и их популярность сразу видны только
+# в процессе, где они сохранены: остальные процессы показывают прежние подсказки
+# до своего перестроения, то есть до FM_PREFIX_TTL сек. (import_ndjson
+# сбрасывает индексы всех процессов сразу)
+FM_PREFIX_TTL = 300
+
+# Профилирование запросов (fm.middleware.ProfilingMiddleware): процент запросов
+# со снятием стеков, порог медленного запроса (сек.), интервал выборки (сек.)
+# и число профилей в буфере каждого процесса
+FM_PROFILE_SAMPLE = 0
+FM_PROFILE_SLOW = 1.0
+FM_PROFILE_INTERVAL = 0.005
+FM_PROFILE_BUFFER = 50
+# Значение заголовка X-Profile, включающее профилирование без входа в админку
+# (для клиентов API); None - только X-Profile: 1 от сотрудника
+FM_PROFILE_SECRET = None
+
+# Журнал медленных SQL-запросов (fm.slowlog): порог, сек., и число отпечатков в статистике
+FM_SLOW_QUERY = 0.2
+FM_SLOW_QUERY_MAX = 500
+
+# Кэш: default - локальный для процесса, shared - общий для всех процессов: второй
+# уровень fm.cache и счетчики частоты запросов (в бою - Redis/Memcached вместо файлов)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/var/tmp/friendmarket_cache',
+    },
+}
+
+# Двухуровневый кэш (fm.cache): псевдоним кэша L2, размер LRU-кэша L1 в процессе,
+# период сверки версии пространства с L2 (сек.), число пространств, версии которых
+# помнит процесс, и время жизни записей (сек.)
+FM_CACHE_ALIAS = 'shared'
+FM_CACHE_L1_SIZE = 1000
+FM_CACHE_BUS_INTERVAL = 1.0
+FM_CACHE_NAMESPACES = 5000
+FM_CACHE_TIMEOUT = 300
+
+# Списки постов собираются из кэшированных фрагментов (fm.fragments)
+FM_POST_FRAGMENTS = True
+
+# Рекомендации (команда recommend_build, fm.recommend): число соседей поста, каталог
+# с матрицами для инкрементального пересчета, порог просмотров, после которого
+# просмотры пользователя не учитываются, и число последних лайков для подбора
+FM_RECOMMEND_K = 30
+FM_RECOMMEND_DIR = '/var/tmp/friendmarket_recommend'
+FM_RECOMMEND_MAX_VIEWS = 1000
+FM_RECOMMEND_SEEDS = 20
+
+# Похожие по тексту посты (fm.textindex): файл матрицы векторов (создается командой
+# text_index_build), размерность векторов, число похожих и минимальная косинусная мера
+FM_TEXT_INDEX = '/var/tmp/friendmarket_text.f32'
+FM_TEXT_DIM = 256
+FM_TEXT_TOP = 50
+FM_TEXT_MIN_SCORE = 0.2
+
+# Поиск дубликатов вопросов (fm.duplicates): минимальная оценка сходства
+# и предел числа кандидатов из индекса MinHash LSH
+FM_DUPLICATE_MIN_SCORE = 0.4
+FM_DUPLICATE_CANDIDATES = 200
+
+# Админка: размер таблицы, с которого число строк списка берется из статистики БД,
+# и число последних записей, среди которых сначала ищется текст (0 - по всей таблице)
+FM_ADMIN_ESTIMATE_THRESHOLD = 10000
+FM_ADMIN_SEARCH_WINDOW = 50000
+
 
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
@@ -91,6 +178,26 @@ DATABASES = {
 }
 
 
+# Пароли хэшируются в ограниченном пуле потоков (fm.hashers). Первый хэшер - основной:
+# пароли, сохраненные другим хэшером или с другими параметрами, пересчитываются при входе.
+# Список не зависит от установленных пакетов: Argon2 (argon2-cffi) нужен только для
+# проверки уже сохраненных им паролей
+PASSWORD_HASHERS = [
+    'fm.hashers.PooledPBKDF2PasswordHasher',
+    'fm.hashers.PooledArgon2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+]
+
+# Пул хэширования: потоков (None - по числу ядер), предел очереди (дальше - 503)
+# и параметры хэшеров. Argon2 не дешевле PBKDF2 на одну проверку (см. login_bench)
+# и требует FM_ARGON2_MEMORY_COST КБ памяти на каждый поток пула
+FM_HASH_WORKERS = None
+FM_HASH_QUEUE = 64
+FM_PBKDF2_ITERATIONS = 150000
+FM_ARGON2_TIME_COST = 2
+FM_ARGON2_MEMORY_COST = 65536
+FM_ARGON2_PARALLELISM = 1
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -134,12 +241,22 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Файлы именуются по хэшу содержимого, одинаковые загрузки хранятся один раз
+DEFAULT_FILE_STORAGE = 'fm.storage.HashedFileSystemStorage'
+
 # Configure the JWTs to expire after 1 hour, and allow users to refresh near-expiration tokens
 JWT_AUTH = {
     'JWT_EXPIRATION_DELTA': datetime.timedelta(days=14),
     'JWT_ALLOW_REFRESH': True,
 }
 
+# Формат MessagePack (fm.renderers) для мобильных клиентов, если установлен msgpack
+if importlib.util.find_spec('msgpack') is not None:
+    MSGPACK_RENDERERS = ('fm.renderers.MessagePackRenderer', )
+    MSGPACK_PARSERS = ('fm.renderers.MessagePackParser', )
+else:
+    MSGPACK_RENDERERS = MSGPACK_PARSERS = ()
+
 # Make JWT Auth the default authentication mechanism for Django
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': (
@@ -148,6 +265,17 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_jwt.authentication.JSONWebTokenAuthentication',
     ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest_framework.renderers.JSONRenderer',
+    ) + MSGPACK_RENDERERS + (
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'rest_framework.parsers.JSONParser',
+    ) + MSGPACK_PARSERS + (
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 100,
     'DATETIME_FORMAT': DATETIME_FORMAT
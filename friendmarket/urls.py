@@ -18,11 +18,22 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from rest_framework.documentation import include_docs_urls
+from fm.exports import export
+from fm.profiling import profile_list, profile_detail
+from fm.slowlog import slow_query_report
+from fm.cache import cache_stats
+from fm.hashers import hasher_stats
 
 urlpatterns = [
 	path('docs/', include_docs_urls(title='FriendMarket API',
 		authentication_classes=[], permission_classes=[])),
     path('grappelli/', include('grappelli.urls')), # grappelli URLS
+    path('admin/export/<slug:kind>/<slug:fmt>/', export, name='admin-export'),
+    path('admin/profiles/', profile_list, name='admin-profiles'),
+    path('admin/profiles/<int:pk>/', profile_detail, name='admin-profile'),
+    path('admin/slow-queries/', slow_query_report, name='admin-slow-queries'),
+    path('admin/cache/', cache_stats, name='admin-cache'),
+    path('admin/hashers/', hasher_stats, name='admin-hashers'),
     path('admin/', admin.site.urls),
     path('api-auth/', include('fm.urls'))
 ]